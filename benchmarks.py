@@ -0,0 +1,401 @@
+"""Micro-benchmarks for the gateway hot paths.
+
+Run all:            python benchmarks.py
+Run a selection:    python benchmarks.py crc frames
+
+Each benchmark prints one line per variant with the time per call, so results
+from a gateway PC can be pasted straight into an issue.
+"""
+import os
+import random
+import select
+import sys
+import time
+import timeit
+
+import rtucodec
+
+
+# --- Reference implementations (the original bit-by-bit code, kept for comparison) ---
+def legacy_calculate_crc(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def legacy_build_write_frame(slave_id, register, value):
+    frame = bytes([slave_id, 0x06, (register >> 8) & 0xFF, register & 0xFF,
+                   (value >> 8) & 0xFF, value & 0xFF])
+    crc = legacy_calculate_crc(frame)
+    return frame + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+
+
+def legacy_verify_crc(data):
+    if len(data) < 4:
+        return False
+    message = data[:-2]
+    return (data[-2] | (data[-1] << 8)) == legacy_calculate_crc(message)
+
+
+def legacy_read_response(slave_id, func_code, registers, start_addr, count):
+    resp = bytearray([slave_id, func_code, count * 2])
+    for i in range(count):
+        val = registers[start_addr + i]
+        resp.extend([(val >> 8) & 0xFF, val & 0xFF])
+    crc = legacy_calculate_crc(resp)
+    resp.extend([crc & 0xFF, (crc >> 8) & 0xFF])
+    return bytes(resp)
+
+
+def legacy_scan_stream(chunks, yaskawa_id):
+    """The original run_single_bus_gateway scan, one pass per received chunk"""
+    buffer = bytearray()
+    found = 0
+    for data in chunks:
+        buffer.extend(data)
+        if len(buffer) < 8:
+            continue
+        hit = False
+        for i in range(len(buffer) - 7):
+            if buffer[i] == yaskawa_id:
+                fc = buffer[i + 1]
+                frame_len = None
+                if fc in (0x03, 0x04, 0x06):
+                    frame_len = 8
+                elif fc == 0x10 and i + 7 <= len(buffer):
+                    frame_len = 9 + buffer[i + 6]
+                if frame_len and i + frame_len <= len(buffer):
+                    frame = buffer[i:i + frame_len]
+                    if legacy_verify_crc(frame):
+                        found += 1
+                        buffer = buffer[i + frame_len:]
+                        hit = True
+                        break
+        if not hit and len(buffer) > 256:
+            buffer = buffer[-64:]
+    return found
+
+
+def mixed_bus_traffic(cycles=200, seed=1):
+    """HMI polls to node 6, gateway replies, WEG (node 5) transactions and a third drive (node 7)"""
+    rng = random.Random(seed)
+    stream = bytearray()
+    for cycle in range(cycles):
+        stream += rtucodec.encode_read_request(6, 0x0020, 18)
+        stream += rtucodec.encode_read_response(6, 3, rtucodec.encode_register_values([cycle & 0xFFFF] * 18))
+        stream += rtucodec.encode_write_single(6, 0x0002, rng.randrange(6000))
+        stream += rtucodec.encode_write_single(6, 0x0002, rng.randrange(6000))
+        stream += rtucodec.encode_write_multiple(6, 0x0001, [1, rng.randrange(6000)])
+        stream += rtucodec.encode_echo_response(rtucodec.encode_write_multiple(6, 0x0001, [1, 0]))
+        stream += rtucodec.encode_write_single(5, 683, rng.randrange(8192))
+        stream += rtucodec.encode_write_single(5, 683, rng.randrange(8192))
+        stream += rtucodec.encode_read_request(5, 680, 1)
+        stream += rtucodec.encode_read_response(5, 3, rtucodec.encode_register_values([0x1300]))
+        stream += rtucodec.encode_read_request(7, 0x0000, 4)
+        stream += rtucodec.encode_exception(7, 3, 0x02)
+        if cycle % 10 == 0:
+            stream += bytes([0x00, 0xFF])  # line noise between frames
+    # Split like a USB-serial adapter would: random chunk sizes
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = rng.randint(1, 64)
+        chunks.append(bytes(stream[pos:pos + n]))
+        pos += n
+    return bytes(stream), chunks
+
+
+def _report(name, seconds, number, baseline=None):
+    per_call_us = seconds / number * 1e6
+    ratio = f'  ({baseline / seconds:.1f}x faster)' if baseline else ''
+    print(f'  {name:<40} {per_call_us:9.2f} us/call{ratio}')
+    return seconds
+
+
+def _time(stmt, number):
+    return min(timeit.repeat(stmt, number=number, repeat=5))
+
+
+def bench_crc():
+    """CRC-16 over an 8-byte request and a 41-byte FC03 response (18 registers)"""
+    print('crc:')
+    short = bytes(range(6))
+    long = bytes(range(39))
+    for label, data in (('8-byte frame (6 B)', short), ('41-byte frame (39 B)', long)):
+        n = 20000
+        base = _report(f'legacy  {label}', _time(lambda: legacy_calculate_crc(data), n), n)
+        _report(f'table   {label}', _time(lambda: rtucodec.crc16(data), n), n, base)
+    frame = rtucodec.encode_read_response(6, 3, bytes(36))
+    n = 20000
+    base = _report('legacy  verify 41-byte frame', _time(lambda: legacy_verify_crc(bytearray(frame)), n), n)
+    view = memoryview(frame)
+    _report('table   verify 41-byte memoryview', _time(lambda: rtucodec.check_crc(view), n), n, base)
+
+
+def bench_frames():
+    """Frame construction: FC06 request and an 18-register FC03 response"""
+    print('frames:')
+    n = 20000
+    base = _report('legacy  FC06 write frame', _time(lambda: legacy_build_write_frame(5, 683, 4096), n), n)
+    _report('codec   FC06 write frame', _time(lambda: rtucodec.encode_write_single(5, 683, 4096), n), n, base)
+    registers = list(range(0x100))
+    base = _report('legacy  FC03 response x18', _time(lambda: legacy_read_response(6, 3, registers, 0x20, 18), n), n)
+    _report('codec   FC03 response x18', _time(
+        lambda: rtucodec.encode_read_response(6, 3, rtucodec.encode_register_values(registers[0x20:0x32])), n), n, base)
+    request = memoryview(rtucodec.encode_write_multiple(6, 0x0001, [1, 3000]))
+    _report('codec   FC10 decode (memoryview)', _time(lambda: rtucodec.decode_write_multiple(request), n), n)
+
+
+def bench_parser():
+    """Streaming parser throughput on mixed multi-node traffic vs. the original buffer scan"""
+    print('parser:')
+    stream, chunks = mixed_bus_traffic()
+    node6_requests = 200 * 4
+
+    found = legacy_scan_stream(chunks, 6)
+    legacy = _time(lambda: legacy_scan_stream(chunks, 6), 1)
+    print(f'  {"legacy scan (node 6 only)":<40} {len(stream) / legacy / 1024:9.1f} KiB/s  '
+          f'{found}/{node6_requests} node-6 requests found')
+
+    def parse_all():
+        parser = rtucodec.RtuFrameParser()
+        frames = []
+        for data in chunks:
+            frames += parser.feed(data)
+        frames += parser.end_of_frame()
+        return parser, frames
+
+    parser, frames = parse_all()
+    elapsed = _time(parse_all, 1)
+    node6 = sum(1 for kind, frame in frames if kind == parser.REQUEST and frame[0] == 6)
+    print(f'  {"RtuFrameParser (all nodes)":<40} {len(stream) / elapsed / 1024:9.1f} KiB/s  '
+          f'{node6}/{node6_requests} node-6 requests, {len(frames)} frames, '
+          f'{parser.resyncs} resyncs, {parser.dropped_bytes} dropped bytes  ({legacy / elapsed:.1f}x faster)')
+    baud_kib = 115200 / 11 / 1024
+    print(f'  (115200 baud 8N2 line rate is {baud_kib:.1f} KiB/s)')
+
+
+def bench_readcache():
+    """process_yaskawa_request on the HMI's poll windows: uncached vs. response cache"""
+    import logging
+    import vfdserver
+
+    print('readcache:')
+    logging.getLogger('vfdserver').setLevel(logging.WARNING)
+    registers = vfdserver.new_yaskawa_image({0x0020: vfdserver.YASKAWA_STATUS_READY})
+    polls = [rtucodec.encode_read_request(6, 0x0020, 18), rtucodec.encode_read_request(6, 0x007F, 1),
+             rtucodec.encode_read_request(6, 0x07D8, 1)]
+    cache = vfdserver.yaskawa_response_cache
+
+    def poll_all(clear):
+        for request in polls:
+            if clear:
+                cache.clear()
+            vfdserver.process_yaskawa_request(request, registers, 6, 5, None)
+
+    n = 2000
+    base = _report('uncached (3 poll windows)', _time(lambda: poll_all(True), n), n)
+    cache.clear()
+    _report('cached   (3 poll windows)', _time(lambda: poll_all(False), n), n, base)
+    print(f'  {cache.stats()}')
+
+
+def bench_turnaround():
+    """HMI request -> response ready (process_yaskawa_request) with inline vs. deferred logging"""
+    import logging
+    import vfdserver
+
+    print('turnaround:')
+    log = logging.getLogger('vfdserver')
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    handler = logging.StreamHandler(open(os.devnull, 'w'))  # full logging cost, no terminal noise
+    log.addHandler(handler)
+    registers = vfdserver.new_yaskawa_image({0x0020: vfdserver.YASKAWA_STATUS_READY})
+    requests = [rtucodec.encode_read_request(6, 0x0020, 18), rtucodec.encode_read_request(6, 0x007F, 1),
+                rtucodec.encode_write_single(6, 0x0002, 3000), rtucodec.encode_write_multiple(6, 0x0001, [1, 4500])]
+    baseline = None
+    for label, async_logging in (('inline logging', False), ('log worker', True)):
+        vfdserver.config['ASYNC_LOGGING'] = async_logging
+        samples = []
+        for cycle in range(500):
+            for request in requests:
+                start = time.perf_counter()
+                vfdserver.process_yaskawa_request(request, registers, 6, 5, None)
+                samples.append(time.perf_counter() - start)
+            vfdserver.flush_messages()  # the worker drains between HMI polls, outside the timed path
+            vfdserver.weg_command_queue.clear()
+        p50, p99 = _percentile(samples, 50), _percentile(samples, 99)
+        ratio = f'  ({baseline / p50:.1f}x faster p50)' if baseline else ''
+        print(f'  {label:<40} p50 {p50 * 1e6:8.1f} us  p99 {p99 * 1e6:8.1f} us{ratio}')
+        baseline = baseline or p50
+    log.removeHandler(handler)
+    vfdserver.config['ASYNC_LOGGING'] = True
+
+
+def _legacy_message(msg_type, data):
+    """The original eager add_message entry for an RX dump: timestamp string, hex, f-string"""
+    from datetime import datetime
+    hex_data = ' '.join(f'{b:02X}' for b in data)
+    return {'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+            'type': msg_type, 'message': f"RX: {hex_data}"}
+
+
+def bench_events():
+    """Log event cost: eager message dicts vs. slotted LogEvents (memory per event, events/sec)"""
+    import tracemalloc
+    from eventlog import LogEvent, MessageRing
+
+    print('events:')
+    frame = rtucodec.encode_read_response(6, 3, bytes(36))  # 41-byte HMI response
+    n = 10000
+    variants = (
+        ('eager dict (legacy add_message)', lambda: _legacy_message('RAW', frame)),
+        ('LogEvent (raw fields)', lambda: LogEvent('RAW', 'RX: ', node=6, raw=frame)),
+    )
+    for label, make in variants:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        events = [make() for _ in range(n)]
+        per_event = (tracemalloc.get_traced_memory()[0] - before) / n
+        tracemalloc.stop()
+        del events
+        ring = MessageRing(100)
+        start = time.perf_counter()
+        for _ in range(n):
+            ring.append(make())
+        rate = n / (time.perf_counter() - start)
+        print(f'  {label:<40} {per_event:7.0f} B/event  {rate:10.0f} events/s')
+    event = LogEvent('RAW', 'RX: ', node=6, raw=frame)
+    _report('LogEvent.to_dicts (text cached)', _time(lambda: LogEvent.to_dicts(event), n), n)
+
+
+def _legacy_decode(register, value, is_write, registers, command_bits, status_bits):
+    """The original decode_yaskawa_command: fresh dict, if/elif chain, eager 12-bit breakdown"""
+    def bits(table):
+        return [{'bit': bit, 'description': text, 'state': 'ON' if value & (1 << bit) else 'OFF'}
+                for bit, text in table.items()]
+    result = {'register': register, 'register_hex': f'0x{register:04X}', 'value': value,
+              'value_hex': f'0x{value:04X}', 'value_binary': f'{value:016b}',
+              'operation': 'WRITE' if is_write else 'READ', 'description': '', 'decoded_bits': [],
+              'calculated_value': None}
+    reg_info = registers.get(register, {'name': 'UNKNOWN', 'description': f'Unknown Register {register}'})
+    result['register_name'] = reg_info['name']
+    result['description'] = reg_info['description']
+    if register == 0x0001:
+        result['decoded_bits'] = bits(command_bits)
+        result['calculated_value'] = 'RUN COMMAND ACTIVE' if value & 0x01 else 'STOP COMMAND'
+        result['calculated_value'] += ' (REVERSE)' if value & 0x02 else ' (FORWARD)'
+    elif register == 0x0000:
+        result['decoded_bits'] = bits(status_bits)
+    elif register == 0x0002:
+        result['calculated_value'] = f'{value / 100.0:.2f} Hz ({value/60:.0f} RPM at 2-pole)'
+    elif register in (0x0003, 0x0004):
+        result['calculated_value'] = f'{value / 100.0:.2f} {"Hz" if register == 0x0003 else "A"}'
+    elif register == 0x0005:
+        result['calculated_value'] = f'{value} V'
+    elif register == 0x0009:
+        result['calculated_value'] = f'{value} RPM'
+    elif register in (0x0010, 0x0011):
+        result['calculated_value'] = f'{value / 10.0:.1f} seconds'
+    return result
+
+
+def bench_decode():
+    """decode_yaskawa_command over an HMI poll window: original vs. compiled + memoized"""
+    import vfdserver
+
+    print('decode:')
+    # 0x0020 x18 status block plus a command word and speed reference write, as the HMI polls them
+    window = [(0x0020 + i, 0x0021 if i == 0 else i * 10, False) for i in range(18)]
+    window += [(0x0000, 0x0023, False), (0x0001, 0x0001, True), (0x0002, 4500, True)]
+    tables = (vfdserver.YASKAWA_REGISTERS, vfdserver.YASKAWA_COMMAND_BITS, vfdserver.YASKAWA_STATUS_BITS)
+    n = 2000
+    base = _report('original (21 registers)',
+                   _time(lambda: [_legacy_decode(r, v, w, *tables) for r, v, w in window], n), n)
+    vfdserver._decode_yaskawa.cache_clear()
+    decode = vfdserver.decode_yaskawa_command
+    _report('compiled + LRU (21 registers)',
+            _time(lambda: [decode(r, v, is_write=w) for r, v, w in window], n), n, base)
+    print(f'  {vfdserver._decode_yaskawa.cache_info()}')
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _pty_roundtrips(master, request, response_len, count):
+    """Send request on the pty master count times; return per-poll latencies (s)"""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        os.write(master, request)
+        reply = b''
+        while len(reply) < response_len:
+            ready, _, _ = select.select([master], [], [], 1.0)
+            if not ready:
+                break
+            reply += os.read(master, 256)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)  # HMI inter-poll gap
+    return latencies
+
+
+def bench_pty():
+    """Single-bus gateway over a pseudo-terminal: HMI poll latency and idle CPU per I/O mode (POSIX)"""
+    import logging
+    import threading
+    import tty
+    import vfdserver
+
+    print('pty:')
+    logging.getLogger('vfdserver').setLevel(logging.WARNING)
+    vfdserver.config.update({'BAUD_RATE': 38400, 'HEARTBEAT_INTERVAL': 1e9, 'SINGLE_BUS_MODE': True})
+    request = rtucodec.encode_read_request(vfdserver.config['YASKAWA_SLAVE_ID'], 0x0020, 18)
+    for mode in ('poll', 'select'):
+        master, slave = os.openpty()
+        tty.setraw(master)
+        vfdserver.config['PORT_CONTROLADOR'] = os.ttyname(slave)
+        vfdserver.config['SERIAL_IO_MODE'] = mode
+        vfdserver.server_running = True
+        thread = threading.Thread(target=vfdserver.run_single_bus_gateway, daemon=True)
+        thread.start()
+        time.sleep(0.3)
+
+        latencies = _pty_roundtrips(master, request, 5 + 36, 200)
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        time.sleep(2.0)
+        idle_cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start) * 100
+
+        vfdserver.server_running = False
+        thread.join(2)
+        os.close(master)
+        os.close(slave)
+        print(f'  {mode:<8} poll->response p50 {_percentile(latencies, 50) * 1000:6.2f} ms  '
+              f'p99 {_percentile(latencies, 99) * 1000:6.2f} ms  idle CPU {idle_cpu:5.1f} %')
+    print('  (latency includes the t3.5 = 1.75 ms turnaround the gateway must leave before answering)')
+
+
+BENCHMARKS = {
+    'crc': bench_crc,
+    'frames': bench_frames,
+    'parser': bench_parser,
+    'readcache': bench_readcache,
+    'turnaround': bench_turnaround,
+    'events': bench_events,
+    'decode': bench_decode,
+    'pty': bench_pty,
+}
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        BENCHMARKS[name]()
@@ -0,0 +1,404 @@
+"""Log events and the fixed-capacity ring they are kept in.
+
+LogEvent holds the raw fields of something that happened (monotonic timestamp,
+type, node, register, value, raw frame bytes); the human-readable text, the
+hex dump, the wall-clock timestamp string and the JSON dict are only built
+when a consumer (logger, web UI, export) asks for them, and then cached.
+
+Ring entries are numbered with a process-wide, monotonically increasing
+sequence. Consumers keep the last sequence number they have seen and ask for
+everything after it (since()), so a full buffer never hides new entries the
+way comparing list lengths did, and nobody has to copy the whole buffer to
+find what is new.
+
+Appends only lock to publish: the sequence number comes from itertools.count
+(atomic under the GIL) and each entry is written into its own slot with a
+single store; a short lock then raises the published last sequence number, so
+a producer holding a lower number can never lower it again. Readers check the
+sequence number stored with each slot, so an entry that was overwritten while
+they read is skipped, and a slot whose writer has not stored it yet ends the
+read (the next read resumes there).
+
+LogSampler sits in front of the ring: per-type rate limits and aggregation of
+identical events, so steady HMI polling does not flood the log.
+"""
+import itertools
+import threading
+import time
+from datetime import datetime
+
+# Wall clock = monotonic + offset (taken once, so events only store one float)
+_WALL_OFFSET = time.time() - time.monotonic()
+
+
+class LogEvent:
+    """One log event with lazily rendered text.
+
+    Either text (+ raw bytes, appended as a hex dump) or render(*args), a
+    function returning (type, message) pairs, gives the message lines; render
+    lets one event (e.g. an answered HMI read) expand into several log lines."""
+    __slots__ = ('seq', 'created', 'type', 'node', 'register', 'value', 'raw',
+                 'text', 'render', 'args', 'mode', '_lines')
+
+    def __init__(self, msg_type, text='', node=None, register=None, value=None, raw=None,
+                 render=None, args=(), created=None, mode=None):
+        self.seq = 0
+        self.created = time.monotonic() if created is None else created
+        self.type = msg_type
+        self.node = node
+        self.register = register
+        self.value = value
+        self.raw = raw
+        self.text = text
+        self.render = render
+        self.args = args
+        self.mode = mode
+        self._lines = None
+
+    @property
+    def wall_time(self):
+        """Creation time as time.time() seconds"""
+        return self.created + _WALL_OFFSET
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created + _WALL_OFFSET).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+    @property
+    def hex(self):
+        return memoryview(self.raw).hex(' ').upper() if self.raw is not None else ''
+
+    def lines(self):
+        """(type, message) pairs, rendered on first use"""
+        if self._lines is None:
+            if self.render is not None:
+                self._lines = tuple(self.render(*self.args))
+            else:
+                message = self.text
+                if self.raw is not None:
+                    message = f"{message}{self.hex}"
+                if self.node is not None:
+                    message = f"[Node {self.node}] {message}"
+                self._lines = ((self.type, message),)
+        return self._lines
+
+    @property
+    def message(self):
+        return '\n'.join(message for _, message in self.lines())
+
+    def to_dicts(self):
+        """JSON-ready dicts, one per message line"""
+        timestamp = self.timestamp
+        return [{'seq': self.seq, 'timestamp': timestamp, 'type': msg_type, 'message': message}
+                for msg_type, message in self.lines()]
+
+    def to_dict(self):
+        entry = {'seq': self.seq, 'timestamp': self.timestamp, 'type': self.type, 'message': self.message}
+        for field in ('node', 'register', 'value'):
+            if getattr(self, field) is not None:
+                entry[field] = getattr(self, field)
+        if self.raw is not None:
+            entry['hex'] = self.hex
+        return entry
+
+    @property
+    def key(self):
+        """Identity of the event for repeat aggregation (same kind, fields and frame)"""
+        return (self.type, self.node, self.register, self.value, self.raw, self.text, self.render, self.args)
+
+    def __getitem__(self, key):
+        """Dict-style access (event['type'], event['message']) for code written against message dicts"""
+        return getattr(self, key)
+
+    def __str__(self):
+        return self.message
+
+
+def as_dicts(entries):
+    """Flatten ring entries (LogEvents or plain dicts) into JSON-ready message dicts"""
+    result = []
+    for entry in entries:
+        if isinstance(entry, LogEvent):
+            result.extend(entry.to_dicts())
+        else:
+            result.append(entry)
+    return result
+
+
+DECODED_TYPE = 'DECODED'   # Subscription type of decoded-register entries
+
+
+def _parse_register(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+class EventFilter:
+    """A live-stream subscription: message types, node IDs, a register range and gateway modes.
+
+    Topics combine with AND; a topic left empty matches everything. A type matches the
+    event's own type (e.g. WRITE) or the type of individual lines (e.g. only the DECODE
+    lines of a read). Events without a node field match a node by their "[Node N]" text
+    prefix. Decoded-register entries have the type DECODED_TYPE and are filtered by the
+    same topics; their bit breakdown is only sent with include_bits. Subscriptions with
+    the same topics share `key`, so the stream filters each event once per distinct
+    subscription, not once per client.
+    """
+
+    def __init__(self, types=None, nodes=None, registers=None, modes=None, include_bits=False):
+        self.types = frozenset(t.strip().upper() for t in types if t.strip()) if types else None
+        self.types = self.types or None
+        self.nodes = frozenset(int(n) for n in nodes) if nodes else None
+        self.registers = (_parse_register(registers[0]), _parse_register(registers[1])) if registers else None
+        self.modes = frozenset(modes) if modes else None
+        self.include_bits = bool(include_bits)
+        self.key = (self.types, self.nodes, self.registers, self.modes)
+
+    @classmethod
+    def from_request(cls, data):
+        """Build from a subscribe payload; lists or comma-separated strings are accepted"""
+        def as_list(value):
+            if isinstance(value, str):
+                return [part for part in value.split(',') if part.strip()]
+            return list(value or [])
+        registers = data.get('registers') or None
+        if isinstance(registers, str):
+            low, _, high = registers.partition('-')
+            registers = (low.strip(), (high or low).strip())
+        return cls(as_list(data.get('types')), as_list(data.get('nodes')), registers, as_list(data.get('modes')),
+                   data.get('include_bits', False))
+
+    def select(self, event):
+        """JSON dicts of the event's lines this subscription receives ([] = none)"""
+        if self.modes is not None and event.mode not in self.modes:
+            return []
+        if self.registers is not None:
+            if event.register is None or not self.registers[0] <= event.register <= self.registers[1]:
+                return []
+        lines = event.lines()
+        if self.nodes is not None:
+            if event.node is not None:
+                if event.node not in self.nodes:
+                    return []
+            elif not any(f"[Node {node}]" in lines[0][1] for node in self.nodes):
+                return []
+        if self.types is not None and event.type not in self.types:
+            lines = [line for line in lines if line[0] in self.types]
+            if not lines:
+                return []
+        timestamp = event.timestamp
+        return [{'seq': event.seq, 'timestamp': timestamp, 'type': msg_type, 'message': message}
+                for msg_type, message in lines]
+
+    def match_decoded(self, entry):
+        """True if the subscription receives a decoded-register entry (type DECODED_TYPE)"""
+        if self.types is not None and DECODED_TYPE not in self.types:
+            return False
+        if self.nodes is not None and entry.get('node') not in self.nodes:
+            return False
+        if self.modes is not None and entry.get('mode') not in self.modes:
+            return False
+        if self.registers is not None:
+            return self.registers[0] <= entry.get('register', -1) <= self.registers[1]
+        return True
+
+    def to_dict(self):
+        return {
+            'types': sorted(self.types) if self.types else [],
+            'nodes': sorted(self.nodes) if self.nodes else [],
+            'registers': list(self.registers) if self.registers else None,
+            'modes': sorted(self.modes) if self.modes else [],
+            'include_bits': self.include_bits,
+        }
+
+
+def _render_repeat(event, count, elapsed):
+    msg_type, message = event.lines()[0]
+    yield msg_type, f"{message}  [repeated {count}x in {elapsed:.1f}s]"
+
+
+def _render_rate_limited(msg_type, count, rate, elapsed):
+    yield msg_type, f"{count} {msg_type} messages suppressed in {elapsed:.1f}s (limit {rate}/s)"
+
+
+class LogSampler:
+    """Per-category rate limits and repeat aggregation for log events.
+
+    Types in `always` (state changes: writes, translations, errors...) always
+    pass. Any other event identical to one seen less than `repeat_window`
+    seconds ago is counted instead of stored; when the window closes a single
+    "[repeated Nx in Ts]" line replaces the copies. Events that are not repeats
+    are limited per type to `rates[type]` per second (token bucket, one second
+    of burst); what the limit drops is reported as a count once per second.
+    """
+    MAX_TRACKED = 1024  # distinct events tracked for repeats at once
+
+    def __init__(self, rates=None, repeat_window=5.0, always=()):
+        self._lock = threading.Lock()
+        self._repeats = {}   # key -> [first event, window start, suppressed count]
+        self._buckets = {}   # type -> [tokens, last refill]
+        self._dropped = {}   # type -> [count, since]
+        self._last_expire = 0.0
+        self.passed = 0
+        self.suppressed_repeat = 0
+        self.suppressed_rate = {}
+        self.configure(rates or {}, repeat_window, always)
+
+    def configure(self, rates=None, repeat_window=None, always=None):
+        """Change thresholds live; None leaves a setting as it is"""
+        with self._lock:
+            if rates is not None:
+                self.rates = dict(rates)
+                self._buckets.clear()
+            if repeat_window is not None:
+                self.repeat_window = repeat_window
+            if always is not None:
+                self.always = frozenset(always)
+
+    def filter(self, event):
+        """Events to store for this one: [] (suppressed), [event], or summaries + [event]"""
+        if event.type in self.always:
+            self.passed += 1
+            return [event]
+        now = event.created
+        with self._lock:
+            out = self._expire(now) if now - self._last_expire >= 1.0 else []
+            if self.repeat_window:
+                try:
+                    key = event.key
+                    entry = self._repeats.get(key)
+                except TypeError:  # unhashable args: no aggregation for this event
+                    key = entry = None
+                if entry is not None:
+                    if now - entry[1] < self.repeat_window:
+                        entry[2] += 1
+                        self.suppressed_repeat += 1
+                        return out
+                    if entry[2]:
+                        out.append(LogEvent(event.type, render=_render_repeat, args=(entry[0], entry[2], now - entry[1]),
+                                            created=now, mode=entry[0].mode))
+                if key is not None:
+                    if len(self._repeats) >= self.MAX_TRACKED:
+                        out += self._expire(now, force=True)
+                    self._repeats[key] = [event, now, 0]
+            rate = self.rates.get(event.type)
+            if rate:
+                bucket = self._buckets.get(event.type)
+                if bucket is None:
+                    bucket = self._buckets[event.type] = [float(rate), now]
+                bucket[0] = min(float(rate), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                if bucket[0] < 1.0:
+                    dropped = self._dropped.setdefault(event.type, [0, now])
+                    dropped[0] += 1
+                    self.suppressed_rate[event.type] = self.suppressed_rate.get(event.type, 0) + 1
+                    return out
+                bucket[0] -= 1.0
+            self.passed += 1
+            out.append(event)
+            return out
+
+    def expire(self, now):
+        """Summaries for repeat windows and rate-limit periods that have ended"""
+        with self._lock:
+            return self._expire(now)
+
+    def _expire(self, now, force=False):
+        self._last_expire = now
+        out = []
+        for key, (first, start, count) in list(self._repeats.items()):
+            if force or now - start >= self.repeat_window:
+                del self._repeats[key]
+                if count:
+                    out.append(LogEvent(first.type, render=_render_repeat, args=(first, count, now - start),
+                                        created=now, mode=first.mode))
+        for msg_type, (count, since) in list(self._dropped.items()):
+            if now - since >= 1.0:
+                del self._dropped[msg_type]
+                out.append(LogEvent(msg_type, render=_render_rate_limited,
+                                    args=(msg_type, count, self.rates.get(msg_type), now - since), created=now))
+        return out
+
+    def stats(self):
+        return {
+            'passed': self.passed,
+            'suppressed_repeat': self.suppressed_repeat,
+            'suppressed_rate': dict(self.suppressed_rate),
+            'tracked_repeats': len(self._repeats),
+            'rates': dict(self.rates),
+            'repeat_window_s': self.repeat_window,
+            'always': sorted(self.always),
+        }
+
+
+class MessageRing:
+    """Ring of the last `capacity` entries, readable by sequence-number cursor"""
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._counter = itertools.count(1)
+        self._last = 0      # highest sequence number appended so far
+        self._publish = threading.Lock()   # guards the read-compare-write of _last
+        self._floor = 0     # entries up to this sequence number were cleared
+
+    def append(self, entry):
+        """Store entry (a dict gets a 'seq' key, a LogEvent its seq); returns its sequence number"""
+        seq = next(self._counter)
+        if isinstance(entry, dict):
+            entry['seq'] = seq
+        else:
+            entry.seq = seq
+        self._slots[seq % self.capacity] = (seq, entry)
+        with self._publish:
+            if seq > self._last:
+                self._last = seq
+        return seq
+
+    @property
+    def last_seq(self):
+        """Sequence number of the newest entry (0 if nothing was ever appended)"""
+        return self._last
+
+    @property
+    def floor(self):
+        """Sequence number up to which entries were cleared"""
+        return self._floor
+
+    def missed(self, seq):
+        """How many entries after seq are gone because the ring wrapped (cleared ones don't count)"""
+        return max(0, self._last - self.capacity - max(seq, self._floor))
+
+    def since(self, seq=0, limit=None):
+        """Entries with a sequence number greater than seq, oldest first.
+
+        Returns (entries, cursor): pass cursor back as seq on the next call. If the
+        consumer fell more than `capacity` entries behind, the missed ones are gone
+        and the read starts at the oldest entry still held."""
+        last = self._last
+        start = max(seq, self._floor, last - self.capacity) + 1
+        end = last if limit is None else min(last, start + limit - 1)
+        entries = []
+        cursor = max(seq, start - 1)
+        slots = self._slots
+        capacity = self.capacity
+        for expected in range(start, end + 1):
+            slot = slots[expected % capacity]
+            if slot is None or slot[0] < expected:
+                break  # Writer has taken the number but not stored the entry yet
+            if slot[0] == expected:
+                entries.append(slot[1])
+            cursor = expected
+        return entries, cursor
+
+    def clear(self):
+        """Forget the current entries; sequence numbers keep increasing so cursors stay valid"""
+        self._floor = self._last
+
+    def __len__(self):
+        return min(self._last - self._floor, self.capacity)
+
+    def __iter__(self):
+        return iter(self.since(0)[0])
+
+    def __getitem__(self, index):
+        return self.since(0)[0][index]
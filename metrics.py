@@ -0,0 +1,166 @@
+"""Counters and fixed-bucket latency histograms for the gateway.
+
+Recording is cheap enough for the serial loop: a counter is one integer add, and
+a histogram observation is a bisect into a short tuple of bucket bounds plus
+three adds. Neither takes a lock. Each metric has one writer thread (the serial
+thread, or the log worker); readers may see a histogram whose count and buckets
+are one observation apart, which is fine for monitoring.
+
+A MetricsRegistry renders everything as a JSON-able dict (to_dict) or in the
+Prometheus text exposition format (prometheus).
+"""
+import bisect
+
+# Upper bounds in seconds: 0.25 ms .. 2 s covers a t3.5 gap at 115200 bd up to a WEG timeout
+LATENCY_BUCKETS_S = (0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                     0.1, 0.2, 0.5, 1.0, 2.0)
+
+
+class Counter:
+    """Monotonically increasing count"""
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def reset(self):
+        self.value = 0
+
+    def to_dict(self):
+        return self.value
+
+
+class Histogram:
+    """Observations counted into fixed buckets (upper bounds), plus their sum.
+
+    counts[i] is the number of observations <= buckets[i] and > buckets[i - 1];
+    the last slot counts everything above the highest bound."""
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS_S):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def quantile(self, q):
+        """Estimate of the q-quantile (0..1), interpolated linearly inside its bucket.
+        None without observations; values above the highest bound report that bound."""
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def to_dict(self):
+        """Count, mean and p50/p90/p99 in milliseconds, plus [upper bound ms, cumulative count] pairs"""
+        count = self.count
+        cumulative = []
+        running = 0
+        for bound, n in zip(self.buckets, self.counts):
+            running += n
+            cumulative.append([bound * 1000, running])
+        cumulative.append(['+Inf', running + self.counts[-1]])
+        return {
+            'count': count,
+            'avg_ms': self.sum / count * 1000 if count else None,
+            'p50_ms': _ms(self.quantile(0.50)),
+            'p90_ms': _ms(self.quantile(0.90)),
+            'p99_ms': _ms(self.quantile(0.99)),
+            'buckets_ms': cumulative,
+        }
+
+
+def _ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+class MetricsRegistry:
+    """Named counters and histograms; metric names are exported with `prefix`_ in front"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = {}
+
+    def counter(self, name, help=''):
+        """The counter called name, created on first use"""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Counter(name, help)
+        return metric
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS_S):
+        """The histogram called name, created on first use"""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Histogram(name, help, buckets)
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def to_dict(self):
+        """{'counters': {name: value}, 'histograms': {name: summary}}"""
+        counters = {}
+        histograms = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Histogram):
+                histograms[name] = metric.to_dict()
+            else:
+                counters[name] = metric.to_dict()
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for name, metric in self._metrics.items():
+            full = f'{self.prefix}_{name}'
+            if isinstance(metric, Histogram):
+                if metric.help:
+                    lines.append(f'# HELP {full} {metric.help}')
+                lines.append(f'# TYPE {full} histogram')
+                counts = list(metric.counts)
+                running = 0
+                for bound, n in zip(metric.buckets, counts):
+                    running += n
+                    lines.append(f'{full}_bucket{{le="{bound:g}"}} {running}')
+                running += counts[-1]
+                lines.append(f'{full}_bucket{{le="+Inf"}} {running}')
+                lines.append(f'{full}_sum {metric.sum!r}')
+                lines.append(f'{full}_count {running}')
+            else:
+                if metric.help:
+                    lines.append(f'# HELP {full}_total {metric.help}')
+                lines.append(f'# TYPE {full}_total counter')
+                lines.append(f'{full}_total {metric.value}')
+        return '\n'.join(lines) + '\n'
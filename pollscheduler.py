@@ -0,0 +1,196 @@
+"""Multi-rate poll scheduler for reading a Modbus slave within a bus-time budget.
+
+A poll table is a list of PollEntry rows: a register range, a period (or a
+parameter whose change triggers the read) and the target registers its values
+feed. due() returns the reads to issue now, with entries that are due together
+and close to each other merged into one FC03 range, so the fewest transactions
+are sent.
+
+The scheduler estimates the bus time its reads take (cost(count), supplied by
+the caller) against a budget: a share of the bus time other traffic leaves
+free. When the table asks for more than that, the periods of non-essential
+entries are stretched by a common factor until it fits. Essential entries
+(e.g. the one keeping a serial watchdog alive) keep their period. Each entry
+reports its target, effective and achieved rate.
+"""
+import time
+from collections import deque
+
+MAX_READ_COUNT = 125   # FC03 limit
+MAX_STRETCH = 50.0     # Periods are never stretched beyond this factor
+
+
+class PollEntry:
+    """One row of a poll table.
+
+    Registers start .. start + count - 1 are read every `period` seconds, or, with
+    period None, whenever register `on_change` is seen with a new value.
+    targets: (target register, source registers, scale) tuples; scale(*values) gives
+    the target value from the source values of one read."""
+    __slots__ = ('name', 'start', 'count', 'period', 'targets', 'essential', 'on_change',
+                 'effective_period', 'next_due', 'reads', 'failures', 'last_read', '_history')
+
+    def __init__(self, name, start, count, period, targets=(), essential=False, on_change=None):
+        self.name = name
+        self.start = start
+        self.count = count
+        self.period = period
+        self.targets = tuple(targets)
+        self.essential = essential
+        self.on_change = on_change
+        self.effective_period = period
+        self.next_due = 0.0 if period is not None else None
+        self.reads = 0
+        self.failures = 0
+        self.last_read = None
+        self._history = deque(maxlen=20)   # times of the last successful reads
+
+    @property
+    def end(self):
+        return self.start + self.count
+
+    def achieved_hz(self):
+        """Reads per second over the last successful reads (None until two were made)"""
+        history = self._history
+        if len(history) < 2 or history[-1] == history[0]:
+            return None
+        return (len(history) - 1) / (history[-1] - history[0])
+
+
+class PollScheduler:
+    """Merges due PollEntry rows into FC03 reads and paces them to a bus-time budget"""
+
+    def __init__(self, entries, cost, budget=0.3, merge_gap=8):
+        self.entries = list(entries)
+        self.cost = cost              # cost(count) -> seconds of bus time for one read
+        self.budget = budget          # share of the free bus time polling may use
+        self.merge_gap = merge_gap    # unused registers allowed between merged entries
+        self.stretch = 1.0
+        self.demand = 0.0             # bus time per second the table asks for (unstretched)
+        self.available = budget
+        self.transactions = 0
+        self._values = {}             # register -> last value seen (for on_change)
+
+    def configure(self, budget=None, periods=None):
+        """Change the budget and/or entry periods ({name: seconds})"""
+        if budget is not None:
+            self.budget = budget
+        for entry in self.entries:
+            if periods and entry.name in periods and entry.period is not None:
+                entry.period = float(periods[entry.name])
+
+    def rebalance(self, bus_load=0.0):
+        """Fit the table into budget * (1 - bus_load) by stretching non-essential periods"""
+        self.available = max(0.0, self.budget * (1.0 - bus_load))
+        essential = flexible = 0.0
+        for entry in self.entries:
+            if entry.period:
+                share = self.cost(entry.count) / entry.period
+                if entry.essential:
+                    essential += share
+                else:
+                    flexible += share
+        self.demand = essential + flexible
+        stretch = 1.0
+        if flexible and self.demand > self.available:
+            room = self.available - essential
+            stretch = flexible / room if room > 0 else MAX_STRETCH
+        self.stretch = min(MAX_STRETCH, max(1.0, stretch))
+        for entry in self.entries:
+            if entry.period:
+                entry.effective_period = entry.period * (1.0 if entry.essential else self.stretch)
+
+    def entry(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+    def reschedule(self, name, at):
+        """Move the next read of entry `name` to time at (e.g. because other traffic did its job)"""
+        entry = self.entry(name)
+        if entry is not None and entry.period:
+            entry.next_due = at
+
+    def next_due(self):
+        """Earliest time an entry is due (None if nothing is scheduled)"""
+        times = [entry.next_due for entry in self.entries if entry.next_due is not None]
+        return min(times) if times else None
+
+    def due(self, now=None):
+        """(start, count) reads covering every entry due at now, merged; the entries are
+        rescheduled one effective period later (periodic) or cleared (on change)"""
+        now = time.time() if now is None else now
+        due = [entry for entry in self.entries if entry.next_due is not None and entry.next_due <= now]
+        if not due:
+            return []
+        for entry in due:
+            if entry.period:
+                # Keep the phase, but never try to catch up on slots missed while the bus was busy
+                entry.next_due = max(entry.next_due + entry.effective_period, now)
+            else:
+                entry.next_due = None
+        due.sort(key=lambda entry: entry.start)
+        reads = []
+        start, end = due[0].start, due[0].end
+        for entry in due[1:]:
+            if entry.start <= end + self.merge_gap and max(end, entry.end) - start <= MAX_READ_COUNT:
+                end = max(end, entry.end)
+            else:
+                reads.append((start, end - start))
+                start, end = entry.start, entry.end
+        reads.append((start, end - start))
+        self.transactions += len(reads)
+        return reads
+
+    def completed(self, start, values, at=None):
+        """Record the reply to a read; returns the entries it covered"""
+        at = time.time() if at is None else at
+        end = start + len(values)
+        covered = [entry for entry in self.entries if entry.start >= start and entry.end <= end]
+        for entry in covered:
+            entry.reads += 1
+            entry.last_read = at
+            entry._history.append(at)
+        for i, value in enumerate(values):
+            register = start + i
+            previous = self._values.get(register)
+            self._values[register] = value
+            if previous != value:
+                for entry in self.entries:
+                    if entry.on_change == register:
+                        entry.next_due = at
+        return covered
+
+    def failed(self, start, count):
+        """Record a read that got no (valid) reply"""
+        for entry in self.entries:
+            if entry.start >= start and entry.end <= start + count:
+                entry.failures += 1
+
+    def stats(self, now=None):
+        now = time.time() if now is None else now
+        entries = {}
+        for entry in self.entries:
+            achieved = entry.achieved_hz()
+            entries[entry.name] = {
+                'start': entry.start,
+                'count': entry.count,
+                'period_s': entry.period,
+                'on_change': entry.on_change,
+                'essential': entry.essential,
+                'target_hz': round(1.0 / entry.period, 3) if entry.period else None,
+                'effective_hz': round(1.0 / entry.effective_period, 3) if entry.period else None,
+                'achieved_hz': round(achieved, 3) if achieved is not None else None,
+                'reads': entry.reads,
+                'failures': entry.failures,
+                'age_ms': (now - entry.last_read) * 1000 if entry.last_read is not None else None,
+            }
+        return {
+            'budget': self.budget,
+            'available': round(self.available, 4),
+            'demand': round(self.demand, 4),
+            'stretch': round(self.stretch, 3),
+            'transactions': self.transactions,
+            'entries': entries,
+        }
@@ -0,0 +1,115 @@
+"""Register image of the emulated Yaskawa A1000.
+
+One array('H') holds every holding register the HMI can read or write, in all
+gateway modes. Ranges are read and written in bulk: a multi-register read is a
+single slice plus byteswap into big-endian wire order, not a per-register loop.
+
+Each block of BLOCK_SIZE registers has a version counter that is bumped whenever
+a register in it changes, so callers holding derived data (e.g. an encoded
+response) can check it is still current with range_version(). Protected ranges
+(read-only identification registers) are declared on the image and silently
+keep their value when written.
+"""
+import sys
+from array import array
+
+BLOCK_SIZE = 16
+_SWAP = sys.byteorder == 'little'
+
+
+class RegisterImage:
+    """Fixed-size table of 16-bit registers with per-block versions and protected ranges"""
+
+    def __init__(self, size=0x1000, protected=()):
+        self.size = size
+        self._data = array('H', bytes(size * 2))
+        self._versions = array('L', bytes(array('L').itemsize * ((size + BLOCK_SIZE - 1) // BLOCK_SIZE)))
+        self._protected = []
+        for start, end in protected:
+            self.protect(start, end)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._data[index].tolist()
+        return self._data[index]
+
+    def __setitem__(self, address, value):
+        self.set(address, (value,))
+
+    def protect(self, start, end):
+        """Declare registers start..end (inclusive) read-only for set()/set_bytes()"""
+        self._protected.append((start, end))
+
+    def is_protected(self, address):
+        for start, end in self._protected:
+            if start <= address <= end:
+                return True
+        return False
+
+    def get(self, address, count=1):
+        """Values of registers address .. address + count - 1 (past the end read as 0)"""
+        values = self._data[address:address + count].tolist()
+        if len(values) < count:
+            values += [0] * (count - len(values))
+        return values
+
+    def get_bytes(self, address, count=1):
+        """Big-endian bytes of a register range, ready to go into an FC03/04 response"""
+        chunk = self._data[address:address + count]
+        if _SWAP:
+            chunk.byteswap()
+        data = chunk.tobytes()
+        if len(chunk) < count:
+            data += bytes((count - len(chunk)) * 2)
+        return data
+
+    def load(self, address, values):
+        """Initialise registers, protected ones included (e.g. the identification values)"""
+        end = min(address + len(values), self.size)
+        if address >= end:
+            return
+        self._data[address:end] = array('H', values[:end - address])
+        for block in range(address // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+            self._versions[block] += 1
+
+    def set(self, address, values):
+        """Store values from address on. Protected and out-of-range registers are skipped.
+
+        Returns the number of registers whose value changed."""
+        end = min(address + len(values), self.size)
+        if address >= end:
+            return 0
+        new = array('H', values[:end - address])
+        for start, stop in self._protected:
+            for addr in range(max(start, address), min(stop + 1, end)):
+                new[addr - address] = self._data[addr]
+        old = self._data[address:end]
+        if old == new:
+            return 0
+        self._data[address:end] = new
+        changed = 0
+        for block in range(address // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+            lo = max(address, block * BLOCK_SIZE) - address
+            hi = min(end, (block + 1) * BLOCK_SIZE) - address
+            diff = sum(1 for a, b in zip(old[lo:hi], new[lo:hi]) if a != b)
+            if diff:
+                self._versions[block] += 1
+                changed += diff
+        return changed
+
+    def set_bytes(self, address, data):
+        """Store big-endian register bytes (e.g. the payload of an FC10 write or FC03 reply)"""
+        values = array('H', bytes(data))
+        if _SWAP:
+            values.byteswap()
+        return self.set(address, values.tolist())
+
+    def range_version(self, address, count=1):
+        """Changes whenever any register in the range changes (sum of the block versions)"""
+        if address >= self.size:
+            return 0
+        end = min(address + count, self.size)
+        return sum(self._versions[address // BLOCK_SIZE:(end - 1) // BLOCK_SIZE + 1])
@@ -0,0 +1,375 @@
+"""Modbus RTU codec used by the single-bus gateway.
+
+Table-driven CRC-16 (poly 0xA001, init 0xFFFF) and encode/decode helpers for
+FC 03/04/06/10. Decoders take any buffer (bytes, bytearray, memoryview) and read
+fields in place with struct.unpack_from, so a frame sitting in a receive buffer
+never has to be sliced into a new object just to be inspected.
+"""
+import struct
+
+CRC16_INIT = 0xFFFF
+
+
+def _build_crc_table():
+    """Precompute the 256-entry table for the reflected 0xA001 polynomial"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _build_crc_table()
+
+# Function codes the gateway understands
+FC_READ_HOLDING = 0x03
+FC_READ_INPUT = 0x04
+FC_WRITE_SINGLE = 0x06
+FC_WRITE_MULTIPLE = 0x10
+SUPPORTED_FCS = (FC_READ_HOLDING, FC_READ_INPUT, FC_WRITE_SINGLE, FC_WRITE_MULTIPLE)
+
+MAX_RTU_FRAME = 256  # Modbus RTU ADU limit (address + PDU 253 + CRC 2)
+
+_HEADER = struct.Struct('>BBHH')     # slave, fc, address, count/value
+_CRC = struct.Struct('<H')           # CRC is sent low byte first
+
+
+def crc16(data, crc=CRC16_INIT):
+    """Modbus CRC-16 of data. Pass a previous result as crc to continue a running CRC."""
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def crc16_update(crc, byte):
+    """Extend a running CRC by a single byte (for byte-at-a-time receivers)"""
+    return (crc >> 8) ^ CRC16_TABLE[(crc ^ byte) & 0xFF]
+
+
+def check_crc(frame, length=None):
+    """True if the last two bytes of frame[:length] are the CRC of the bytes before them.
+
+    Works on a memoryview without copying: running the CRC over a frame that
+    includes its own CRC always yields 0, so the payload is never sliced out."""
+    view = memoryview(frame)
+    if length is not None:
+        view = view[:length]
+    return len(view) >= 4 and crc16(view) == 0
+
+
+def append_crc(frame, length=None):
+    """Write the CRC of frame[:length] into frame[length:length + 2] (frame must be a bytearray)"""
+    if length is None:
+        length = len(frame) - 2
+    crc = crc16(memoryview(frame)[:length])
+    _CRC.pack_into(frame, length, crc)
+    return frame
+
+
+# --- ENCODERS ---
+def encode_request(slave_id, func_code, address, count_or_value):
+    """Build an 8-byte FC03/04 read request or FC06 write request"""
+    frame = bytearray(8)
+    _HEADER.pack_into(frame, 0, slave_id, func_code, address & 0xFFFF, count_or_value & 0xFFFF)
+    return bytes(append_crc(frame, 6))
+
+
+def encode_read_request(slave_id, address, count, func_code=FC_READ_HOLDING):
+    """Build a Modbus RTU read holding/input registers request (FC 0x03/0x04)"""
+    return encode_request(slave_id, func_code, address, count)
+
+
+def encode_write_single(slave_id, register, value):
+    """Build a Modbus RTU write single register frame (FC 0x06)"""
+    return encode_request(slave_id, FC_WRITE_SINGLE, register, value)
+
+
+def encode_write_multiple(slave_id, address, values):
+    """Build a Modbus RTU write multiple registers frame (FC 0x10)"""
+    count = len(values)
+    frame = bytearray(9 + count * 2)
+    _HEADER.pack_into(frame, 0, slave_id, FC_WRITE_MULTIPLE, address & 0xFFFF, count)
+    frame[6] = count * 2
+    struct.pack_into(f'>{count}H', frame, 7, *(value & 0xFFFF for value in values))
+    return bytes(append_crc(frame, 7 + count * 2))
+
+
+def encode_read_response(slave_id, func_code, payload):
+    """Build an FC03/04 response around payload (big-endian register bytes).
+
+    payload may be any buffer (bytes, memoryview, array already byteswapped)."""
+    payload = memoryview(payload).cast('B')
+    byte_count = len(payload)
+    frame = bytearray(5 + byte_count)
+    frame[0] = slave_id
+    frame[1] = func_code
+    frame[2] = byte_count
+    frame[3:3 + byte_count] = payload
+    return bytes(append_crc(frame, 3 + byte_count))
+
+
+def encode_register_values(values):
+    """Pack a sequence of register values into big-endian bytes"""
+    return struct.pack(f'>{len(values)}H', *values)
+
+
+def encode_echo_response(request):
+    """Build the FC06/FC10 acknowledgement: slave, fc and the first four data bytes of the request"""
+    frame = bytearray(8)
+    frame[0:6] = memoryview(request)[0:6]
+    return bytes(append_crc(frame, 6))
+
+
+def encode_exception(slave_id, func_code, exception_code):
+    """Build a 5-byte exception response"""
+    frame = bytearray(5)
+    frame[0] = slave_id
+    frame[1] = (func_code | 0x80) & 0xFF
+    frame[2] = exception_code
+    return bytes(append_crc(frame, 3))
+
+
+# --- DECODERS (no copies: all read in place with unpack_from) ---
+def decode_read_request(frame):
+    """Return (slave_id, func_code, start, count) of an FC03/04 request"""
+    return _HEADER.unpack_from(frame, 0)
+
+
+def decode_write_single(frame):
+    """Return (slave_id, register, value) of an FC06 request or echo"""
+    slave_id, _, register, value = _HEADER.unpack_from(frame, 0)
+    return slave_id, register, value
+
+
+def decode_write_multiple(frame):
+    """Return (slave_id, start, values) of an FC10 request"""
+    slave_id, _, start, count = _HEADER.unpack_from(frame, 0)
+    return slave_id, start, struct.unpack_from(f'>{count}H', frame, 7)
+
+
+def decode_read_response(frame):
+    """Return (slave_id, func_code, values) of an FC03/04 response"""
+    slave_id, func_code, byte_count = frame[0], frame[1], frame[2]
+    return slave_id, func_code, struct.unpack_from(f'>{byte_count // 2}H', frame, 3)
+
+
+def read_response_payload(frame):
+    """Zero-copy view of the register bytes of an FC03/04 response"""
+    view = memoryview(frame)
+    return view[3:3 + view[2]]
+
+
+def hex_bytes(data):
+    """Space-separated upper-case hex dump, as used in the log"""
+    return memoryview(data).hex(' ').upper()
+
+
+# --- FRAME LENGTHS ---
+def get_modbus_request_frame_length(data):
+    """Return length of first Modbus request frame in data, or None if incomplete/unknown.
+    Used to scan a buffer containing multiple concatenated frames."""
+    if len(data) < 4:
+        return None
+    fc = data[1]
+    if fc in (0x03, 0x04):  # Read Holding/Input Registers - 8 bytes
+        return 8 if len(data) >= 8 else None
+    if fc == 0x06:  # Write Single Register - 8 bytes
+        return 8 if len(data) >= 8 else None
+    if fc == 0x10:  # Write Multiple Registers
+        if len(data) < 7:
+            return None
+        byte_count = data[6]
+        total = 9 + byte_count
+        return total if len(data) >= total else None
+    # Unknown function code - caller can skip 1 byte to resync
+    return None
+
+
+def get_modbus_response_frame_length(data):
+    """Return length of a Modbus response frame (from slave e.g. WEG), or None."""
+    if len(data) < 5:
+        return None
+    fc = data[1]
+    if fc in (0x03, 0x04):  # Read response: slave, fc, byte_count, data..., crc, crc
+        byte_count = data[2]
+        total = 3 + byte_count + 2
+        return total if len(data) >= total else None
+    if fc == 0x06 or fc == 0x10:  # Write response: 8 bytes
+        return 8 if len(data) >= 8 else None
+    if fc & 0x80 and (fc & 0x7F) in SUPPORTED_FCS:  # Exception: slave, fc|0x80, code, crc, crc
+        return 5
+    return None
+
+
+# --- STREAMING PARSER ---
+class RtuFrameParser:
+    """Incremental Modbus RTU frame parser for a shared bus.
+
+    Bytes are fed as they are read and consumed exactly once. A frame is emitted
+    as soon as its length (from the function code / byte count) is reached and
+    its CRC checks, so no inter-frame gap is needed to delimit back-to-back frames.
+    Requests and responses from every node come out in bus order as
+    (kind, frame) tuples, kind being REQUEST or RESPONSE.
+
+    Storage is a mirrored ring buffer: every byte is written at pos and
+    pos + capacity, so any window of up to `capacity` bytes is contiguous and
+    length/CRC checks index the buffer in place without compacting it. While a
+    frame is incomplete the parser remembers how many bytes it needs and does
+    not look at the buffer again until they have arrived.
+    """
+    REQUEST = 'request'
+    RESPONSE = 'response'
+
+    _WAIT = 0
+    _SKIP = 1
+
+    def __init__(self, capacity=512):
+        if capacity < MAX_RTU_FRAME:
+            raise ValueError(f'capacity must be at least {MAX_RTU_FRAME} bytes')
+        self._capacity = capacity
+        self._buf = bytearray(capacity * 2)
+        self._start = 0   # ring index of the first unconsumed byte
+        self._count = 0   # bytes buffered and not yet consumed
+        self._need = 4    # bytes to buffer before the next match attempt
+        self._skipping = False
+        self.frames = 0
+        self.resyncs = 0
+        self.dropped_bytes = 0
+        self.crc_errors = 0   # complete frames at a frame boundary whose CRC did not check
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet part of an emitted frame"""
+        return self._count
+
+    def feed(self, data):
+        """Consume newly received bytes; return the list of complete frames"""
+        frames = []
+        data = memoryview(data)
+        while data:
+            n = min(len(data), self._capacity - self._count)
+            self._write(data[:n])
+            data = data[n:]
+            if self._count >= self._need:
+                self._parse(frames, final=False)
+        return frames
+
+    def end_of_frame(self):
+        """Call after a t3.5 silence: emit any valid frames left and discard the rest"""
+        frames = []
+        self._parse(frames, final=True)
+        if self._count:
+            self.dropped_bytes += self._count
+        self.reset()
+        return frames
+
+    def reset(self):
+        """Drop buffered bytes (e.g. after the port was reopened)"""
+        self._start = 0
+        self._count = 0
+        self._need = 4
+        self._skipping = False
+
+    def _write(self, chunk):
+        cap = self._capacity
+        pos = (self._start + self._count) % cap
+        n = len(chunk)
+        first = min(n, cap - pos)
+        buf = self._buf
+        buf[pos:pos + first] = chunk[:first]
+        buf[pos + cap:pos + cap + first] = chunk[:first]
+        if first < n:
+            rest = n - first
+            buf[0:rest] = chunk[first:]
+            buf[cap:cap + rest] = chunk[first:]
+        self._count += n
+
+    def _parse(self, frames, final):
+        buf = self._buf
+        cap = self._capacity
+        match = self._match
+        start = self._start
+        count = self._count
+        need = 4
+        while count >= 4 or (final and count):
+            kind, length = match(buf, start, count)
+            if kind == self._WAIT:
+                if not final:
+                    need = length
+                    break
+                length = 0
+            if kind == self._WAIT or kind == self._SKIP:
+                # Not a frame boundary: drop one byte and try the next offset
+                if not self._skipping:
+                    self._skipping = True
+                    self.resyncs += 1
+                    if length:
+                        self.crc_errors += 1
+                self.dropped_bytes += 1
+                length = 1
+            else:
+                self._skipping = False
+                self.frames += 1
+                frames.append((kind, bytes(buf[start:start + length])))
+            start = (start + length) % cap
+            count -= length
+        self._start = start
+        self._count = count
+        self._need = need
+
+    def _match(self, buf, start, n):
+        """Classify the n bytes buffered at buf[start]: (kind, length), (_WAIT, bytes needed)
+        or (_SKIP, n), n being 1 if a complete frame was there but failed its CRC"""
+        if n < 4:
+            return self._WAIT, 4
+        fc = buf[start + 1]
+        if fc in SUPPORTED_FCS:
+            if fc == FC_WRITE_MULTIPLE:
+                if n < 7:
+                    return self._WAIT, 7   # byte count not received yet
+                request = 9 + buf[start + 6]
+                response = 8
+            elif fc == FC_WRITE_SINGLE:
+                request = response = 8
+            else:
+                request = 8
+                response = 5 + buf[start + 2]
+        elif fc & 0x80 and (fc & 0x7F) in SUPPORTED_FCS:
+            request = 0   # exception replies have no request form
+            response = 5
+        else:
+            return self._SKIP, 0
+        need = 0
+        bad_crc = 0
+        checked = 0   # bytes already run through crc
+        if request:
+            if n < request:
+                need = request
+            elif request > MAX_RTU_FRAME:
+                bad_crc = 1
+            else:
+                crc = crc16(buf[start:start + request])
+                if crc == 0:
+                    return self.REQUEST, request
+                bad_crc = 1
+                checked = request
+        if n < response:
+            need = min(need, response) if need else response
+        elif response != request:   # an equal-length response has just failed the same CRC
+            if checked and response > checked:
+                # Both readings share the first `checked` bytes: continue the running CRC
+                crc = crc16(buf[start + checked:start + response], crc)
+            else:
+                crc = crc16(buf[start:start + response])
+            if crc == 0:
+                return self.RESPONSE, response
+            bad_crc = 1
+        if need and n < MAX_RTU_FRAME:
+            return self._WAIT, min(need, MAX_RTU_FRAME)
+        return self._SKIP, bad_crc
@@ -0,0 +1,26 @@
+"""POST /api/config applies all keys or none"""
+import pytest
+
+import vfdserver
+import webserver
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(vfdserver, 'config', dict(vfdserver.config))
+    return webserver.app.test_client()
+
+
+def test_invalid_key_leaves_config_untouched(client):
+    before = dict(vfdserver.config)
+    response = client.post('/api/config', json={'BAUD_RATE': 9600, 'HEARTBEAT_INTERVAL': 0.25,
+                                                'WEG_WATCHDOG_MARGIN': 1.5})
+    assert response.status_code == 400
+    assert vfdserver.config == before
+
+
+def test_valid_keys_are_applied_together(client):
+    response = client.post('/api/config', json={'BAUD_RATE': 9600, 'WEG_WATCHDOG_MARGIN': 0.5})
+    assert response.get_json()['success']
+    assert vfdserver.config['BAUD_RATE'] == 9600
+    assert vfdserver.config['WEG_WATCHDOG_MARGIN'] == 0.5
@@ -0,0 +1,17 @@
+"""decode_yaskawa_command memoizes one entry per (register, value, read/write)"""
+import pytest
+
+import vfdserver
+
+
+def test_calling_conventions_share_a_cache_entry():
+    vfdserver._decode_yaskawa.cache_clear()
+    first = vfdserver.decode_yaskawa_command(0x0001, 1)
+    assert vfdserver.decode_yaskawa_command(0x0001, 1, is_write=True) is first
+    assert vfdserver.decode_yaskawa_command(0x0001, 1, is_write=1) is first
+    assert vfdserver._decode_yaskawa.cache_info().currsize == 1
+
+
+def test_is_write_is_keyword_only():
+    with pytest.raises(TypeError):
+        vfdserver.decode_yaskawa_command(0x0001, 1, True)
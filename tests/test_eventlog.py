@@ -0,0 +1,26 @@
+"""MessageRing appends from many producers"""
+import sys
+import threading
+
+from eventlog import MessageRing
+
+
+def test_concurrent_appends_publish_the_highest_seq():
+    ring = MessageRing(capacity=100000)
+    producers, per_producer = 8, 5000
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)   # Switch threads as often as possible
+    try:
+        threads = [threading.Thread(target=lambda: [ring.append({'n': i}) for i in range(per_producer)])
+                   for _ in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    total = producers * per_producer
+    assert ring.last_seq == total
+    entries, cursor = ring.since(0)
+    assert cursor == total
+    assert [entry['seq'] for entry in entries] == list(range(1, total + 1))
@@ -0,0 +1,57 @@
+"""The keep-alive metric counts P0680 reads written to the bus, not reads that came due"""
+import pytest
+
+import vfdserver
+
+WEG_ID = 5
+
+
+class RecordingSerial:
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+@pytest.fixture
+def adaptive():
+    saved = {key: vfdserver.config.get(key) for key in ('WEG_WATCHDOG_S', 'WEG_TELEMETRY')}
+    vfdserver.config.update({'WEG_WATCHDOG_S': 2.0, 'WEG_TELEMETRY': False})
+    vfdserver.weg_poller = vfdserver.new_weg_poller()
+    vfdserver.weg_command_queue.clear()
+    vfdserver._weg_inflight[0] = None
+    yield
+    vfdserver.config.update(saved)
+    vfdserver.weg_poller = vfdserver.new_weg_poller()
+    vfdserver.weg_command_queue.clear()
+    vfdserver._weg_inflight[0] = None
+
+
+def keepalive_frames(ser):
+    request = vfdserver.build_modbus_read_frame(WEG_ID, 680, 1)
+    return sum(frame == request for frame in ser.frames)
+
+
+def test_coalesced_keepalive_is_counted_once(adaptive):
+    ser = RecordingSerial()
+    sent = vfdserver._m_keepalives_sent.value
+    vfdserver.queue_weg_read(680, 1, 'HEARTBEAT')
+    vfdserver.queue_weg_read(680, 1, 'HEARTBEAT')
+    vfdserver.process_weg_queue_on_bus(ser, WEG_ID)
+    assert keepalive_frames(ser) == 1
+    assert vfdserver._m_keepalives_sent.value - sent == 1
+
+
+def test_telemetry_reads_are_not_keepalives(adaptive):
+    ser = RecordingSerial()
+    vfdserver.weg_poller.reschedule('status', float('inf'))
+    sent = vfdserver._m_keepalives_sent.value
+    vfdserver.queue_weg_read(2, 9, 'HEARTBEAT')
+    vfdserver.process_weg_queue_on_bus(ser, WEG_ID)
+    assert len(ser.frames) == 1
+    assert vfdserver._m_keepalives_sent.value == sent
@@ -0,0 +1,29 @@
+"""YaskawaResponseCache stays bounded"""
+from vfdserver import YaskawaResponseCache
+
+
+def test_sweeping_windows_is_bounded():
+    cache = YaskawaResponseCache(maxsize=8)
+    for start in range(100):
+        assert cache.get(0x03, start, 1, 0) is None
+        cache.put(0x03, start, 1, 0, b'response', [start])
+    stats = cache.stats()
+    assert stats['entries'] == 8
+    assert stats['evictions'] == 92
+
+
+def test_recently_used_windows_survive():
+    cache = YaskawaResponseCache(maxsize=2)
+    cache.put(0x03, 0, 10, 0, b'status', [])
+    cache.put(0x03, 0x20, 4, 0, b'monitor', [])
+    assert cache.get(0x03, 0, 10, 0) == (b'status', [])
+    cache.put(0x03, 0x40, 2, 0, b'sweep', [])
+    assert cache.get(0x03, 0, 10, 0) == (b'status', [])
+    assert cache.get(0x03, 0x20, 4, 0) is None
+
+
+def test_stale_version_is_a_miss():
+    cache = YaskawaResponseCache()
+    cache.put(0x03, 0, 1, 0, b'old', [1])
+    assert cache.get(0x03, 0, 1, 1) is None
+    assert cache.stats()['invalidations'] == 1
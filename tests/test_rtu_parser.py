@@ -0,0 +1,34 @@
+"""RtuFrameParser: frames come out the same however the bytes are chunked"""
+import rtucodec
+from rtucodec import RtuFrameParser
+
+
+def traffic():
+    return [
+        (RtuFrameParser.REQUEST, rtucodec.encode_read_request(6, 0x0020, 18)),
+        (RtuFrameParser.RESPONSE, rtucodec.encode_read_response(6, 3, bytes(range(36)))),
+        (RtuFrameParser.REQUEST, rtucodec.encode_write_multiple(6, 0x0001, [1, 3000])),
+        (RtuFrameParser.RESPONSE, rtucodec.encode_exception(7, 3, 0x02)),
+    ]
+
+
+def test_byte_at_a_time_matches_one_read():
+    frames = traffic()
+    stream = b''.join(frame for _, frame in frames)
+    whole = RtuFrameParser().feed(stream)
+    parser = RtuFrameParser()
+    single = []
+    for i in range(len(stream)):
+        single += parser.feed(stream[i:i + 1])
+    assert whole == single == frames
+    assert parser.pending == 0
+
+
+def test_read_response_after_failed_request_crc():
+    # The first 8 bytes of an FC03 reply are read as a request first; its CRC fails and the
+    # running CRC continues into the full reply
+    response = rtucodec.encode_read_response(6, 3, bytes(36))
+    parser = RtuFrameParser()
+    assert parser.feed(response[:8]) == []
+    assert parser.feed(response[8:]) == [(RtuFrameParser.RESPONSE, response)]
+    assert parser.crc_errors == 0
@@ -0,0 +1,114 @@
+"""SerialEventWaiter wakes on data and returns on timeout, in every mode (pty-backed port)"""
+import os
+import threading
+import time
+
+import pytest
+
+serial = pytest.importorskip('serial')
+pty = pytest.importorskip('pty')
+tty = pytest.importorskip('tty')
+
+import vfdserver
+from vfdserver import SerialEventWaiter
+
+MODES = ('select', 'blocking', 'poll')
+
+
+@pytest.fixture
+def port():
+    master, slave = os.openpty()
+    tty.setraw(master)
+    ser = serial.Serial(os.ttyname(slave), baudrate=19200, timeout=0)
+    yield master, ser
+    ser.close()
+    os.close(master)
+    os.close(slave)
+
+
+def read_until_data(waiter, timeout):
+    """The poll mode returns after its own short timeout, so keep reading like the gateway loop"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        data = waiter.read(max(0.0, deadline - time.monotonic()))
+        if data:
+            return data
+    return b''
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_wakes_when_data_arrives(port, mode):
+    master, ser = port
+    waiter = SerialEventWaiter(ser, mode)
+    timer = threading.Timer(0.05, os.write, (master, b'\x06\x03\x00\x00\x00\x01'))
+    started = time.monotonic()
+    timer.start()
+    try:
+        data = read_until_data(waiter, 2.0)
+    finally:
+        timer.join()
+        waiter.close()
+    elapsed = time.monotonic() - started
+    assert data.startswith(b'\x06')
+    assert elapsed < 0.5
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_returns_empty_on_timeout(port, mode):
+    _, ser = port
+    waiter = SerialEventWaiter(ser, mode, poll_timeout=0.002)
+    started = time.monotonic()
+    data = waiter.read(0.1)
+    elapsed = time.monotonic() - started
+    waiter.close()
+    assert data == b''
+    assert elapsed < 0.5
+    if mode != 'poll':
+        assert elapsed >= 0.09   # waited for the deadline instead of spinning
+
+
+def test_returns_everything_available(port):
+    master, ser = port
+    waiter = SerialEventWaiter(ser, 'select')
+    os.write(master, bytes(range(32)))
+    time.sleep(0.05)
+    data = read_until_data(waiter, 1.0)
+    waiter.close()
+    assert data == bytes(range(32))
+
+
+def test_auto_picks_select_on_posix(port):
+    _, ser = port
+    waiter = SerialEventWaiter(ser)
+    waiter.close()
+    assert waiter.mode == ('select' if os.name == 'posix' else 'blocking')
+
+
+class CountingPort:
+    """Stands in for a Windows COM port: counts how often the timeout is reconfigured"""
+
+    def __init__(self):
+        self._timeout = None
+        self.reconfigured = 0
+        self.in_waiting = 0
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        self.reconfigured += 1
+
+    def read(self, size=1):
+        return b''
+
+
+def test_blocking_mode_reuses_its_timeouts():
+    port = CountingPort()
+    waiter = SerialEventWaiter(port, 'blocking')
+    for i in range(1000):
+        waiter.read(0.05 - i * 0.00004)   # deadline drifting like the gateway loop's
+    assert port.reconfigured <= 3
+    assert port.timeout in (0,) + vfdserver.BLOCKING_TIMEOUTS_S
@@ -0,0 +1,83 @@
+"""Per-client stream cursors: filtered-out events are consumed, only ring overflow is 'skipped'"""
+import pytest
+
+import vfdserver
+import webserver
+from eventlog import EventFilter
+
+
+@pytest.fixture
+def ring():
+    vfdserver.config['ASYNC_LOGGING'] = False
+    vfdserver.recent_messages.clear()
+    vfdserver.decoded_messages.clear()
+    yield vfdserver.recent_messages
+    vfdserver.config['ASYNC_LOGGING'] = True
+
+
+def new_client(types, since):
+    return {
+        'filter': EventFilter.from_request({'types': types}),
+        'seq': since,
+        'decoded_seq': vfdserver.decoded_messages.last_seq,
+        'status': None,
+    }
+
+
+def test_filtered_events_are_not_reported_as_skipped(ring):
+    client = new_client(['ERROR'], ring.last_seq)
+    for i in range(300):
+        vfdserver.add_message('INFO', f'info {i}')
+        webserver._stream_batch(client, None, {})
+    assert client['seq'] == ring.last_seq
+    vfdserver.add_message('ERROR', 'boom')
+    batch = webserver._stream_batch(client, None, {})
+    assert [m['message'] for m in batch['messages']] == ['boom']
+    assert 'skipped' not in batch
+
+
+def test_filtered_backlog_advances_the_cursor(ring):
+    client = new_client(['ERROR'], ring.last_seq)
+    for i in range(50):
+        vfdserver.add_message('INFO', f'info {i}')
+    assert webserver._stream_batch(client, None, {}) is None
+    assert client['seq'] == ring.last_seq
+
+
+def test_ring_overflow_is_reported_as_skipped(ring):
+    client = new_client(['ERROR'], ring.last_seq)
+    for i in range(ring.capacity + 25):
+        vfdserver.add_message('ERROR', f'error {i}')
+    batch = webserver._stream_batch(client, None, {})
+    assert batch['skipped'] == 25
+
+
+def decoded_client(since, **topics):
+    client = new_client([], since)
+    client['filter'] = EventFilter.from_request(topics)
+    client['decoded_seq'] = vfdserver.decoded_messages.last_seq
+    return client
+
+
+def test_decoded_entries_follow_the_type_topic(ring):
+    client = decoded_client(ring.last_seq, types='ERROR,TRANSLATE')
+    vfdserver.add_decoded_message(vfdserver.decode_yaskawa_command(0x0001, 1, is_write=True))
+    assert webserver._stream_batch(client, None, {}) is None
+    assert client['decoded_seq'] == vfdserver.decoded_messages.last_seq
+
+
+def test_decoded_entries_follow_node_and_mode_topics(ring):
+    node = vfdserver.config.get('YASKAWA_SLAVE_ID', 6)
+    other = decoded_client(ring.last_seq, nodes=[node + 1])
+    same = decoded_client(ring.last_seq, nodes=[node], modes=[vfdserver.get_mode()])
+    vfdserver.add_decoded_message(vfdserver.decode_yaskawa_command(0x0001, 1, is_write=True))
+    assert webserver._stream_batch(other, None, {}) is None
+    assert len(webserver._stream_batch(same, None, {})['decoded']) == 1
+
+
+def test_bits_only_with_include_bits(ring):
+    plain = decoded_client(ring.last_seq, types='DECODED')
+    bits = decoded_client(ring.last_seq, types='DECODED', include_bits=True)
+    vfdserver.add_decoded_message(vfdserver.decode_yaskawa_command(0x0001, 1, is_write=True))
+    assert 'decoded_bits' not in webserver._stream_batch(plain, None, {})['decoded'][0]
+    assert webserver._stream_batch(bits, None, {})['decoded'][0]['decoded_bits']
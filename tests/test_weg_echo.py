@@ -0,0 +1,58 @@
+"""A local echo of an FC06 request must not complete the WEG transaction"""
+import time
+
+import pytest
+
+import rtucodec
+import vfdserver
+
+WEG_ID = 5
+
+
+class EchoingSerial:
+    """Half-duplex RS-485 transceiver that reads back every byte it transmits"""
+
+    def __init__(self):
+        self.rx = bytearray()
+
+    def write(self, data):
+        self.rx += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_all(self):
+        data, self.rx = bytes(self.rx), bytearray()
+        return data
+
+
+@pytest.fixture
+def transaction():
+    vfdserver._weg_inflight[0] = None
+    ser = EchoingSerial()
+    cmd = {'register': 683, 'value': 1234, 'name': 'Speed Reference', 'traces': []}
+    frame = vfdserver.build_modbus_write_frame(WEG_ID, 683, 1234)
+    vfdserver._send_weg_transaction(ser, 'write', frame, [cmd])
+    yield ser, frame
+    vfdserver._weg_inflight[0] = None
+
+
+def test_echo_does_not_ack_the_write(transaction):
+    ser, frame = transaction
+    frames = rtucodec.RtuFrameParser().feed(ser.read_all())
+    assert [bytes(f) for _, f in frames] == [frame]
+    for kind, echoed in frames:
+        assert not vfdserver.on_weg_frame(kind, echoed, WEG_ID, time.time())
+    assert vfdserver._weg_inflight[0] is not None
+
+
+def test_reply_after_the_echo_window_acks_the_write(transaction):
+    ser, frame = transaction
+    ser.read_all()
+    reply_at = vfdserver._weg_inflight[0]['echo_until'] + 0.002
+    parser = rtucodec.RtuFrameParser()
+    frames = parser.feed(frame) + parser.end_of_frame()
+    kind, reply = frames[0]
+    assert vfdserver.on_weg_frame(kind, reply, WEG_ID, reply_at)
+    assert vfdserver._weg_inflight[0] is None
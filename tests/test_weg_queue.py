@@ -0,0 +1,114 @@
+"""WegCommandQueue coalescing must never lose a STOP or fault reset"""
+import pytest
+
+import vfdserver
+from vfdserver import WEG_PRIORITY_CONTROL, WEG_PRIORITY_SAFETY, WegCommandQueue
+
+WEG_ID = 5
+
+
+@pytest.fixture
+def weg_queue():
+    vfdserver.weg_command_queue.clear()
+    yield vfdserver.weg_command_queue
+    vfdserver.weg_command_queue.clear()
+
+
+def drain(queue):
+    sent = []
+    while True:
+        block = queue.pop_block(2)
+        if not block:
+            return sent
+        sent.extend((cmd['register'], cmd['value']) for cmd in block)
+
+
+def test_fault_reset_then_run_sends_both(weg_queue):
+    vfdserver.translate_to_weg(0x0001, 0x0008, WEG_ID)   # fault reset
+    vfdserver.translate_to_weg(0x0001, 0x0001, WEG_ID)   # run
+    assert drain(weg_queue) == [(682, 0x94), (682, 0x17)]
+
+
+def test_stop_then_run_sends_both(weg_queue):
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    vfdserver.translate_to_weg(0x0001, 0x0001, WEG_ID)
+    assert drain(weg_queue) == [(682, 0x14), (682, 0x17)]
+
+
+def test_fault_reset_then_stop_sends_both(weg_queue):
+    vfdserver.translate_to_weg(0x0001, 0x0008, WEG_ID)
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    assert drain(weg_queue) == [(682, 0x94), (682, 0x14)]
+
+
+def test_run_then_stop_coalesces_to_stop(weg_queue):
+    vfdserver.translate_to_weg(0x0001, 0x0001, WEG_ID)
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    assert drain(weg_queue) == [(682, 0x14)]
+
+
+def test_repeated_stop_coalesces(weg_queue):
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    assert drain(weg_queue) == [(682, 0x14)]
+
+
+def test_pinned_stop_trace_is_not_coalesced(weg_queue):
+    tracer = vfdserver.setpoint_tracer
+    tracer.clear()
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    vfdserver.translate_to_weg(0x0001, 0x0001, WEG_ID)
+    assert '0x0001' not in tracer.stats()   # neither trace has finished: both words are pending
+    tracer.clear()
+
+
+def test_setpoints_still_coalesce():
+    queue = WegCommandQueue()
+    queue.put(683, 1000, 'Speed', vfdserver.WEG_PRIORITY_SPEED, 1.0)
+    assert queue.put(683, 2000, 'Speed', vfdserver.WEG_PRIORITY_SPEED, 1.0)
+    assert drain(queue) == [(683, 2000)]
+
+
+def test_failed_stop_is_retried_before_newer_run():
+    queue = WegCommandQueue()
+    queue.put(682, 0x14, 'Control', WEG_PRIORITY_SAFETY, 1.0)
+    block = queue.pop_block(2)
+    queue.put(682, 0x17, 'Control', WEG_PRIORITY_CONTROL, 1.0)
+    queue.push_front(block)
+    assert drain(queue) == [(682, 0x14), (682, 0x17)]
+
+
+class FailingSerial:
+    def write(self, data):
+        raise OSError('port gone')
+
+    def flush(self):
+        pass
+
+
+@pytest.fixture
+def idle_poller():
+    for entry in vfdserver.weg_poller.entries:
+        entry.next_due = None
+    vfdserver._weg_inflight[0] = None
+    yield
+    vfdserver.weg_poller = vfdserver.new_weg_poller()
+    vfdserver._weg_inflight[0] = None
+
+
+def test_out_of_range_speed_is_clamped(weg_queue):
+    vfdserver.translate_to_weg(0x0009, 20000, WEG_ID)   # 20000 RPM
+    assert drain(weg_queue) == [(683, vfdserver.WEG_SPEED_REF_MAX)]
+
+
+def test_fc16_values_are_masked():
+    frame = vfdserver.rtucodec.encode_write_multiple(WEG_ID, 682, [0x14, 0x12345])
+    assert frame[7:11] == bytes([0x00, 0x14, 0x23, 0x45])
+
+
+def test_failed_send_keeps_the_stop(weg_queue, idle_poller):
+    vfdserver.translate_to_weg(0x0001, 0x0000, WEG_ID)
+    vfdserver.translate_to_weg(0x0002, 3000, WEG_ID)
+    vfdserver.process_weg_queue_on_bus(FailingSerial(), WEG_ID)
+    assert vfdserver._weg_inflight[0] is None
+    assert [register for register, _ in drain(weg_queue)] == [682, 683]
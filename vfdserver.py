@@ -1,12 +1,24 @@
+import functools
+import itertools
 import logging
+import os
+import queue
+import selectors
 import threading
 import time
 import serial
+from collections import OrderedDict, deque
 from datetime import datetime
+from types import MappingProxyType
 from pymodbus.server import StartSerialServer
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
 from pymodbus.client import ModbusSerialClient as ModbusClient
+import rtucodec
+from eventlog import LogEvent, LogSampler, MessageRing
+from metrics import Histogram, MetricsRegistry
+from pollscheduler import PollEntry, PollScheduler
+from registerimage import RegisterImage
 
 # --- CONFIGURACIÓN ---
 config = {
@@ -22,9 +34,78 @@ config = {
     'RESPOND_TO_ANY_ID': False,  # Respond to any slave ID (for debugging)
     'SINGLE_BUS_MODE': True,     # Set True if WEG and controller on same RS-485 bus
     'HEARTBEAT_INTERVAL': 0.5,   # Seconds between WEG heartbeat polls (must be < P0314!)
+    'WEG_WATCHDOG_S': None,      # P0314 serial watchdog time set on the drive (None = fixed HEARTBEAT_INTERVAL heartbeat)
+    'WEG_WATCHDOG_MARGIN': 0.5,  # Keep-alive sent once this fraction of P0314 passed without a WEG exchange
     'WEG_MAX_FREQ_HZ': 60.0,     # WEG motor max frequency (8192 = this value)
+    'WEG_TELEMETRY': True,       # Poll WEG telemetry (WEG_POLL_TABLE) into the A1000 registers (False = P0680 heartbeat only)
+    'WEG_POLL_PERIODS_S': {'drive': 0.1, 'temperature': 5.0, 'fault': 1.0},  # Poll table period overrides (status = keep-alive, see WEG_WATCHDOG_S)
+    'WEG_POLL_BUDGET': 0.3,      # Share of the bus time left free by the HMI that telemetry polls may use
+    # Bus timing overrides in seconds (None = derive from baud/parity/stop bits, see compute_bus_timing)
+    'FRAME_GAP_S': None,         # Silence that ends a frame (default t3.5)
+    'RESPONSE_DELAY_S': None,    # Minimum turnaround before answering the HMI (default t3.5)
+    'BUS_IDLE_S': None,          # Silence required before the gateway talks to the WEG (default t3.5)
+    'STALE_FRAME_S': None,       # Max age of an incomplete frame (default: time of a 256-byte frame + t3.5)
+    'SERIAL_LATENCY_S': 0.0,     # Extra allowance for USB-serial adapter latency, added to gap/idle
+    'WEG_QUEUE_MAX': 16,         # Max distinct WEG registers pending at once (oldest dropped beyond this)
+    'WEG_COMBINE_WRITES': True,  # Send pending P0682 + P0683 as one FC16 write (falls back to FC06 on exception)
+    # Per-class deadlines (s from queueing to transmission); late commands are counted as missed
+    'WEG_DEADLINES_S': {'safety_stop': 0.05, 'control': 0.1, 'speed': 0.25, 'diagnostic': 1.0},
+    'WEG_TURNAROUND_TIMEOUT_S': 0.1,  # Max wait for a WEG reply before the transaction counts as failed
+    'HMI_RESPONSE_WINDOW_S': 0.05,  # HMI frames answered later than this count as missed (bus stats)
+    'SERIAL_IO_MODE': 'auto',    # Single-bus receive: 'select' (POSIX fd wait), 'blocking' (timed read), 'poll' (1 ms loop), 'auto'
+    'ASYNC_LOGGING': True,       # Format/decode log messages on a worker thread, off the serial response path
+    # Log sampling: max messages/s per type (missing/0 = unlimited); identical messages within the
+    # repeat window collapse into one "[repeated Nx]" line. LOG_ALWAYS_TYPES are never sampled:
+    # HMI writes, their translations, errors and warnings (heartbeat failures are warnings).
+    'LOG_RATE_LIMITS': {'RAW': 5, 'RECV': 5, 'TX': 5, 'DEBUG': 10,
+                        'YASKAWA': 10, 'QUEUE': 10, 'SUCCESS': 10, 'INFO': 10},
+    'LOG_REPEAT_WINDOW_S': 5.0,
+    'LOG_ALWAYS_TYPES': ['ERROR', 'WARNING', 'WRITE', 'TRANSLATE'],
+    # Web live stream (Socket.IO 'stream' batches, see webserver.py)
+    'STREAM_FLUSH_S': 0.05,      # Collect events this long after the first one before sending a batch
+    'STREAM_BATCH_MAX': 200,     # Max messages per batch (a client further behind gets several)
+    'STREAM_MAX_INFLIGHT': 2,    # Unacknowledged batches per client before it is skipped (backpressure)
+    'STREAM_STALL_S': 30.0,      # A client that acknowledges nothing for this long is disconnected
+    'STREAM_STATUS_S': 1.0,      # Min interval between status updates on the stream
 }
 
+# --- MODBUS RTU BUS TIMING ---
+# Modbus over Serial Line spec 2.5.1.1: frames are separated by >= 3.5 character times of
+# silence (t3.5) and a gap > 1.5 characters inside a frame (t1.5) is an error. Above 19200 baud
+# the spec fixes t1.5 = 750 us and t3.5 = 1750 us.
+_TIMING_OVERRIDES = {
+    'frame_gap': 'FRAME_GAP_S',
+    'response_delay': 'RESPONSE_DELAY_S',
+    'bus_idle': 'BUS_IDLE_S',
+    'stale_frame': 'STALE_FRAME_S',
+}
+
+def compute_bus_timing(cfg=None):
+    """Return the single-bus timings (seconds) for the configured serial format"""
+    cfg = cfg if cfg is not None else config
+    baud = int(cfg['BAUD_RATE'])
+    bits_per_char = 1 + int(cfg['BYTESIZE']) + (0 if cfg['PARITY'] == 'N' else 1) + int(cfg['STOPBITS'])
+    char_time = bits_per_char / baud
+    if baud > 19200:
+        t1_5, t3_5 = 0.00075, 0.00175
+    else:
+        t1_5, t3_5 = 1.5 * char_time, 3.5 * char_time
+    latency = float(cfg.get('SERIAL_LATENCY_S') or 0.0)
+    timing = {
+        'bits_per_char': bits_per_char,
+        'char_time': char_time,
+        't1_5': t1_5,
+        't3_5': t3_5,
+        'frame_gap': t3_5 + latency,
+        'response_delay': t3_5,
+        'bus_idle': t3_5 + latency,
+        'stale_frame': rtucodec.MAX_RTU_FRAME * char_time + t3_5 + latency,
+    }
+    for key, cfg_key in _TIMING_OVERRIDES.items():
+        if cfg.get(cfg_key) is not None:
+            timing[key] = float(cfg[cfg_key])
+    return timing
+
 # --- APPLICATION MODE ---
 # 'redirect' = Forward Yaskawa commands to WEG (production)
 # 'listen'   = Listen and decode Yaskawa commands without forwarding (debug)
@@ -39,7 +120,8 @@ current_mode = 'redirect'
 # - Same wire format as Modbus RTU (FC 03/04/06/10, CRC-16). Many HMIs treat MEMOBUS = Modbus for A1000.
 # - Optional: drive type/model/option register (see A1000 manual C.9 Data Table). If your controller
 #   reads a specific register to identify A1000, add it below and set a valid value so the HMI accepts the drive.
-# - Timing: inter-frame delay and response time; we use short fixed delays. Can be made configurable if needed.
+# - Timing: inter-frame gap and response turnaround follow the RTU t3.5 rule for the configured
+#   baud rate (compute_bus_timing); each value can be overridden in config.
 # - Broadcast (slave 0): we only respond to Yaskawa Emulator ID (e.g. 6), not broadcast.
 # Identification registers (0x00F0-0x00F2) are set so controllers that read "drive type" get A1000.
 # --- YASKAWA COMMAND DECODER ---
@@ -154,62 +236,103 @@ YASKAWA_STATUS_BITS = {
 YASKAWA_STATUS_READY = 0x0021   # Bit 0 = Drive Ready, Bit 5 = At Frequency (bit 3 = FAULT must be 0)
 YASKAWA_STATUS_FAULT_BIT = 0x0008  # Bit 3 = FAULT ACTIVE - never set this in emulator
 
-def decode_yaskawa_command(register, value, is_write=True):
-    """Decode Yaskawa register and provide human-readable description"""
-    result = {
+# --- EMULATED A1000 REGISTER IMAGE (shared by every gateway mode) ---
+# Register space extended to 0x1000 so reads to high addresses (e.g. 0x07D8) don't index out.
+YASKAWA_REGISTER_SIZE = 0x1000
+A1000_ID_REGISTERS = (0x00F0, 0x00F2)  # read-only: drive type, software version, option
+
+def new_yaskawa_image(initial=None):
+    """Register image with the A1000 identification registers protected.
+    initial: {address: value} or a list of values from address 0"""
+    image = RegisterImage(YASKAWA_REGISTER_SIZE, protected=(A1000_ID_REGISTERS,))
+    if isinstance(initial, dict):
+        for address, value in initial.items():
+            image.load(address, [value])
+    elif initial:
+        image.load(0, list(initial))
+    return image
+
+def yaskawa_status_from_command(command):
+    """Status word echoed for a command word: Ready + At Frequency, Running/Reverse from
+    bits 0/1. Never has the fault bit - HMI shows "faulted" if bit 3 is set."""
+    status = 0x0001  # Drive Ready
+    if command & 0x01:
+        status |= 0x0002  # Running
+    if command & 0x02:
+        status |= 0x0004  # Reverse
+    status |= 0x0020  # At frequency
+    return status & ~YASKAWA_STATUS_FAULT_BIT
+
+def store_yaskawa_write(image, address, values):
+    """Store an HMI write in the register image, with the emulator's rules: the fault bit
+    is never stored in status register 0, identification registers stay read-only and a
+    command word (0x0001) is echoed to the status words 0x0000 and 0x0020 (Sullair reads
+    0x0020). Returns the values as stored."""
+    values = list(values)
+    if address == 0 and values:
+        values[0] &= ~YASKAWA_STATUS_FAULT_BIT
+    image.set(address, values)
+    if address <= 0x0001 < address + len(values):
+        status = yaskawa_status_from_command(values[0x0001 - address])
+        image[0x0000] = status
+        image[0x0020] = status
+    return values
+
+# --- DECODING ---
+# One decoder per register, compiled once from YASKAWA_REGISTERS and the bit tables.
+# decode_yaskawa_command() results are read-only mappings, memoized per (register, value,
+# is_write) in an LRU of DECODE_CACHE_SIZE, so the same HMI poll values are decoded once.
+# The per-bit breakdown is not part of the result; yaskawa_decoded_bits() builds it on demand.
+DECODE_CACHE_SIZE = 4096
+
+def _interpret_command(value):
+    text = 'RUN COMMAND ACTIVE' if value & 0x01 else 'STOP COMMAND'
+    return text + (' (REVERSE)' if value & 0x02 else ' (FORWARD)')
+
+_YASKAWA_INTERPRETERS = {
+    0x0001: _interpret_command,                                                   # Command Word
+    0x0002: lambda value: f'{value / 100.0:.2f} Hz ({value/60:.0f} RPM at 2-pole)',  # Frequency Reference
+    0x0003: lambda value: f'{value / 100.0:.2f} Hz',                              # Output Frequency
+    0x0004: lambda value: f'{value / 100.0:.2f} A',                               # Output Current
+    0x0005: lambda value: f'{value} V',                                           # Output Voltage
+    0x0009: lambda value: f'{value} RPM',                                         # Motor Speed
+    0x0010: lambda value: f'{value / 10.0:.1f} seconds',                          # Accel time
+    0x0011: lambda value: f'{value / 10.0:.1f} seconds',                          # Decel time
+}
+_YASKAWA_BIT_TABLES = {
+    0x0000: YASKAWA_STATUS_BITS,
+    0x0001: YASKAWA_COMMAND_BITS,
+}
+
+def _compile_yaskawa_decoder(register):
+    """(fixed fields, interpreter) of one register"""
+    reg_info = YASKAWA_REGISTERS.get(register, {'name': 'UNKNOWN', 'description': f'Unknown Register {register}'})
+    fields = {
         'register': register,
         'register_hex': f'0x{register:04X}',
-        'value': value,
-        'value_hex': f'0x{value:04X}',
-        'value_binary': f'{value:016b}',
-        'operation': 'WRITE' if is_write else 'READ',
-        'description': '',
-        'decoded_bits': [],
-        'calculated_value': None
+        'register_name': reg_info['name'],
+        'description': reg_info['description'],
     }
-    
-    # Get register info
-    reg_info = YASKAWA_REGISTERS.get(register, {'name': 'UNKNOWN', 'description': f'Unknown Register {register}'})
-    result['register_name'] = reg_info['name']
-    result['description'] = reg_info['description']
-    
-    # Decode specific registers
-    if register == 0x0001:  # Command Word
-        result['decoded_bits'] = decode_bits(value, YASKAWA_COMMAND_BITS)
-        if value & 0x01:
-            result['calculated_value'] = 'RUN COMMAND ACTIVE'
-        else:
-            result['calculated_value'] = 'STOP COMMAND'
-        if value & 0x02:
-            result['calculated_value'] += ' (REVERSE)'
-        else:
-            result['calculated_value'] += ' (FORWARD)'
-            
-    elif register == 0x0000:  # Status Word
-        result['decoded_bits'] = decode_bits(value, YASKAWA_STATUS_BITS)
-        
-    elif register == 0x0002:  # Frequency Reference
-        freq_hz = value / 100.0
-        result['calculated_value'] = f'{freq_hz:.2f} Hz ({value/60:.0f} RPM at 2-pole)'
-        
-    elif register == 0x0003:  # Output Frequency
-        freq_hz = value / 100.0
-        result['calculated_value'] = f'{freq_hz:.2f} Hz'
-        
-    elif register == 0x0004:  # Output Current
-        current_a = value / 100.0
-        result['calculated_value'] = f'{current_a:.2f} A'
-        
-    elif register == 0x0005:  # Output Voltage
-        result['calculated_value'] = f'{value} V'
-        
-    elif register == 0x0009:  # Motor Speed
-        result['calculated_value'] = f'{value} RPM'
-        
-    elif register in [0x0010, 0x0011]:  # Accel/Decel time
-        result['calculated_value'] = f'{value / 10.0:.1f} seconds'
-    
-    return result
+    return fields, _YASKAWA_INTERPRETERS.get(register)
+
+_YASKAWA_DECODERS = {register: _compile_yaskawa_decoder(register) for register in YASKAWA_REGISTERS}
+
+def decode_yaskawa_command(register, value, *, is_write=True):
+    """Decode Yaskawa register and provide human-readable description (read-only, memoized)"""
+    # One positional key per (register, value, read/write): lru_cache keys f(a, b) and
+    # f(a, b, is_write=True) differently, so callers never reach the cache directly
+    return _decode_yaskawa(register, value, bool(is_write))
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def _decode_yaskawa(register, value, is_write):
+    fields, interpret = _YASKAWA_DECODERS.get(register) or _compile_yaskawa_decoder(register)
+    result = dict(fields)
+    result['value'] = value
+    result['value_hex'] = f'0x{value:04X}'
+    result['value_binary'] = f'{value:016b}'
+    result['operation'] = 'WRITE' if is_write else 'READ'
+    result['calculated_value'] = interpret(value) if interpret else None
+    return MappingProxyType(result)
 
 def decode_bits(value, bit_definitions):
     """Decode individual bits based on definitions"""
@@ -221,6 +344,15 @@ def decode_bits(value, bit_definitions):
             active_bits.append({'bit': bit_num, 'description': description, 'state': 'OFF'})
     return active_bits
 
+def yaskawa_decoded_bits(register, value):
+    """Bit breakdown of a command/status word ([] for other registers)"""
+    bit_definitions = _YASKAWA_BIT_TABLES.get(register)
+    return decode_bits(value, bit_definitions) if bit_definitions else []
+
+def with_decoded_bits(entry):
+    """Copy of a decoded entry with its 'decoded_bits' breakdown added"""
+    return dict(entry, decoded_bits=yaskawa_decoded_bits(entry['register'], entry['value']))
+
 def format_decoded_command(decoded):
     """Format decoded command for display"""
     lines = []
@@ -232,10 +364,11 @@ def format_decoded_command(decoded):
         lines.append(f"  Interpreted: {decoded['calculated_value']}")
     
     # Show active bits for command/status words
-    if decoded['decoded_bits']:
-        active = [b for b in decoded['decoded_bits'] if b['state'] == 'ON']
-        if active:
-            bit_strs = [f"Bit{b['bit']}:{b['description']}" for b in active]
+    bit_definitions = _YASKAWA_BIT_TABLES.get(decoded['register'])
+    if bit_definitions:
+        bit_strs = [f"Bit{bit}:{description}" for bit, description in bit_definitions.items()
+                    if decoded['value'] & (1 << bit)]
+        if bit_strs:
             lines.append(f"  Active Bits: {', '.join(bit_strs)}")
     
     return '\n'.join(lines)
@@ -244,21 +377,97 @@ def format_decoded_command(decoded):
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Store recent messages for web interface
-recent_messages = []
+# Store recent messages for web interface (ring of the last MAX_MESSAGES, read by sequence cursor)
 MAX_MESSAGES = 100
+recent_messages = MessageRing(MAX_MESSAGES)
+messages_changed = threading.Event()  # Set on every new message / decoded entry (wakes the web stream)
+
+# Rate limits / repeat aggregation in front of the buffer and the logger (see LogSampler)
+log_sampler = LogSampler(config['LOG_RATE_LIMITS'], config['LOG_REPEAT_WINDOW_S'], config['LOG_ALWAYS_TYPES'])
+
+def configure_log_sampling():
+    """Apply the LOG_* config keys to the running sampler"""
+    log_sampler.configure(config.get('LOG_RATE_LIMITS', {}), config.get('LOG_REPEAT_WINDOW_S', 0.0),
+                          config.get('LOG_ALWAYS_TYPES', ()))
+
+def _store_event(event):
+    """Add event to the buffer and the log (text is only rendered if the logger emits it)"""
+    for stored in log_sampler.filter(event):
+        _append_event(stored)
+
+def _append_event(event):
+    recent_messages.append(event)
+    messages_changed.set()
+    if logger.isEnabledFor(logging.INFO):
+        for msg_type, message in event.lines():
+            logger.info(f"[{msg_type}] {message}")
+
+# --- LOG WORKER ---
+# With ASYNC_LOGGING the serial thread only puts raw LogEvents (and decode tasks) on _log_queue;
+# the event keeps its creation time, but storing, decoding, formatting and the logger all run on
+# the worker thread, after the HMI has been answered. Event text is rendered only when a
+# consumer asks for it (logger, web interface).
+_log_queue = queue.SimpleQueue()
+_log_worker = [None]
+_log_worker_lock = threading.Lock()
+
+def _ensure_log_worker():
+    if _log_worker[0] is None:
+        with _log_worker_lock:
+            if _log_worker[0] is None:
+                _log_worker[0] = threading.Thread(target=_log_worker_loop, name='log-worker', daemon=True)
+                _log_worker[0].start()
+
+def _log_worker_loop():
+    while True:
+        try:
+            item = _log_queue.get(timeout=1.0)
+        except queue.Empty:
+            # Quiet period: close expired repeat windows so their summaries still appear
+            for summary in log_sampler.expire(time.monotonic()):
+                _append_event(summary)
+            continue
+        try:
+            if isinstance(item, LogEvent):
+                _store_event(item)
+            elif isinstance(item, threading.Event):
+                item.set()  # flush_messages() marker
+            else:
+                func, args = item
+                func(*args)
+        except Exception:
+            logger.exception(f"Log worker item {item!r} failed")
+
+def log_event(msg_type, text='', node=None, register=None, value=None, raw=None, render=None, args=()):
+    """Record a raw event. Text is built later: text + hex of raw, or the (type, message) pairs
+    returned by render(*args). Costs one small object on the calling (serial) thread."""
+    event = LogEvent(msg_type, text, node, register, value, raw, render, args, mode=current_mode)
+    if config.get('ASYNC_LOGGING', True):
+        _ensure_log_worker()
+        _log_queue.put(event)
+    else:
+        _store_event(event)
+    return event
 
 def add_message(msg_type, message):
     """Add message to the buffer with timestamp"""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    recent_messages.append({
-        'timestamp': timestamp,
-        'type': msg_type,
-        'message': message
-    })
-    if len(recent_messages) > MAX_MESSAGES:
-        recent_messages.pop(0)
-    logger.info(f"[{msg_type}] {message}")
+    log_event(msg_type, message)
+
+def defer_call(func, *args):
+    """Run func(*args) on the log worker (e.g. decoding for decoded_messages)"""
+    if config.get('ASYNC_LOGGING', True):
+        _ensure_log_worker()
+        _log_queue.put((func, args))
+    else:
+        func(*args)
+
+def flush_messages(timeout=1.0):
+    """Wait until every message queued so far is in recent_messages and the log"""
+    if _log_worker[0] is None:
+        return True
+    done = threading.Event()
+    _log_queue.put(done)
+    return done.wait(timeout)
 
 # Cliente para hablar con el WEG
 weg_client = None
@@ -311,12 +520,40 @@ class YaskawaCallback(ModbusSequentialDataBlock):
     Esta clase intercepta las escrituras que el PLC hace al 'Yaskawa'
     y las traduce inmediatamente al formato del WEG CFW11.
     Supports multiple modes: redirect, listen, command
+    Register values live in a RegisterImage (self.values), shared logic with single bus mode.
     """
+    def __init__(self, address, image):
+        super().__init__(address, [0])
+        self.values = image
+    
+    def getValues(self, address, count=1):
+        """Intercept read requests for logging"""
+        global current_mode
+        
+        values = self.values.get(address - self.address, count)
+        yaskawa_id = config.get('YASKAWA_SLAVE_ID', 6)
+        
+        if current_mode == 'listen':
+            for i, val in enumerate(values):
+                decoded = decode_yaskawa_command(address + i, val, is_write=False)
+                add_message('RECV', f"[Node {yaskawa_id}] READ Reg 0x{address+i:04X} -> {val} (0x{val:04X})")
+                add_message('DECODE', f"  -> {decoded.get('register_name', 'UNKNOWN')}: {decoded.get('calculated_value', decoded.get('description', 'N/A'))}")
+                add_decoded_message(decoded)
+        elif current_mode == 'redirect':
+            # Log reads in redirect mode too
+            for i, val in enumerate(values):
+                decoded = decode_yaskawa_command(address + i, val, is_write=False)
+                add_message('RECV', f"[Node {yaskawa_id}] READ Reg 0x{address+i:04X} -> {val} (0x{val:04X})")
+        
+        return values
+
     def setValues(self, address, values):
         global current_mode
         
+        if not isinstance(values, list):
+            values = [values]
         # Primero guardamos el valor en la memoria local (para que el PLC lo lea si quiere)
-        super().setValues(address, values)
+        values = store_yaskawa_write(self.values, address - self.address, values)
         
         reg_address = address 
         val = values[0] if values else 0
@@ -329,20 +566,10 @@ class YaskawaCallback(ModbusSequentialDataBlock):
             # Store decoded data for web interface
             add_decoded_message(decoded)
             
-            # Update status register to simulate drive response
+            # Status register was updated by store_yaskawa_write to simulate drive response
             # This makes the controller think commands are being executed
             if reg_address == 0x0001:  # Command word
-                # Echo command to status - never set fault bit or HMI shows "faulted"
-                status = 0x0001  # Drive Ready
-                if val & 0x01:
-                    status |= 0x0002  # Running
-                if val & 0x02:
-                    status |= 0x0004  # Reverse
-                status |= 0x0020  # At frequency
-                super().setValues(0x0000, [status & ~YASKAWA_STATUS_FAULT_BIT])
-                # Sullair WS Controller reads register 0x0020 for status (not 0x0000)
-                super().setValues(0x0020, [status & ~YASKAWA_STATUS_FAULT_BIT])
-                add_message('DEBUG', f'Simulated status response: 0x{status & ~YASKAWA_STATUS_FAULT_BIT:04X}')
+                add_message('DEBUG', f'Simulated status response: 0x{self.values[0x0020]:04X}')
             
             return
         
@@ -380,27 +607,6 @@ class YaskawaCallback(ModbusSequentialDataBlock):
         else:
             add_message('DEBUG', f"No translation rule for register 0x{reg_address:04X}")
 
-    def getValues(self, address, count=1):
-        """Intercept read requests for logging"""
-        global current_mode
-        
-        values = super().getValues(address, count)
-        yaskawa_id = config.get('YASKAWA_SLAVE_ID', 6)
-        
-        if current_mode == 'listen':
-            for i, val in enumerate(values):
-                decoded = decode_yaskawa_command(address + i, val, is_write=False)
-                add_message('RECV', f"[Node {yaskawa_id}] READ Reg 0x{address+i:04X} -> {val} (0x{val:04X})")
-                add_message('DECODE', f"  -> {decoded.get('register_name', 'UNKNOWN')}: {decoded.get('calculated_value', decoded.get('description', 'N/A'))}")
-                add_decoded_message(decoded)
-        elif current_mode == 'redirect':
-            # Log reads in redirect mode too
-            for i, val in enumerate(values):
-                decoded = decode_yaskawa_command(address + i, val, is_write=False)
-                add_message('RECV', f"[Node {yaskawa_id}] READ Reg 0x{address+i:04X} -> {val} (0x{val:04X})")
-        
-        return values
-
     def _write_to_weg(self, register, value, command_name):
         """Thread-safe write to WEG with error handling"""
         weg_id = config.get('SLAVE_ID', 5)
@@ -437,16 +643,17 @@ class YaskawaCallback(ModbusSequentialDataBlock):
                         pass
 
 # Store decoded messages for web interface
-decoded_messages = []
 MAX_DECODED = 50
+decoded_messages = MessageRing(MAX_DECODED)
 
 def add_decoded_message(decoded):
-    """Add decoded message to buffer for web interface"""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    decoded['timestamp'] = timestamp
-    decoded_messages.append(decoded)
-    if len(decoded_messages) > MAX_DECODED:
-        decoded_messages.pop(0)
+    """Add decoded message to buffer for web interface (bits are added on read, see with_decoded_bits)"""
+    entry = dict(decoded)
+    entry['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    entry['node'] = config.get('YASKAWA_SLAVE_ID', 6)   # Topics for stream subscriptions
+    entry['mode'] = current_mode
+    decoded_messages.append(entry)
+    messages_changed.set()
 
 def set_mode(mode):
     """Set the application mode"""
@@ -461,113 +668,485 @@ def get_mode():
     """Get current mode"""
     return current_mode
 
-# --- SINGLE BUS MODE: Command Queue ---
-weg_command_queue = []
-weg_queue_lock = threading.Lock()
+# --- METRICS ---
+# Stage latencies of the single-bus loop and fault counters, served by /api/metrics (JSON and
+# Prometheus text). HMI stages answer "was the gateway slow?", WEG ones "was the drive?".
+metrics = MetricsRegistry('vfdgateway')
+_m_frame_assembly = metrics.histogram('hmi_frame_assembly_seconds', 'First byte of an HMI request to frame complete')
+_m_frame_to_response = metrics.histogram('hmi_frame_to_response_seconds', 'HMI request frame complete to response written')
+_m_hmi_turnaround = metrics.histogram('hmi_request_to_response_seconds', 'First byte of an HMI request to response written')
+_m_weg_queue_wait = metrics.histogram('weg_queue_wait_seconds', 'WEG command queued to sent')
+_m_weg_rtt = metrics.histogram('weg_round_trip_seconds', 'WEG request sent to reply received')
+_m_crc_errors = metrics.counter('crc_errors', 'Complete frames on the bus with a bad CRC')
+_m_resyncs = metrics.counter('resyncs', 'Times the frame parser lost frame alignment')
+_m_dropped_bytes = metrics.counter('dropped_bytes', 'Bytes discarded while resynchronizing')
+_m_hmi_unanswered = metrics.counter('hmi_unanswered', 'HMI requests to the emulator that got no response')
+_m_hmi_late = metrics.counter('hmi_late', 'HMI responses written after HMI_RESPONSE_WINDOW_S')
+_m_coalesced = metrics.counter('weg_commands_coalesced', 'Queued WEG commands replaced by a newer value')
+_m_weg_timeouts = metrics.counter('weg_timeouts', 'WEG transactions without a reply')
+_m_weg_exceptions = metrics.counter('weg_exceptions', 'WEG replies that were Modbus exceptions')
+_m_weg_echoes = metrics.counter('weg_echoes_ignored', 'Copies of our own WEG request read back before a reply was possible')
+_m_keepalives_sent = metrics.counter('weg_keepalives_sent', 'Watchdog keep-alive (P0680) reads sent')
+_m_keepalives_skipped = metrics.counter('weg_keepalives_skipped', 'Fixed-interval heartbeats not needed because other WEG traffic reset P0314')
+_m_keepalive_saved = metrics.counter('weg_keepalive_bus_seconds_saved', 'Bus time of the skipped heartbeats')
 
-def queue_weg_command(register, value, command_name):
-    """Queue a command to be sent to WEG on single bus"""
-    weg_id = config.get('SLAVE_ID', 5)
-    with weg_queue_lock:
-        weg_command_queue.append({
+def _count_parser(parser, seen):
+    """Add the parser's new CRC errors / resyncs / dropped bytes to the metrics.
+    seen holds the values already counted and is updated in place."""
+    crc_errors, resyncs, dropped = parser.crc_errors, parser.resyncs, parser.dropped_bytes
+    if crc_errors != seen[0] or resyncs != seen[1] or dropped != seen[2]:
+        _m_crc_errors.inc(crc_errors - seen[0])
+        _m_resyncs.inc(resyncs - seen[1])
+        _m_dropped_bytes.inc(dropped - seen[2])
+        seen[:] = [crc_errors, resyncs, dropped]
+
+# --- SETPOINT TRACING ---
+class SetpointTracer:
+    """Follows each translated HMI write (command word, speed reference) to the drive.
+
+    A trace is opened when the translation is queued for the WEG and travels with the queued
+    command. Timestamps are recorded at each hop ('hmi_write': first byte of the HMI request,
+    'queued', 'sent') and at the end, whose name is the outcome: 'acked' (the drive echoed the
+    write), 'coalesced' (a newer value replaced it before it was sent), 'exception', 'timeout'
+    or 'dropped' (queue full). For acknowledged writes the HMI-write-to-ack latency goes into
+    a histogram per Yaskawa register."""
+    OUTCOMES = ('acked', 'coalesced', 'exception', 'timeout', 'dropped')
+
+    def __init__(self, keep=50):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.recent = deque(maxlen=keep)   # finished traces, newest last
+        self._latency = {}                 # Yaskawa register -> Histogram of HMI write -> ack
+        self._outcomes = {}                # Yaskawa register -> {outcome: count}
+
+    def begin(self, register, value, weg_register, weg_value, received_at=None):
+        """New trace for the HMI write register=value, translated to weg_register=weg_value"""
+        now = time.time()
+        return {
+            'id': next(self._ids),
             'register': register,
             'value': value,
-            'name': command_name,
-            'timestamp': datetime.now()
-        })
-        add_message('QUEUE', f"[Node {weg_id}] Queued: P{register:04d}={value} ({command_name})")
+            'weg_register': weg_register,
+            'weg_value': weg_value,
+            'hops': {'hmi_write': received_at or now, 'queued': now},
+            'outcome': None,
+        }
+
+    def hop(self, traces, name, at=None):
+        at = at or time.time()
+        for trace in traces:
+            trace['hops'][name] = at
+
+    def finish(self, traces, outcome, at=None):
+        at = at or time.time()
+        with self._lock:
+            for trace in traces:
+                trace['hops'][outcome] = at
+                trace['outcome'] = outcome
+                register = trace['register']
+                outcomes = self._outcomes.get(register)
+                if outcomes is None:
+                    outcomes = self._outcomes[register] = dict.fromkeys(self.OUTCOMES, 0)
+                outcomes[outcome] += 1
+                if outcome == 'acked':
+                    latency = self._latency.get(register)
+                    if latency is None:
+                        latency = self._latency[register] = Histogram('setpoint_ack_seconds')
+                    latency.observe(at - trace['hops']['hmi_write'])
+                self.recent.append(trace)
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self._latency.clear()
+            self._outcomes.clear()
+
+    def stats(self):
+        """Per Yaskawa register: outcome counts and HMI-write-to-ack latency (ms)"""
+        with self._lock:
+            registers = {}
+            for register, outcomes in sorted(self._outcomes.items()):
+                latency = self._latency.get(register)
+                summary = latency.to_dict() if latency else {}
+                registers[f'0x{register:04X}'] = {
+                    'outcomes': dict(outcomes),
+                    'acked': summary.get('count', 0),
+                    'avg_ms': summary.get('avg_ms'),
+                    'p50_ms': summary.get('p50_ms'),
+                    'p99_ms': summary.get('p99_ms'),
+                }
+            return registers
+
+    def recent_traces(self):
+        """Finished traces, newest first, with hop times in ms after the HMI write"""
+        with self._lock:
+            traces = list(self.recent)
+        result = []
+        for trace in reversed(traces):
+            start = trace['hops']['hmi_write']
+            result.append({
+                'id': trace['id'],
+                'register': f"0x{trace['register']:04X}",
+                'value': trace['value'],
+                'weg_register': f"P{trace['weg_register']:04d}",
+                'weg_value': trace['weg_value'],
+                'outcome': trace['outcome'],
+                'hops_ms': {name: round((at - start) * 1000, 3) for name, at in trace['hops'].items()},
+            })
+        return result
+
+setpoint_tracer = SetpointTracer()
+
+# --- SINGLE BUS MODE: Command Queue ---
+# Priority classes, most urgent first. The scheduler always sends the highest class that has
+# something pending; each class has a deadline (seconds from queueing, WEG_DEADLINES_S) and
+# commands sent after it are counted as missed. Only diagnostic reads are ever discarded for
+# being late - a control word is always delivered, however late.
+WEG_PRIORITY_SAFETY = 0       # STOP / fault reset control words
+WEG_PRIORITY_CONTROL = 1      # Other control words (run, direction)
+WEG_PRIORITY_SPEED = 2        # Speed reference
+WEG_PRIORITY_DIAGNOSTIC = 3   # Reads (heartbeat, diagnostics)
+WEG_PRIORITY_NAMES = ('safety_stop', 'control', 'speed', 'diagnostic')
+
+def classify_weg_command(register, value):
+    """Priority class of a write to the WEG"""
+    if register == 682:
+        # P0682 bit 0 = Start/Stop, bit 7 = Fault Reset
+        if not value & 0x0001 or value & 0x0080:
+            return WEG_PRIORITY_SAFETY
+        return WEG_PRIORITY_CONTROL
+    if register == 683:
+        return WEG_PRIORITY_SPEED
+    return WEG_PRIORITY_CONTROL
+
+def _supersedes(priority, value, cmd):
+    """True if a new value of class priority may replace the pending cmd for the same register.
+    Safety words are only absorbed by the same value: a STOP or fault reset must reach the drive."""
+    if cmd['priority'] == WEG_PRIORITY_SAFETY:
+        return priority == WEG_PRIORITY_SAFETY and value == cmd['value']
+    return priority <= cmd['priority']
+
+class WegCommandQueue:
+    """Pending WEG transactions by priority class, latest value wins.
+    
+    Keyed by (function code, WEG register): writing P0683 again while an earlier P0683 is still
+    pending replaces its value in place, so the drive never replays stale setpoints. A value
+    only replaces a pending one of the same or a lower class (a STOP after a RUN for P0682
+    leaves only the STOP). A pending entry of a higher class, or a safety word with a different
+    value, is never overwritten: it is pinned under a key of its own and the new value queues
+    behind it, so a STOP or fault reset still reaches the drive before a later RUN. Dequeue is O(1) from the front of the class's
+    OrderedDict. At most `maxlen` entries are pending; beyond that the oldest of the lowest
+    class is dropped.
+    """
+    def __init__(self, maxlen=16):
+        self.maxlen = maxlen
+        self._classes = [OrderedDict() for _ in WEG_PRIORITY_NAMES]
+        self._index = {}      # key -> priority class currently holding it
+        self._pins = itertools.count()   # unique keys for pinned (superseded but unsent) entries
+        self._lock = threading.Lock()
+        self.queued = 0       # new entries
+        self.coalesced = 0    # values that replaced a pending one
+        self.dropped = 0      # entries evicted because the queue was full
+        self.expired = 0      # diagnostic reads discarded past their deadline
+        self.dispatched = 0
+        self._age_total = 0.0
+        self._age_max = 0.0
+        self._age_last = None
+        self._class_stats = [{'queued': 0, 'dispatched': 0, 'missed_deadline': 0, 'age_max_ms': 0.0}
+                             for _ in WEG_PRIORITY_NAMES]
+    
+    def put(self, register, value, name, priority, deadline, fc=0x06, count=1, trace=None):
+        """Queue a write (fc 0x06) or read (fc 0x03, value unused); return True if it replaced
+        a pending entry for the same register. trace (see SetpointTracer) travels with it."""
+        now = time.time()
+        key = (fc, register)
+        with self._lock:
+            current = self._index.get(key)
+            if current is not None and not _supersedes(priority, value, self._classes[current][key]):
+                self._pin(key)
+                current = None
+            if current is not None:
+                cmd = self._classes[current][key]
+                if current != priority:
+                    del self._classes[current][key]
+                    self._classes[priority][key] = cmd
+                    self._index[key] = priority
+                cmd.update(value=value, name=name, priority=priority, count=count)
+                cmd['deadline'] = min(cmd['deadline'], now + deadline)
+                cmd['coalesced'] += 1
+                self.coalesced += 1
+                _m_coalesced.inc()
+                if cmd['traces']:
+                    setpoint_tracer.finish(cmd['traces'], 'coalesced', now)
+                cmd['traces'] = [trace] if trace else []
+                return True
+            while len(self._index) >= max(1, self.maxlen):
+                self._drop_oldest_lowest()
+            self._classes[priority][key] = {
+                'key': key,
+                'fc': fc,
+                'register': register,
+                'value': value,
+                'count': count,
+                'name': name,
+                'priority': priority,
+                'timestamp': now,   # when the register first became pending (queued-age)
+                'deadline': now + deadline,
+                'coalesced': 0,
+                'traces': [trace] if trace else [],
+            }
+            self._index[key] = priority
+            self.queued += 1
+            self._class_stats[priority]['queued'] += 1
+            return False
+    
+    def _pin(self, key):
+        """Move the pending entry for key out of the way of newer values, keeping its place"""
+        priority = self._index.pop(key)
+        pending = self._classes[priority]
+        pinned = key + (next(self._pins),)
+        for k in list(pending):
+            cmd = pending.pop(k)
+            if k == key:
+                k = cmd['key'] = pinned
+            pending[k] = cmd
+        self._index[pinned] = priority
+    
+    def _drop_oldest_lowest(self):
+        for pending in reversed(self._classes):
+            if pending:
+                key, cmd = pending.popitem(last=False)
+                del self._index[key]
+                self.dropped += 1
+                if cmd['traces']:
+                    setpoint_tracer.finish(cmd['traces'], 'dropped')
+                return
+    
+    def pop(self):
+        """Remove and return the most urgent pending command, or None"""
+        block = self.pop_block(1)
+        return block[0] if block else None
+    
+    def pop_block(self, max_count):
+        """Remove the most urgent pending command plus pending writes for the registers adjacent
+        to it (up to max_count in all, e.g. P0682 + P0683); return them sorted by register.
+        Returns [] if nothing is pending."""
+        now = time.time()
+        with self._lock:
+            head = None
+            for pending in self._classes:
+                while pending:
+                    key, cmd = pending.popitem(last=False)
+                    del self._index[key]
+                    if cmd['priority'] == WEG_PRIORITY_DIAGNOSTIC and now > cmd['deadline']:
+                        self.expired += 1
+                        continue
+                    head = cmd
+                    break
+                if head:
+                    break
+            if head is None:
+                return []
+            block = [head]
+            if head['fc'] == 0x06:
+                register = head['register'] - 1
+                while len(block) < max_count and (0x06, register) in self._index:
+                    block.insert(0, self._take((0x06, register)))
+                    register -= 1
+                register = head['register'] + 1
+                while len(block) < max_count and (0x06, register) in self._index:
+                    block.append(self._take((0x06, register)))
+                    register += 1
+            for cmd in block:
+                age = now - cmd['timestamp']
+                _m_weg_queue_wait.observe(age)
+                self.dispatched += 1
+                self._age_total += age
+                self._age_last = age
+                self._age_max = max(self._age_max, age)
+                stats = self._class_stats[cmd['priority']]
+                stats['dispatched'] += 1
+                stats['age_max_ms'] = max(stats['age_max_ms'], age * 1000)
+                cmd['missed_deadline'] = now > cmd['deadline']
+                if cmd['missed_deadline']:
+                    stats['missed_deadline'] += 1
+            return block
+    
+    def _take(self, key):
+        return self._classes[self._index.pop(key)].pop(key)
+    
+    def push_front(self, cmds):
+        """Put commands back at the head of their class (after a failed combined write), unless
+        a newer value that supersedes it was queued for the register in the meantime"""
+        with self._lock:
+            for cmd in reversed(cmds):
+                key = cmd['key']
+                if key in self._index:
+                    newer = self._classes[self._index[key]][key]
+                    if _supersedes(newer['priority'], newer['value'], cmd):
+                        if cmd['traces']:
+                            setpoint_tracer.finish(cmd['traces'], 'coalesced')
+                        continue
+                    # The newer value may not swallow this one: pin it so it still goes first
+                    key = cmd['key'] = key + (next(self._pins),)
+                pending = self._classes[cmd['priority']]
+                pending[key] = cmd
+                pending.move_to_end(key, last=False)
+                self._index[key] = cmd['priority']
+    
+    def clear(self):
+        with self._lock:
+            for pending in self._classes:
+                pending.clear()
+            self._index.clear()
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def stats(self):
+        """Counters and queued-age (seconds from first queued to sent) for the web interface"""
+        with self._lock:
+            now = time.time()
+            oldest = min((cmd['timestamp'] for pending in self._classes for cmd in pending.values()), default=None)
+            return {
+                'pending': len(self._index),
+                'max': self.maxlen,
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'expired': self.expired,
+                'dispatched': self.dispatched,
+                'age_last_ms': self._age_last * 1000 if self._age_last is not None else None,
+                'age_avg_ms': self._age_total / self.dispatched * 1000 if self.dispatched else None,
+                'age_max_ms': self._age_max * 1000,
+                'oldest_pending_ms': (now - oldest) * 1000 if oldest is not None else None,
+                'classes': {name: dict(self._class_stats[i], pending=len(self._classes[i]))
+                            for i, name in enumerate(WEG_PRIORITY_NAMES)},
+            }
+
+weg_command_queue = WegCommandQueue(config.get('WEG_QUEUE_MAX', 16))
+
+def _weg_deadline(priority):
+    return config.get('WEG_DEADLINES_S', {}).get(WEG_PRIORITY_NAMES[priority], 1.0)
+
+def queue_weg_command(register, value, command_name, priority=None, origin=None):
+    """Queue a command to be sent to WEG on single bus (replaces a pending value for the same register).
+    origin: (Yaskawa register, value, receive time) of the HMI write it translates, to trace it"""
+    weg_id = config.get('SLAVE_ID', 5)
+    if priority is None:
+        priority = classify_weg_command(register, value)
+    weg_command_queue.maxlen = config.get('WEG_QUEUE_MAX', 16)
+    class_name = WEG_PRIORITY_NAMES[priority]
+    trace = None
+    if origin is not None:
+        trace = setpoint_tracer.begin(origin[0], origin[1], register, value, origin[2])
+    replaced = weg_command_queue.put(register, value, command_name, priority, _weg_deadline(priority), trace=trace)
+    log_event('QUEUE', node=weg_id, register=register, value=value,
+              render=_render_queued, args=(weg_id, register, value, command_name, class_name, replaced))
+
+def _render_queued(weg_id, register, value, command_name, class_name, replaced):
+    yield 'QUEUE', f"[Node {weg_id}] {'Updated pending' if replaced else 'Queued'}: P{register:04d}={value} ({command_name}, {class_name})"
+
+def queue_weg_read(register, count, name):
+    """Queue a diagnostic FC03 read of the WEG (lowest priority, dropped if it goes stale)"""
+    priority = WEG_PRIORITY_DIAGNOSTIC
+    return weg_command_queue.put(register, None, name, priority, _weg_deadline(priority), fc=0x03, count=count)
 
 def build_modbus_write_frame(slave_id, register, value):
     """Build a Modbus RTU write single register frame (FC 0x06)"""
-    # Function code 06 = Write Single Register
-    frame = bytes([
-        slave_id,           # Slave address
-        0x06,               # Function code
-        (register >> 8) & 0xFF,   # Register address high byte
-        register & 0xFF,          # Register address low byte
-        (value >> 8) & 0xFF,      # Value high byte
-        value & 0xFF              # Value low byte
-    ])
-    # Calculate CRC-16
-    crc = calculate_crc(frame)
-    frame += bytes([crc & 0xFF, (crc >> 8) & 0xFF])
-    return frame
+    return rtucodec.encode_write_single(slave_id, register, value)
 
 def build_modbus_read_frame(slave_id, register, count):
     """Build a Modbus RTU read holding registers frame (FC 0x03)"""
-    frame = bytes([
-        slave_id,           # Slave address
-        0x03,               # Function code (Read Holding Registers)
-        (register >> 8) & 0xFF,   # Register address high byte
-        register & 0xFF,          # Register address low byte
-        (count >> 8) & 0xFF,      # Count high byte
-        count & 0xFF              # Count low byte
-    ])
-    # Calculate CRC-16
-    crc = calculate_crc(frame)
-    frame += bytes([crc & 0xFF, (crc >> 8) & 0xFF])
-    return frame
+    return rtucodec.encode_read_request(slave_id, register, count)
 
 def calculate_crc(data):
-    """Calculate Modbus CRC-16"""
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 0x0001:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    return crc
+    """Calculate Modbus CRC-16 (table-driven, see rtucodec)"""
+    return rtucodec.crc16(data)
 
-def get_modbus_request_frame_length(data):
-    """Return length of first Modbus request frame in data, or None if incomplete/unknown.
-    Used to scan a buffer containing multiple concatenated frames."""
-    if len(data) < 4:
-        return None
-    fc = data[1]
-    if fc in (0x03, 0x04):  # Read Holding/Input Registers - 8 bytes
-        return 8 if len(data) >= 8 else None
-    if fc == 0x06:  # Write Single Register - 8 bytes
-        return 8 if len(data) >= 8 else None
-    if fc == 0x10:  # Write Multiple Registers
-        if len(data) < 7:
-            return None
-        byte_count = data[6]
-        total = 9 + byte_count
-        return total if len(data) >= total else None
-    # Unknown function code - caller can skip 1 byte to resync
-    return None
-
-def get_modbus_response_frame_length(data):
-    """Return length of a Modbus response frame (from slave e.g. WEG), or None."""
-    if len(data) < 5:
-        return None
-    fc = data[1]
-    if fc in (0x03, 0x04):  # Read response: slave, fc, byte_count, data..., crc, crc
-        byte_count = data[2]
-        total = 3 + byte_count + 2
-        return total if len(data) >= total else None
-    if fc == 0x06 or fc == 0x10:  # Write response: 8 bytes
-        return 8 if len(data) >= 8 else None
-    return None
+SERIAL_IO_MODES = ('auto', 'select', 'blocking', 'poll')
+IDLE_WAKEUP_S = 0.1  # Longest the single-bus loop sleeps with nothing scheduled (stop flag check)
+
+# Read timeouts the blocking mode uses: waking a little before the deadline is harmless (the loop
+# just waits again), reconfiguring the port on every pass is not
+BLOCKING_TIMEOUTS_S = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+def _blocking_timeout(timeout):
+    """Largest BLOCKING_TIMEOUTS_S step not past timeout (0 = just take what is there)"""
+    step = 0
+    for candidate in BLOCKING_TIMEOUTS_S:
+        if candidate > timeout:
+            break
+        step = candidate
+    return step
+
+class SerialEventWaiter:
+    """Waits for serial data or a deadline without a fixed poll interval.
+
+    'select'   - non-blocking port, wait on its file descriptor (POSIX; wakes on the first byte)
+    'blocking' - blocking read(1) with the timeout set to the next deadline, rounded down to one of
+                 BLOCKING_TIMEOUTS_S (Windows COM ports: every timeout change is a SetCommTimeouts)
+    'poll'     - the original short-timeout read plus 1 ms sleep, kept for comparison
+    """
+    def __init__(self, ser, mode='auto', poll_timeout=0.002):
+        if mode == 'auto':
+            mode = 'select' if os.name == 'posix' and hasattr(ser, 'fileno') else 'blocking'
+        self.ser = ser
+        self.mode = mode
+        self._selector = None
+        if mode == 'select':
+            ser.timeout = 0
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(ser.fileno(), selectors.EVENT_READ)
+        elif mode == 'poll':
+            ser.timeout = poll_timeout
+    
+    def read(self, timeout):
+        """Wait up to timeout seconds for data; return the bytes available (b'' on timeout)"""
+        ser = self.ser
+        if self.mode == 'select':
+            if not self._selector.select(timeout):
+                return b''
+            return ser.read(ser.in_waiting or 1)
+        if self.mode == 'blocking':
+            if ser.in_waiting:
+                return ser.read(ser.in_waiting)
+            timeout = _blocking_timeout(timeout)
+            if ser.timeout != timeout:
+                ser.timeout = timeout
+            data = ser.read(1)
+            if data and ser.in_waiting:
+                data += ser.read(ser.in_waiting)
+            return data
+        data = ser.read(max(1, ser.in_waiting))
+        if not data:
+            time.sleep(0.001)
+        return data
+    
+    def close(self):
+        if self._selector:
+            self._selector.close()
+            self._selector = None
 
 def run_single_bus_gateway():
     """Custom single-bus handler for redirect mode - both slave and master on same port.
 
     HMI shows 'faulted' when: (1) No valid Modbus response = communication timeout - ensure
-    Node 6 frames are processed (buffer scan); (2) Status word bit 3 (FAULT ACTIVE) set -
+    Node 6 frames are processed (RtuFrameParser emits every frame on the bus); (2) Status word bit 3 (FAULT ACTIVE) set -
     we never set it; (3) Fault code register 0x000D non-zero - we init to 0."""
-    global server_running
+    global server_running, weg_poller
     
     yaskawa_id = config.get('YASKAWA_SLAVE_ID', 6)
     weg_id = config.get('SLAVE_ID', 5)
+    timing = compute_bus_timing()
+    weg_poller = new_weg_poller(timing)
+    _weg_inflight[0] = None
+    _weg_fc16_supported[0] = True
+    yaskawa_response_cache.clear()
     
     # Initialize register values (simulated Yaskawa A1000 state)
     # Sullair WS Controller (spec 02250162-949) reads specific registers to verify A1000 is present.
-    # Register space extended to 0x1000 so reads to high addresses (e.g. 0x07D8) don't index out.
-    REGISTER_SIZE = 0x1000
-    registers = [0] * REGISTER_SIZE
+    registers = new_yaskawa_image()
     
     # Standard MEMOBUS registers (0x0000-0x000F)
     registers[0x0000] = YASKAWA_STATUS_READY   # Status: Ready + At Frequency, NO fault bit
@@ -603,78 +1182,105 @@ def run_single_bus_gateway():
             parity=config['PARITY'],
             stopbits=config['STOPBITS'],
             bytesize=config['BYTESIZE'],
-            timeout=0.05
+            timeout=timing['frame_gap']
         )
-        add_message('INFO', f"Single bus gateway started on {config['PORT_CONTROLADOR']}")
+        waiter = SerialEventWaiter(ser, config.get('SERIAL_IO_MODE', 'auto'), poll_timeout=timing['frame_gap'])
+        add_message('INFO', f"Single bus gateway started on {config['PORT_CONTROLADOR']} ({waiter.mode} I/O)")
         add_message('INFO', f"  Yaskawa ID: {yaskawa_id}, WEG ID: {weg_id}")
+        add_message('INFO', f"  Timing: t3.5={timing['t3_5'] * 1000:.2f}ms, gap={timing['frame_gap'] * 1000:.2f}ms, "
+                            f"idle={timing['bus_idle'] * 1000:.2f}ms, turnaround={timing['response_delay'] * 1000:.2f}ms")
         
-        buffer = bytearray()
+        parser = rtucodec.RtuFrameParser()
+        parser_seen = [0, 0, 0]  # crc_errors, resyncs, dropped_bytes already in the metrics
         last_rx_time = time.time()
+        pending_since = None  # Arrival time of the oldest byte of an incomplete frame
         
         while server_running:
-            # Read incoming data
-            data = ser.read(64)
+            # Sleep until bytes arrive or the next timing deadline: end-of-frame gap while a
+            # frame is incomplete, otherwise bus idle + the next WEG queue/heartbeat slot
+            now = time.time()
+            deadline = now + IDLE_WAKEUP_S
+            if parser.pending:
+                deadline = min(deadline, last_rx_time + timing['frame_gap'], pending_since + timing['stale_frame'])
+            else:
+                deadline = min(deadline, max(max(last_rx_time, _bus_tx_end[0]) + timing['bus_idle'],
+                                             next_weg_service_time(now)))
+            
+            # Read incoming data; the parser emits every complete, CRC-valid frame on the bus
+            data = waiter.read(max(0.0, deadline - now))
+            frames = []
+            frame_started = pending_since  # First byte of the first frame completed below
             if data:
-                buffer.extend(data)
                 last_rx_time = time.time()
-                hex_data = ' '.join([f'{b:02X}' for b in data])
-                add_message('RAW', f"RX: {hex_data}")
+                if frame_started is None:
+                    frame_started = last_rx_time
+                log_event('RAW', 'RX: ', raw=data)
+                frames = parser.feed(data)
+                if not parser.pending:
+                    pending_since = None
+                elif pending_since is None:
+                    pending_since = last_rx_time
+            
+            # t3.5 gap after the last byte = end of frame; a partial frame that is still
+            # incomplete after the longest possible frame time is stale either way
+            now = time.time()
+            if parser.pending and (now - last_rx_time >= timing['frame_gap'] or now - pending_since >= timing['stale_frame']):
+                pending_since = None
+                dropped_before = parser.dropped_bytes
+                frames += parser.end_of_frame()
+                if parser.dropped_bytes - dropped_before >= 64:
+                    add_message('DEBUG', f"Discarded {parser.dropped_bytes - dropped_before} bytes of unframed data")
+            _count_parser(parser, parser_seen)
+            frames_time = time.time()
             
-            # If we have data and there's been a gap (end of frame), scan for Node 6 frames
-            if len(buffer) >= 8 and (time.time() - last_rx_time) > 0.005:
-                # SCAN buffer for Node 6 frames with valid CRC (handles mixed protocol traffic)
-                found_frame = False
-                for i in range(len(buffer) - 7):  # Need at least 8 bytes for shortest frame
-                    if buffer[i] == yaskawa_id:
-                        fc = buffer[i + 1]
-                        frame_len = None
-                        
-                        # Calculate expected frame length based on function code
-                        if fc == 0x03 or fc == 0x04:  # Read Holding/Input Registers
-                            frame_len = 8
-                        elif fc == 0x06:  # Write Single Register
-                            frame_len = 8
-                        elif fc == 0x10:  # Write Multiple Registers
-                            if i + 7 <= len(buffer):
-                                byte_count = buffer[i + 6]
-                                frame_len = 9 + byte_count
-                        
-                        if frame_len and i + frame_len <= len(buffer):
-                            frame = buffer[i:i + frame_len]
-                            # Verify CRC
-                            if verify_crc(frame):
-                                hex_frame = ' '.join([f'{b:02X}' for b in frame])
-                                add_message('RECV', f"[Node {yaskawa_id}] Valid frame at offset {i}: {hex_frame}")
-                                
-                                # Process as Yaskawa slave
-                                _, response, registers = process_yaskawa_request(frame, registers, yaskawa_id, weg_id, ser)
-                                if response:
-                                    time.sleep(0.002)  # Small delay before responding
-                                    bytes_written = ser.write(response)
-                                    ser.flush()
-                                    hex_resp = ' '.join([f'{b:02X}' for b in response])
-                                    add_message('TX', f"[Node {yaskawa_id}] Response ({bytes_written}B): {hex_resp}")
-                                
-                                # Remove processed data up to and including this frame
-                                buffer = buffer[i + frame_len:]
-                                found_frame = True
-                                break
+            # HMI requests first: they have a response window, WEG replies only need matching
+            for kind, frame in frames:
+                if frame[0] != weg_id:
+                    _hmi_bus_time[0] += len(frame) * timing['char_time'] + timing['t3_5']
+                if kind != rtucodec.RtuFrameParser.REQUEST or frame[0] != yaskawa_id:
+                    continue  # Other nodes' traffic (WEG replies, other drives on the bus)
+                _hmi_frames[0] += 1
+                log_event('RECV', 'Valid frame: ', node=yaskawa_id, raw=frame)
+                if frame_started is None:
+                    frame_started = last_rx_time  # Later frames of the same read: approximate
+                _m_frame_assembly.observe(frames_time - frame_started)
                 
-                # If no valid Node 6 frame found, clear old data to prevent buffer growth
-                if not found_frame and len(buffer) > 256:
-                    add_message('DEBUG', f"Clearing {len(buffer) - 64} bytes of unprocessed data")
-                    buffer = buffer[-64:]  # Keep last 64 bytes in case frame spans reads
+                # Process as Yaskawa slave
+                _, response, registers = process_yaskawa_request(frame, registers, yaskawa_id, weg_id, ser, frame_started)
+                if response:
+                    # Modbus turnaround: at least t3.5 of silence after the request before answering
+                    delay = timing['response_delay'] - (time.time() - last_rx_time)
+                    if delay > 0:
+                        time.sleep(delay)
+                    if time.time() - last_rx_time > config.get('HMI_RESPONSE_WINDOW_S', 0.05):
+                        _hmi_missed_window[0] += 1
+                        _m_hmi_late.inc()
+                    write_started = time.time()
+                    bytes_written = ser.write(response)
+                    ser.flush()
+                    written = time.time()
+                    _mark_tx_end(write_started, len(response), timing)
+                    _hmi_bus_time[0] += len(response) * timing['char_time'] + timing['t3_5']
+                    _m_frame_to_response.observe(written - frames_time)
+                    _m_hmi_turnaround.observe(written - frame_started)
+                    log_event('TX', f"Response ({bytes_written}B): ", node=yaskawa_id, raw=response)
+                else:
+                    _hmi_missed_window[0] += 1
+                    _m_hmi_unanswered.inc()
+                frame_started = None
             
-            # Clear stale buffer
-            if len(buffer) > 0 and (time.time() - last_rx_time) > 0.5:
-                buffer.clear()
+            for kind, frame in frames:
+                if frame[0] == weg_id:
+                    on_weg_frame(kind, frame, weg_id, last_rx_time, registers)
             
             # Process any queued WEG commands (only when bus is idle)
-            if len(buffer) == 0 and (time.time() - last_rx_time) > 0.05:
+            now = time.time()
+            # Idle = bus_idle since the last byte in either direction: our own HMI reply counts too
+            if (not parser.pending and now - max(last_rx_time, _bus_tx_end[0]) >= timing['bus_idle']
+                    and next_weg_service_time(now) <= now):
                 process_weg_queue_on_bus(ser, weg_id)
-            
-            time.sleep(0.001)
         
+        waiter.close()
         ser.close()
         add_message('INFO', 'Single bus gateway stopped')
         
@@ -686,15 +1292,106 @@ def run_single_bus_gateway():
 
 def verify_crc(data):
     """Verify CRC of a Modbus frame"""
-    if len(data) < 4:
-        return False
-    message = data[:-2]
-    received_crc = data[-2] | (data[-1] << 8)
-    calculated_crc = calculate_crc(message)
-    return received_crc == calculated_crc
+    return rtucodec.check_crc(data)
+
+# --- SINGLE BUS MODE: Read response cache ---
+RESPONSE_CACHE_SIZE = 64   # FC03/FC04 windows kept; an HMI polls a handful
+
+class YaskawaResponseCache:
+    """Finished FC03/FC04 responses (CRC included) keyed by (function code, start, count).
+    
+    The HMI polls the same few windows continuously, so a hit is one dict lookup and the
+    response goes straight to ser.write. The register values are kept with it for the log
+    worker. Each entry records the register image's range_version() when it was built; an
+    entry whose window has been written since is a miss and gets rebuilt. At most `maxsize`
+    windows are kept, least recently used evicted first, so a master sweeping start/count
+    combinations cannot grow it without bound."""
+    
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+    
+    def get(self, func_code, start, count, version):
+        key = (func_code, start, count)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        if entry is not None:
+            self.invalidations += 1
+        self.misses += 1
+        return None
+    
+    def put(self, func_code, start, count, version, response, values):
+        cached = (response, values)
+        key = (func_code, start, count)
+        self._entries[key] = (version, cached)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return cached
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else None,
+        }
+
+yaskawa_response_cache = YaskawaResponseCache()
+
+def _render_yaskawa_read(yaskawa_id, func_code, start_addr, values):
+    """Log lines for an answered FC03/FC04 read (runs on the log worker)"""
+    count = len(values)
+    fc_name = "READ HOLD" if func_code == 0x03 else "READ INPUT"
+    yield 'RECV', f"[Node {yaskawa_id}] {fc_name} Reg 0x{start_addr:04X} x{count}"
+    
+    # Log ALL values being returned (critical for debugging Sullair communication)
+    values_log = [f"0x{start_addr + i:04X}={val}" for i, val in enumerate(values)]
+    yield 'SEND', f"[Node {yaskawa_id}] Response: {', '.join(values_log)}"
+    
+    # Log decoded values (only first few to avoid spam)
+    for i in range(min(count, 3)):
+        addr = start_addr + i
+        decoded = decode_yaskawa_command(addr, values[i], is_write=False)
+        yield 'DECODE', f"  0x{addr:04X}={values[i]} ({decoded.get('register_name', 'UNK')})"
+    if count > 3:
+        yield 'DECODE', f"  ... and {count-3} more registers"
+
+def _render_yaskawa_write(yaskawa_id, reg_addr, received, value):
+    """Log lines for an FC06 write (runs on the log worker)"""
+    yield 'RECV', f"[Node {yaskawa_id}] WRITE Reg 0x{reg_addr:04X} = {received}"
+    decoded = decode_yaskawa_command(reg_addr, value, is_write=True)
+    yield 'DECODE', f"  -> {decoded.get('register_name', 'UNK')}: {decoded.get('calculated_value', decoded.get('description', 'N/A'))}"
+
+def _render_yaskawa_write_multiple(yaskawa_id, start_addr, values):
+    """Log lines for an FC10 write (runs on the log worker)"""
+    yield 'RECV', f"[Node {yaskawa_id}] WRITE MULT Reg 0x{start_addr:04X} x{len(values)}"
+    for i, val in enumerate(values):
+        decoded = decode_yaskawa_command(start_addr + i, val, is_write=True)
+        yield 'DECODE', f"  0x{start_addr + i:04X}={val} ({decoded.get('register_name', 'UNK')})"
+
+def _record_decoded_writes(start_addr, values):
+    """Decoded HMI writes for the web interface (runs on the log worker)"""
+    for i, val in enumerate(values):
+        add_decoded_message(decode_yaskawa_command(start_addr + i, val, is_write=True))
 
-def process_yaskawa_request(buffer, registers, yaskawa_id, weg_id, ser):
-    """Process incoming Modbus request as Yaskawa slave"""
+def process_yaskawa_request(buffer, registers, yaskawa_id, weg_id, ser, received_at=None):
+    """Process incoming Modbus request as Yaskawa slave (received_at: first byte of the request)"""
     if len(buffer) < 4:
         return None, None, registers
     
@@ -706,94 +1403,56 @@ def process_yaskawa_request(buffer, registers, yaskawa_id, weg_id, ser):
     
     response = None
     frame_len = 0
+    view = memoryview(buffer)  # CRC checks and field decoding read in place, no slicing copies
     
     if func_code == 0x03 or func_code == 0x04:  # Read Holding/Input Registers
         if len(buffer) >= 8:
             frame_len = 8
             
             # Verify CRC
-            if not verify_crc(buffer[:frame_len]):
+            if not verify_crc(view[:frame_len]):
                 add_message('ERROR', f"CRC error on received frame")
                 return buffer[:frame_len], None, registers
             
-            start_addr = (buffer[2] << 8) | buffer[3]
-            count = (buffer[4] << 8) | buffer[5]
+            _, _, start_addr, count = rtucodec.decode_read_request(view)
             
-            hex_frame = ' '.join([f'{b:02X}' for b in buffer[:frame_len]])
-            fc_name = "READ HOLD" if func_code == 0x03 else "READ INPUT"
-            add_message('RECV', f"[Node {yaskawa_id}] {fc_name} Reg 0x{start_addr:04X} x{count}")
-            
-            # Build response
-            resp = bytearray([slave_id, func_code, count * 2])
-            values_log = []
-            for i in range(count):
-                addr = start_addr + i
-                val = registers[addr] if addr < len(registers) else 0
-                values_log.append(f"0x{addr:04X}={val}")
-                resp.extend([(val >> 8) & 0xFF, val & 0xFF])
-            
-            # Log ALL values being returned (critical for debugging Sullair communication)
-            add_message('SEND', f"[Node {yaskawa_id}] Response: {', '.join(values_log)}")
-            
-            crc = calculate_crc(resp)
-            resp.extend([crc & 0xFF, (crc >> 8) & 0xFF])
-            response = bytes(resp)
-            
-            # Log decoded values (only first few to avoid spam)
-            for i in range(min(count, 3)):
-                addr = start_addr + i
-                val = registers[addr] if addr < len(registers) else 0
-                decoded = decode_yaskawa_command(addr, val, is_write=False)
-                add_message('DECODE', f"  0x{addr:04X}={val} ({decoded.get('register_name', 'UNK')})")
-            if count > 3:
-                add_message('DECODE', f"  ... and {count-3} more registers")
+            version = registers.range_version(start_addr, count)
+            cached = yaskawa_response_cache.get(func_code, start_addr, count, version)
+            if cached is None:
+                # Build response (addresses past the register space read as 0)
+                cached = yaskawa_response_cache.put(
+                    func_code, start_addr, count, version,
+                    rtucodec.encode_read_response(slave_id, func_code, registers.get_bytes(start_addr, count)),
+                    tuple(registers.get(start_addr, count)))
+            response, values = cached
+            log_event('RECV', node=yaskawa_id, register=start_addr, raw=view[:frame_len].tobytes(),
+                      render=_render_yaskawa_read, args=(yaskawa_id, func_code, start_addr, values))
             
     elif func_code == 0x06:  # Write Single Register
         if len(buffer) >= 8:
             frame_len = 8
             
             # Verify CRC
-            if not verify_crc(buffer[:frame_len]):
+            if not verify_crc(view[:frame_len]):
                 add_message('ERROR', f"CRC error on received frame")
                 return buffer[:frame_len], None, registers
             
-            reg_addr = (buffer[2] << 8) | buffer[3]
-            value = (buffer[4] << 8) | buffer[5]
-            
-            add_message('RECV', f"[Node {yaskawa_id}] WRITE Reg 0x{reg_addr:04X} = {value}")
+            _, reg_addr, value = rtucodec.decode_write_single(view)
             
             # Store value (never allow fault bit in status reg 0; never overwrite A1000 identification)
-            A1000_ID_REGISTERS = (0x00F0, 0x00F1, 0x00F2)  # read-only: drive type, software version, option
-            if reg_addr == 0:
-                value = value & ~YASKAWA_STATUS_FAULT_BIT
-            if reg_addr < len(registers) and reg_addr not in A1000_ID_REGISTERS:
-                registers[reg_addr] = value
-            
-            # Update status if command word (never set fault bit - HMI shows faulted if bit 3 set)
-            if reg_addr == 0x0001:
-                status = 0x0001  # Drive Ready
-                if value & 0x01:
-                    status |= 0x0002  # Running
-                if value & 0x02:
-                    status |= 0x0004  # Reverse
-                status |= 0x0020  # At frequency
-                registers[0x0000] = status & ~YASKAWA_STATUS_FAULT_BIT  # Standard MEMOBUS status
-                # Sullair WS Controller reads 0x0020 for status (not 0x0000)
-                registers[0x0020] = status & ~YASKAWA_STATUS_FAULT_BIT  # Sullair-specific status
+            received = value
+            value = store_yaskawa_write(registers, reg_addr, [value])[0]
             
-            # Decode and log
-            decoded = decode_yaskawa_command(reg_addr, value, is_write=True)
-            add_message('DECODE', f"  -> {decoded.get('register_name', 'UNK')}: {decoded.get('calculated_value', decoded.get('description', 'N/A'))}")
+            # Decode and log (on the log worker)
+            log_event('WRITE', node=yaskawa_id, register=reg_addr, value=value,
+                      render=_render_yaskawa_write, args=(yaskawa_id, reg_addr, received, value))
+            defer_call(_record_decoded_writes, reg_addr, (value,))
             
             # Redirect: translate Yaskawa A1000 commands to WEG CFW-11 and queue
-            translate_to_weg(reg_addr, value, weg_id)
+            translate_to_weg(reg_addr, value, weg_id, received_at)
             
             # Build echo response (same as request)
-            resp = bytearray([slave_id, func_code])
-            resp.extend(buffer[2:6])  # Echo register and value
-            crc = calculate_crc(resp)
-            resp.extend([crc & 0xFF, (crc >> 8) & 0xFF])
-            response = bytes(resp)
+            response = rtucodec.encode_echo_response(view)
             
     elif func_code == 0x10:  # Write Multiple Registers
         if len(buffer) >= 7:
@@ -801,63 +1460,68 @@ def process_yaskawa_request(buffer, registers, yaskawa_id, weg_id, ser):
             frame_len = 9 + byte_count
             if len(buffer) >= frame_len:
                 # Verify CRC
-                if not verify_crc(buffer[:frame_len]):
+                if not verify_crc(view[:frame_len]):
                     add_message('ERROR', f"CRC error on received frame")
                     return buffer[:frame_len], None, registers
                 
-                start_addr = (buffer[2] << 8) | buffer[3]
-                count = (buffer[4] << 8) | buffer[5]
-                
-                add_message('RECV', f"[Node {yaskawa_id}] WRITE MULT Reg 0x{start_addr:04X} x{count}")
+                _, start_addr, write_values = rtucodec.decode_write_multiple(view)
                 
                 # Store values (never allow fault bit in status; never overwrite A1000 identification)
-                A1000_ID_REGISTERS = (0x00F0, 0x00F1, 0x00F2)
-                for i in range(count):
+                write_values = store_yaskawa_write(registers, start_addr, write_values)
+                log_event('WRITE', node=yaskawa_id, register=start_addr, raw=view[:frame_len].tobytes(),
+                          render=_render_yaskawa_write_multiple, args=(yaskawa_id, start_addr, write_values))
+                defer_call(_record_decoded_writes, start_addr, write_values)
+                for i, val in enumerate(write_values):
                     addr = start_addr + i
-                    val = (buffer[7 + i*2] << 8) | buffer[8 + i*2]
-                    if addr == 0:
-                        val = val & ~YASKAWA_STATUS_FAULT_BIT  # Status: clear fault bit
-                    if addr < len(registers) and addr not in A1000_ID_REGISTERS:
-                        registers[addr] = val
-                    
-                    # Update Sullair-specific status register if command word is written
-                    if addr == 0x0001:
-                        status = 0x0001  # Drive Ready
-                        if val & 0x01:
-                            status |= 0x0002  # Running
-                        if val & 0x02:
-                            status |= 0x0004  # Reverse
-                        status |= 0x0020  # At frequency
-                        registers[0x0000] = status & ~YASKAWA_STATUS_FAULT_BIT
-                        registers[0x0020] = status & ~YASKAWA_STATUS_FAULT_BIT  # Sullair reads 0x0020
-                    
-                    decoded = decode_yaskawa_command(addr, val, is_write=True)
-                    add_message('DECODE', f"  0x{addr:04X}={val} ({decoded.get('register_name', 'UNK')})")
                     
                     # Redirect: translate each Yaskawa register to WEG CFW-11 (skip read-only id regs)
-                    if addr not in A1000_ID_REGISTERS:
-                        translate_to_weg(addr, val, weg_id)
+                    if not registers.is_protected(addr):
+                        translate_to_weg(addr, val, weg_id, received_at)
                 
                 # Build response (echo address and count only)
-                resp = bytearray([slave_id, func_code])
-                resp.extend(buffer[2:6])  # Echo start addr and count
-                crc = calculate_crc(resp)
-                resp.extend([crc & 0xFF, (crc >> 8) & 0xFF])
-                response = bytes(resp)
+                response = rtucodec.encode_echo_response(view)
     else:
         # Unsupported function code
         add_message('WARNING', f"[Node {yaskawa_id}] Unsupported FC 0x{func_code:02X}")
         # Return exception response
-        resp = bytearray([slave_id, func_code | 0x80, 0x01])  # Exception: Illegal Function
-        crc = calculate_crc(resp)
-        resp.extend([crc & 0xFF, (crc >> 8) & 0xFF])
-        response = bytes(resp)
+        response = rtucodec.encode_exception(slave_id, func_code, 0x01)  # Exception: Illegal Function
         frame_len = len(buffer)  # Clear whole buffer
     
     return buffer[:frame_len] if frame_len > 0 else None, response, registers
 
-def translate_to_weg(yaskawa_reg, value, weg_id):
-    """Translate Yaskawa register write to WEG command
+def _render_translation(yaskawa_reg, value, weg_register, weg_value, weg_max_hz):
+    """Log lines for an HMI write and the WEG command it became (runs on the log worker)"""
+    yield 'DEBUG', f"translate_to_weg: Reg=0x{yaskawa_reg:04X}, Value={value} (0x{value:04X})"
+    if weg_register == 682:
+        yield 'TRANSLATE', f"Yaskawa CMD 0x{value:04X} -> WEG P0682 = 0x{weg_value:04X}"
+        yield 'DECODE', (f"  WEG: {'RUN' if weg_value & 0x01 else 'STOP'}, {'GEN_EN' if weg_value & 0x02 else 'DIS'}, "
+                         f"{'FWD' if weg_value & 0x04 else 'REV'}, {'REMOTE' if weg_value & 0x10 else 'LOCAL'}")
+    elif weg_register == 683:
+        freq_hz = value / 100.0
+        if yaskawa_reg == 0x0002:
+            yield 'TRANSLATE', f"Yaskawa 0x0002={value} -> {freq_hz:.2f}Hz -> WEG P0683={weg_value} (max={weg_max_hz}Hz)"
+        elif yaskawa_reg == 0x0009:
+            yield 'TRANSLATE', f"Yaskawa SPEED 0x0009={value}RPM -> WEG P0683={weg_value}"
+        else:
+            yield 'TRANSLATE', f"Yaskawa ALT_FREQ 0x{yaskawa_reg:04X}={value} ({freq_hz:.2f}Hz) -> WEG P0683={weg_value}"
+    elif 0x0020 <= yaskawa_reg <= 0x002F:
+        yield 'DEBUG', f"Freq limit/preset reg 0x{yaskawa_reg:04X}={value} (not translated)"
+    else:
+        yield 'DEBUG', f"No WEG translation for Yaskawa reg 0x{yaskawa_reg:04X}={value}"
+
+WEG_SPEED_REF_MAX = 8192   # P0683 13-bit scale: 8192 = WEG_MAX_FREQ_HZ (synchronous speed)
+
+def _weg_speed_reference(val_weg, yaskawa_reg):
+    """Clamp a P0683 value to 0..WEG_SPEED_REF_MAX (an out-of-range HMI value must not overspeed
+    the motor or break the FC16 block it is sent in)"""
+    if 0 <= val_weg <= WEG_SPEED_REF_MAX:
+        return val_weg
+    clamped = min(max(val_weg, 0), WEG_SPEED_REF_MAX)
+    add_message('WARNING', f"Yaskawa 0x{yaskawa_reg:04X}: WEG P0683={val_weg} out of range, clamped to {clamped}")
+    return clamped
+
+def translate_to_weg(yaskawa_reg, value, weg_id, received_at=None):
+    """Translate Yaskawa register write to WEG command (traced from received_at to the drive's ack)
     
     WEG CFW-11 P0682 Control Word bits:
         Bit 0: Start/Stop (0=stop with ramp, 1=run)
@@ -878,8 +1542,8 @@ def translate_to_weg(yaskawa_reg, value, weg_id):
         0x0009: Motor Speed (some controllers)
         0x0102: Frequency Command (alternate)
     """
-    # Log ALL incoming writes for debugging
-    add_message('DEBUG', f"translate_to_weg: Reg=0x{yaskawa_reg:04X}, Value={value} (0x{value:04X})")
+    # Every incoming write is logged (for debugging), rendered on the log worker
+    origin = (yaskawa_reg, value, received_at or time.time())
     
     if yaskawa_reg == 0x0001:  # Command word -> P0682
         # Translate Yaskawa command bits to WEG control word
@@ -899,9 +1563,9 @@ def translate_to_weg(yaskawa_reg, value, weg_id):
         if value & 0x08:
             weg_control |= 0x0080
         
-        add_message('TRANSLATE', f"Yaskawa CMD 0x{value:04X} -> WEG P0682 = 0x{weg_control:04X}")
-        add_message('DECODE', f"  WEG: {'RUN' if weg_control & 0x01 else 'STOP'}, {'GEN_EN' if weg_control & 0x02 else 'DIS'}, {'FWD' if weg_control & 0x04 else 'REV'}, {'REMOTE' if weg_control & 0x10 else 'LOCAL'}")
-        queue_weg_command(682, weg_control, "CONTROL")
+        log_event('TRANSLATE', register=yaskawa_reg, value=value,
+                  render=_render_translation, args=(yaskawa_reg, value, 682, weg_control, None))
+        queue_weg_command(682, weg_control, "CONTROL", classify_weg_command(682, weg_control), origin)
         
     elif yaskawa_reg == 0x0002:  # Frequency Reference -> P0683
         # Yaskawa: 0-6000 = 0-60.00Hz (value / 100 = Hz)
@@ -913,114 +1577,469 @@ def translate_to_weg(yaskawa_reg, value, weg_id):
         freq_hz = value / 100.0
         
         # Convert Hz to WEG 13-bit scale (8192 = weg_max_hz)
-        val_weg = int((freq_hz / weg_max_hz) * 8192)
+        val_weg = _weg_speed_reference(int((freq_hz / weg_max_hz) * 8192), yaskawa_reg)
         
-        add_message('TRANSLATE', f"Yaskawa 0x0002={value} -> {freq_hz:.2f}Hz -> WEG P0683={val_weg} (max={weg_max_hz}Hz)")
-        queue_weg_command(683, val_weg, f"SPEED {freq_hz:.1f}Hz")
+        log_event('TRANSLATE', register=yaskawa_reg, value=value,
+                  render=_render_translation, args=(yaskawa_reg, value, 683, val_weg, weg_max_hz))
+        queue_weg_command(683, val_weg, "SPEED", WEG_PRIORITY_SPEED, origin)
         
     elif yaskawa_reg == 0x0009:  # Motor Speed (RPM) - some controllers use this
         # If sending RPM directly, convert: assuming 1800 RPM = 8192
         sync_rpm = 1800  # 4-pole 60Hz motor
-        val_weg = int((value / sync_rpm) * 8192)
-        add_message('TRANSLATE', f"Yaskawa SPEED 0x0009={value}RPM -> WEG P0683={val_weg}")
-        queue_weg_command(683, val_weg, f"SPEED {value}RPM")
+        val_weg = _weg_speed_reference(int((value / sync_rpm) * 8192), yaskawa_reg)
+        log_event('TRANSLATE', register=yaskawa_reg, value=value,
+                  render=_render_translation, args=(yaskawa_reg, value, 683, val_weg, None))
+        queue_weg_command(683, val_weg, "SPEED", WEG_PRIORITY_SPEED, origin)
         
     elif yaskawa_reg == 0x0102 or yaskawa_reg == 0x0202:  # Alternate frequency registers
         # Some controllers use 0x0102 or 0x0202 for frequency
-        freq_hz = value / 100.0
-        val_weg = int((value / config['MAX_FREQ']) * 8192)
-        add_message('TRANSLATE', f"Yaskawa ALT_FREQ 0x{yaskawa_reg:04X}={value} ({freq_hz:.2f}Hz) -> WEG P0683={val_weg}")
-        queue_weg_command(683, val_weg, f"SPEED {freq_hz:.1f}Hz")
+        val_weg = _weg_speed_reference(int((value / config['MAX_FREQ']) * 8192), yaskawa_reg)
+        log_event('TRANSLATE', register=yaskawa_reg, value=value,
+                  render=_render_translation, args=(yaskawa_reg, value, 683, val_weg, None))
+        queue_weg_command(683, val_weg, "SPEED", WEG_PRIORITY_SPEED, origin)
         
     elif yaskawa_reg >= 0x0020 and yaskawa_reg <= 0x002F:
         # Multi-speed presets or frequency limits - log but don't translate
-        add_message('DEBUG', f"Freq limit/preset reg 0x{yaskawa_reg:04X}={value} (not translated)")
+        log_event('DEBUG', register=yaskawa_reg, value=value,
+                  render=_render_translation, args=(yaskawa_reg, value, None, None, None))
         
     else:
-        add_message('DEBUG', f"No WEG translation for Yaskawa reg 0x{yaskawa_reg:04X}={value}")
+        log_event('DEBUG', register=yaskawa_reg, value=value,
+                  render=_render_translation, args=(yaskawa_reg, value, None, None, None))
+
+_hmi_frames = [0]           # HMI requests addressed to the emulator (single bus)
+_hmi_missed_window = [0]    # ...of which answered late or not at all
+
+def get_bus_stats():
+    """Single-bus counters for the web interface"""
+    return {
+        'hmi_frames': _hmi_frames[0],
+        'hmi_missed_window': _hmi_missed_window[0],
+        'weg_inflight': _weg_inflight[0] is not None,
+        'weg_fc16_supported': _weg_fc16_supported[0],
+        'heartbeat_count': _weg_heartbeat_count[0],
+        'heartbeat_ok': _weg_heartbeat_ok[0],
+        'heartbeat_fail': _weg_heartbeat_fail[0],
+        'weg_queue': weg_command_queue.stats(),
+        'read_cache': yaskawa_response_cache.stats(),
+        'weg_telemetry': get_weg_telemetry(),
+        'weg_poll': weg_poller.stats(),
+        'keepalive': get_keepalive_stats(),
+        'weg_rtt_ms': {
+            'count': _weg_rtt['count'],
+            'timeouts': _weg_rtt['timeouts'],
+            'last': _weg_rtt['last'] * 1000 if _weg_rtt['last'] is not None else None,
+            'min': _weg_rtt['min'] * 1000 if _weg_rtt['min'] is not None else None,
+            'max': _weg_rtt['max'] * 1000 if _weg_rtt['max'] is not None else None,
+            'avg': _weg_rtt['total'] / _weg_rtt['count'] * 1000 if _weg_rtt['count'] else None,
+        },
+    }
+
+# --- WEG TELEMETRY POLLING ---
+# Declarative poll table: each row reads a WEG parameter range every period seconds (or, with
+# on_change, whenever that parameter changes) and scales the values into the emulated A1000
+# registers the Sullair reads. The PollScheduler merges rows that are due together into the
+# fewest FC03 reads and stretches the non-essential periods when the table needs more than
+# WEG_POLL_BUDGET of the bus time the HMI leaves free. Any valid read keeps the P0314 serial
+# watchdog alive; 'status' is essential and runs at keepalive_interval(), so the watchdog is fed
+# even when the budget squeezes everything else. Periods can be overridden in WEG_POLL_PERIODS_S.
+WEG_PROCESSING_S = 0.002     # Assumed WEG turnaround (request end -> reply start) for bus-time estimates
+
+def _weg_percent(hz10):
+    """0.1 Hz -> % of WEG_MAX_FREQ_HZ in 0.01 %"""
+    return hz10 * 1000 / config.get('WEG_MAX_FREQ_HZ', 60.0)
+
+def _weg_temperature(*tenths):
+    """Hottest of the given signed 0.1 C readings, in whole degrees"""
+    return max(t - 0x10000 if t & 0x8000 else t for t in tenths) // 10
+
+WEG_POLL_TABLE = (
+    {'name': 'status', 'start': 680, 'count': 1, 'period': 0.5, 'essential': True},   # P0680 logical status
+    {'name': 'drive', 'start': 2, 'count': 9, 'period': 0.1, 'targets': (           # P0002 speed .. P0010 power
+        (0x0003, (5,), lambda hz10: hz10 * 10),          # Output frequency 0.01 Hz <- P0005 0.1 Hz
+        (0x0004, (3,), lambda amps10: amps10 * 10),      # Output current 0.01 A <- P0003 0.1 A
+        (0x0023, (5,), _weg_percent),                    # Actual speed 0.01 % <- P0005
+        (0x0024, (5,), lambda hz10: hz10 * 10),          # Actual frequency 0.01 Hz <- P0005
+        (0x0026, (3,), lambda amps10: amps10),           # Motor current 0.1 A <- P0003
+        (0x0027, (10,), lambda kw10: kw10),              # Output power 0.1 kW <- P0010
+        (0x0031, (4,), lambda volts: volts),             # DC link voltage V <- P0004
+    )},
+    {'name': 'temperature', 'start': 30, 'count': 5, 'period': 5.0, 'targets': (    # P0030-P0034 (0.1 C)
+        (0x0068, (30, 31, 32), _weg_temperature),        # Unit temperature C <- hottest IGBT
+    )},
+    {'name': 'fault', 'start': 48, 'count': 2, 'period': 1.0, 'targets': (          # P0048 alarm, P0049 fault
+        (0x007F, (49,), lambda fault: fault),            # Active fault <- P0049 (0 = no fault)
+    )},
+    {'name': 'fault_history', 'start': 50, 'count': 20, 'period': None, 'on_change': 49},  # Last faults (code, date, time)
+)
+
+def new_weg_poller(timing=None):
+    """PollScheduler for WEG_POLL_TABLE with the configured periods, budget and bus timing"""
+    timing = timing or compute_bus_timing()
+    rows = WEG_POLL_TABLE if config.get('WEG_TELEMETRY', True) else WEG_POLL_TABLE[:1]
+
+    def read_cost(count):
+        # Our 8-byte request, the drive's turnaround, its reply, and a t3.5 gap after each frame
+        return (13 + 2 * count) * timing['char_time'] + WEG_PROCESSING_S + 2 * timing['t3_5']
+
+    poller = PollScheduler([PollEntry(**row) for row in rows], read_cost)
+    configure_weg_poller(poller)
+    return poller
+
+def configure_weg_poller(poller=None):
+    """Apply the keep-alive interval, WEG_POLL_PERIODS_S and WEG_POLL_BUDGET to the (running) poller"""
+    poller = poller or weg_poller
+    periods = dict(config.get('WEG_POLL_PERIODS_S') or {}, status=keepalive_interval())
+    poller.configure(budget=config.get('WEG_POLL_BUDGET', 0.3), periods=periods)
+    _fixed_heartbeat_due[0] = 0.0
+    _keepalives_unsettled[0] = 0
+
+def keepalive_interval():
+    """Longest the drive may go without a frame from us: P0314 x WEG_WATCHDOG_MARGIN, or
+    HEARTBEAT_INTERVAL when the watchdog time is not configured"""
+    watchdog = config.get('WEG_WATCHDOG_S')
+    if watchdog:
+        return float(watchdog) * config.get('WEG_WATCHDOG_MARGIN', 0.5)
+    return config.get('HEARTBEAT_INTERVAL', 0.5)
+
+# --- WATCHDOG KEEP-ALIVE ---
+# Any valid frame addressed to the drive resets its P0314 serial watchdog. With WEG_WATCHDOG_S
+# set, the 'status' row is a keep-alive: every successful WEG exchange (write, telemetry read,
+# exception reply) pushes it to keepalive_interval() after that exchange, so it is only sent
+# when nothing else reached the drive in time. The bus time saved is counted against the fixed
+# HEARTBEAT_INTERVAL heartbeat it replaces.
+_weg_last_exchange = [0.0]   # When the request of the last answered WEG transaction was sent
+_fixed_heartbeat_due = [0.0] # Next slot of the fixed heartbeat, for the bus-time-saved metric
+_keepalives_unsettled = [0]  # Keep-alives sent but not yet matched against a fixed heartbeat slot
+
+def _on_weg_exchange(sent_at):
+    _weg_last_exchange[0] = max(_weg_last_exchange[0], sent_at)
+    if config.get('WEG_WATCHDOG_S'):
+        weg_poller.reschedule('status', _weg_last_exchange[0] + keepalive_interval())
+
+def _keepalive_sent(start, count):
+    """Called when an FC03 read is written to the WEG; counts it if it carries the keep-alive"""
+    if config.get('WEG_WATCHDOG_S') and start <= 680 < start + count:
+        _m_keepalives_sent.inc()
+        _keepalives_unsettled[0] += 1
+
+def _account_keepalive(now):
+    """Count the fixed-interval heartbeat slots up to now that no keep-alive was sent for"""
+    if not config.get('WEG_WATCHDOG_S'):
+        return
+    interval = config.get('HEARTBEAT_INTERVAL', 0.5)
+    if not _fixed_heartbeat_due[0]:
+        _fixed_heartbeat_due[0] = now + interval
+        return
+    slots = 0
+    while _fixed_heartbeat_due[0] <= now:
+        _fixed_heartbeat_due[0] += interval
+        slots += 1
+    sent = min(slots, _keepalives_unsettled[0])
+    _keepalives_unsettled[0] -= sent
+    skipped = slots - sent
+    if skipped > 0:
+        _m_keepalives_skipped.inc(skipped)
+        _m_keepalive_saved.inc(skipped * weg_poller.cost(1))
+
+def get_keepalive_stats():
+    """Keep-alive state for the web interface"""
+    return {
+        'adaptive': bool(config.get('WEG_WATCHDOG_S')),
+        'interval_s': keepalive_interval(),
+        'since_exchange_ms': (time.time() - _weg_last_exchange[0]) * 1000 if _weg_last_exchange[0] else None,
+        'sent': _m_keepalives_sent.value,
+        'skipped': _m_keepalives_skipped.value,
+        'bus_ms_saved': _m_keepalive_saved.value * 1000,
+    }
+
+weg_poller = new_weg_poller()
+weg_telemetry = {}           # WEG parameter -> (value, time.time() of the reply)
+
+# Bus time taken by traffic other than ours (HMI requests/responses, other nodes), for the budget
+_hmi_bus_time = [0.0]
+_hmi_bus_load = {'since': time.time(), 'load': 0.0}
+
+def hmi_bus_load(now):
+    """Share of bus time used by other traffic, smoothed over ~1 s windows"""
+    window = now - _hmi_bus_load['since']
+    if window >= 1.0:
+        load = min(1.0, _hmi_bus_time[0] / window)
+        _hmi_bus_load['load'] = 0.5 * _hmi_bus_load['load'] + 0.5 * load
+        _hmi_bus_load['since'] = now
+        _hmi_bus_time[0] = 0.0
+    return _hmi_bus_load['load']
+
+def apply_weg_telemetry(start, values, registers, at=None):
+    """Record a WEG read reply and write the A1000 registers fed by the poll rows it covers.
+    Returns the number of image registers that changed."""
+    at = at or time.time()
+    for i, value in enumerate(values):
+        weg_telemetry[start + i] = (value, at)
+    changed = 0
+    for entry in weg_poller.completed(start, values, at):
+        if registers is None:
+            continue
+        for address, sources, scale in entry.targets:
+            value = int(scale(*(values[p - start] for p in sources)))
+            changed += registers.set(address, [max(0, min(0xFFFF, value))])
+    return changed
+
+def get_weg_telemetry():
+    """Latest WEG telemetry for the web interface: {'P0002': {'value', 'age_ms'}}"""
+    now = time.time()
+    return {f'P{param:04d}': {'value': value, 'age_ms': (now - at) * 1000}
+            for param, (value, at) in sorted(weg_telemetry.items())}
 
-_last_weg_poll_time = [0]  # Use list to avoid global declaration issues
 _weg_heartbeat_count = [0]
 _weg_heartbeat_ok = [0]
 _weg_heartbeat_fail = [0]
 
+# Single-bus WEG transaction in flight (request sent, reply not yet seen). The receive loop
+# keeps answering the HMI while it is pending and hands WEG frames to on_weg_frame().
+_weg_inflight = [None]
+_weg_fc16_supported = [True]  # Cleared when the drive answers a combined FC16 write with an exception
+
+# Round-trip time (end of our request -> complete, CRC-valid reply) of WEG transactions
+_weg_rtt = {'count': 0, 'last': None, 'min': None, 'max': None, 'total': 0.0, 'timeouts': 0}
+
+def _record_weg_rtt(rtt):
+    _m_weg_rtt.observe(rtt)
+    _weg_rtt['count'] += 1
+    _weg_rtt['last'] = rtt
+    _weg_rtt['total'] += rtt
+    if _weg_rtt['min'] is None or rtt < _weg_rtt['min']:
+        _weg_rtt['min'] = rtt
+    if _weg_rtt['max'] is None or rtt > _weg_rtt['max']:
+        _weg_rtt['max'] = rtt
+
+def next_weg_service_time(now):
+    """When process_weg_queue_on_bus next has work: the in-flight deadline, now if commands
+    are queued, else the slot where the next heartbeat read gets queued"""
+    inflight = _weg_inflight[0]
+    if inflight is not None:
+        return inflight['deadline']
+    if weg_command_queue:
+        return now
+    next_poll = weg_poller.next_due()
+    return next_poll if next_poll is not None else now + IDLE_WAKEUP_S
+
+_bus_tx_end = [0.0]  # When our last transmission (HMI reply or WEG request) left the wire
+
+def _mark_tx_end(written_at, length, timing):
+    """Record the end of a frame we wrote: flush() may return before the UART has sent it all,
+    so it is never earlier than the write time plus the frame's character time"""
+    _bus_tx_end[0] = max(time.time(), written_at + length * timing['char_time'])
+
+def _send_weg_transaction(ser, kind, frame, cmds=None):
+    """Write a request to the WEG and register it as the in-flight transaction (no waiting).
+    
+    The transaction completes as soon as the parser emits a CRC-valid reply (its length comes
+    from its function code and byte count, exception replies included), or fails once
+    WEG_TURNAROUND_TIMEOUT_S has passed without one. A copy of the request that is complete
+    before the request itself could have been sent plus a frame gap is our own transmission
+    read back (transceiver echo), never the drive's reply: echo_until marks that window."""
+    timing = compute_bus_timing()
+    written_at = time.time()
+    ser.write(frame)
+    ser.flush()
+    sent_at = time.time()
+    _mark_tx_end(written_at, len(frame), timing)
+    for cmd in cmds or ():
+        if cmd['traces']:
+            setpoint_tracer.hop(cmd['traces'], 'sent', sent_at)
+    _weg_inflight[0] = {
+        'kind': kind,
+        'frame': frame,
+        'cmds': cmds or [],
+        'sent_at': sent_at,
+        'echo_until': written_at + len(frame) * timing['char_time'] + timing['frame_gap'],
+        'deadline': sent_at + config.get('WEG_TURNAROUND_TIMEOUT_S', 0.1),
+    }
+
 def process_weg_queue_on_bus(ser, weg_id):
-    """Process queued WEG commands on the shared serial bus.
+    """Start the next WEG transaction on the shared serial bus, without blocking.
+    
+    Called from the single-bus loop when the bus is idle. The most urgent pending command is
+    sent (see WegCommandQueue); the heartbeat is queued as a diagnostic read when due, so it
+    never delays a control word. At most one transaction is in flight: its reply is matched
+    by on_weg_frame() as the parser emits it, and a missing reply is reported here once the
+    deadline passes.
     
     WEG CFW-11 A128 timeout occurs when P0314 (Serial Watchdog) is set and no valid
     Modbus frames are received within that time. Heartbeat reads P0680; interval must be < P0314.
+    With WEG_WATCHDOG_S set the heartbeat only goes out when no other exchange reached the
+    drive within WEG_WATCHDOG_MARGIN of P0314 (see _on_weg_exchange).
     """
-    global weg_command_queue
-    
-    # Heartbeat: Poll WEG regularly to prevent A128 timeout
-    heartbeat_interval = config.get('HEARTBEAT_INTERVAL', 0.5)
     current_time = time.time()
-    if current_time - _last_weg_poll_time[0] > heartbeat_interval:
-        _last_weg_poll_time[0] = current_time
-        _weg_heartbeat_count[0] += 1
+    inflight = _weg_inflight[0]
+    if inflight is not None:
+        if current_time < inflight['deadline']:
+            return
+        _weg_inflight[0] = None
+        _on_weg_timeout(inflight, weg_id)
+    
+    # Heartbeat / telemetry: the poll table keeps the drive polled to prevent A128 timeout.
+    # Reads are queued as diagnostics, so control words and setpoints always go first.
+    next_poll = weg_poller.next_due()
+    if next_poll is not None and next_poll <= current_time:
+        _account_keepalive(current_time)
+        weg_poller.rebalance(hmi_bus_load(current_time))
+        for start, count in weg_poller.due(current_time):
+            queue_weg_read(start, count, 'HEARTBEAT')
+    
+    combine = config.get('WEG_COMBINE_WRITES', True) and _weg_fc16_supported[0]
+    queue_len = len(weg_command_queue)
+    cmds = weg_command_queue.pop_block(2 if combine else 1)
+    if not cmds:
+        return
+    
+    for cmd in cmds:
+        if cmd['missed_deadline']:
+            late_ms = (current_time - cmd['timestamp']) * 1000
+            add_message('WARNING', f"[Node {weg_id}] {WEG_PRIORITY_NAMES[cmd['priority']]} command P{cmd['register']:04d} "
+                                   f"({cmd['name']}) missed its deadline: sent {late_ms:.0f}ms after queueing")
+    
+    if cmds[0]['fc'] == 0x03:
+        cmd = cmds[0]
+        heartbeat = cmd['name'] == 'HEARTBEAT'
+        if heartbeat:
+            _weg_heartbeat_count[0] += 1
         try:
-            heartbeat_frame = build_modbus_read_frame(weg_id, 680, 1)
-            hex_hb = ' '.join([f'{b:02X}' for b in heartbeat_frame])
-            time.sleep(0.004)
-            ser.reset_input_buffer()
-            ser.write(heartbeat_frame)
-            ser.flush()
-            time.sleep(0.05)
-            response = ser.read(32)
-            if response and len(response) >= 5:
-                _weg_heartbeat_ok[0] += 1
-                if _weg_heartbeat_count[0] % 10 == 0 and response[0] == weg_id and response[1] == 0x03:
-                    status = (response[3] << 8) | response[4]
-                    status_str = []
-                    if status & 0x0100: status_str.append("RUN")
-                    if status & 0x0200: status_str.append("GEN_EN")
-                    if status & 0x1000: status_str.append("REMOTE")
-                    if status & 0x8000: status_str.append("FAULT")
-                    if status & 0x0080: status_str.append("ALARM")
-                    add_message('DEBUG', f"[WEG] Heartbeat #{_weg_heartbeat_count[0]}: P0680=0x{status:04X} ({', '.join(status_str) if status_str else 'STOPPED'})")
-            else:
-                _weg_heartbeat_fail[0] += 1
-                if _weg_heartbeat_fail[0] <= 5 or _weg_heartbeat_fail[0] % 10 == 0:
-                    add_message('WARNING', f"[WEG] Heartbeat #{_weg_heartbeat_count[0]} NO RESPONSE (fail {_weg_heartbeat_fail[0]}/{_weg_heartbeat_count[0]})")
-                    add_message('DEBUG', f"[WEG] TX: {hex_hb}")
+            frame = build_modbus_read_frame(weg_id, cmd['register'], cmd['count'])
+            _send_weg_transaction(ser, 'heartbeat' if heartbeat else 'read', frame, cmds)
+            if heartbeat:
+                _keepalive_sent(cmd['register'], cmd['count'])
         except Exception as e:
-            _weg_heartbeat_fail[0] += 1
-            add_message('ERROR', f"[WEG] Heartbeat error: {str(e)}")
-    
-    with weg_queue_lock:
-        if not weg_command_queue:
-            return
-        queue_len = len(weg_command_queue)
-        cmd = weg_command_queue.pop(0)
+            if heartbeat:
+                _weg_heartbeat_fail[0] += 1
+            add_message('ERROR', f"[WEG] {cmd['name']} read error: {str(e)}")
+        return
     
     add_message('INFO', f"[Node {weg_id}] Processing queue ({queue_len} commands)")
     try:
-        frame = build_modbus_write_frame(weg_id, cmd['register'], cmd['value'])
-        hex_frame = ' '.join([f'{b:02X}' for b in frame])
-        add_message('SEND', f"[Node {weg_id}] TX P{cmd['register']:04d}={cmd['value']}: {hex_frame}")
-        ser.reset_input_buffer()
-        bytes_sent = ser.write(frame)
-        ser.flush()
-        add_message('DEBUG', f"[Node {weg_id}] Sent {bytes_sent} bytes")
-        time.sleep(0.15)
-        response = ser.read(8)
-        if response:
-            hex_resp = ' '.join([f'{b:02X}' for b in response])
-            if len(response) >= 2 and response[1] == 0x06:
-                add_message('SUCCESS', f"[Node {weg_id}] RX OK: {hex_resp}")
-            elif len(response) >= 2 and response[1] & 0x80:
-                error_code = response[2] if len(response) > 2 else 0
-                add_message('ERROR', f"[Node {weg_id}] Exception {error_code}: {hex_resp}")
-            else:
-                add_message('DEBUG', f"[Node {weg_id}] RX: {hex_resp}")
+        if len(cmds) > 1:
+            # Adjacent registers (P0682 control word + P0683 speed): one FC16 transaction
+            frame = rtucodec.encode_write_multiple(weg_id, cmds[0]['register'], [cmd['value'] for cmd in cmds])
         else:
-            add_message('WARNING', f"[Node {weg_id}] No response (check wiring/ID)")
-            
+            frame = build_modbus_write_frame(weg_id, cmds[0]['register'], cmds[0]['value'])
+        hex_frame = rtucodec.hex_bytes(frame)
+        writes = ', '.join(f"P{cmd['register']:04d}={cmd['value']}" for cmd in cmds)
+        add_message('SEND', f"[Node {weg_id}] TX {writes}: {hex_frame}")
+        _send_weg_transaction(ser, 'write', frame, cmds)
     except Exception as e:
+        # Nothing reached the drive: keep the commands (a STOP must not be lost) for the next slot
+        weg_command_queue.push_front(cmds)
         add_message('ERROR', f"WEG TX error: {str(e)}")
         import traceback
         add_message('ERROR', traceback.format_exc())
 
+def _weg_reply_matches(request, kind, frame):
+    """True if frame is the reply to request: same FC (or its exception), and for normal replies
+    the echoed address/value (FC06/FC10) or the byte count (FC03/04) agree"""
+    request_fc = request[1]
+    fc = frame[1]
+    if fc & 0x7F != request_fc:
+        return False
+    if fc & 0x80:
+        return True
+    if request_fc in (0x03, 0x04):
+        # Our own request echoed back by the transceiver is a REQUEST-shaped frame, not the reply
+        return kind == rtucodec.RtuFrameParser.RESPONSE and frame[2] == 2 * ((request[4] << 8) | request[5])
+    if request_fc == 0x06:
+        return frame[2:6] == request[2:6]
+    if request_fc == 0x10:
+        return kind == rtucodec.RtuFrameParser.RESPONSE and frame[2:6] == request[2:6]
+    return True
+
+def on_weg_frame(kind, frame, weg_id, rx_time=None, registers=None):
+    """Match a frame from the WEG node against the in-flight transaction; True if it completed it.
+    Heartbeat telemetry is written into registers (the emulated A1000 image) if given."""
+    inflight = _weg_inflight[0]
+    if inflight is None or frame[0] != weg_id:
+        return False
+    if not _weg_reply_matches(inflight['frame'], kind, frame):
+        return False
+    if frame == inflight['frame'] and (rx_time or time.time()) < inflight['echo_until']:
+        # An FC06 reply is byte-identical to the request: this early copy is our own echo
+        _m_weg_echoes.inc()
+        return False
+    _weg_inflight[0] = None
+    _record_weg_rtt((rx_time or time.time()) - inflight['sent_at'])
+    _on_weg_exchange(inflight['sent_at'])
+    
+    fc = frame[1]
+    if fc & 0x80:
+        _m_weg_exceptions.inc()
+    hex_resp = rtucodec.hex_bytes(frame)
+    if inflight['kind'] == 'heartbeat':
+        if fc & 0x80:
+            _weg_heartbeat_fail[0] += 1
+            _poll_failed(inflight)
+            add_message('WARNING', f"[WEG] Heartbeat #{_weg_heartbeat_count[0]} exception {frame[2]}: {hex_resp}")
+            return True
+        _weg_heartbeat_ok[0] += 1
+        start = inflight['cmds'][0]['register'] if inflight['cmds'] else 680
+        _, _, values = rtucodec.decode_read_response(frame)
+        previous = weg_telemetry.get(680, (None, 0))[0]
+        apply_weg_telemetry(start, values, registers, rx_time)
+        if start == 680 and values[0] != previous:
+            status = values[0]
+            status_str = []
+            if status & 0x0100: status_str.append("RUN")
+            if status & 0x0200: status_str.append("GEN_EN")
+            if status & 0x1000: status_str.append("REMOTE")
+            if status & 0x8000: status_str.append("FAULT")
+            if status & 0x0080: status_str.append("ALARM")
+            add_message('DEBUG', f"[WEG] Heartbeat #{_weg_heartbeat_count[0]}: P0680=0x{status:04X} ({', '.join(status_str) if status_str else 'STOPPED'})")
+        return True
+    
+    if inflight['kind'] == 'read':
+        cmd = inflight['cmds'][0]
+        if fc & 0x80:
+            add_message('ERROR', f"[Node {weg_id}] {cmd['name']} read exception {frame[2]}: {hex_resp}")
+        else:
+            _, _, values = rtucodec.decode_read_response(frame)
+            add_message('DEBUG', f"[Node {weg_id}] {cmd['name']}: " + ', '.join(
+                f"P{cmd['register'] + i:04d}={val}" for i, val in enumerate(values)))
+        return True
+    
+    if fc & 0x80 and fc & 0x7F == 0x10 and len(inflight['cmds']) > 1:
+        # Drive rejected Write Multiple Registers: remember it and resend as single FC06 writes
+        _weg_fc16_supported[0] = False
+        weg_command_queue.push_front(inflight['cmds'])
+        add_message('WARNING', f"[Node {weg_id}] FC16 exception {frame[2]}: {hex_resp} - falling back to FC06 writes")
+    elif fc & 0x80:
+        add_message('ERROR', f"[Node {weg_id}] Exception {frame[2]}: {hex_resp}")
+        _finish_traces(inflight['cmds'], 'exception', rx_time)
+    else:
+        add_message('SUCCESS', f"[Node {weg_id}] RX OK: {hex_resp}")
+        _finish_traces(inflight['cmds'], 'acked', rx_time)
+    return True
+
+def _poll_failed(inflight):
+    for cmd in inflight['cmds']:
+        weg_poller.failed(cmd['register'], cmd['count'])
+
+def _finish_traces(cmds, outcome, at=None):
+    for cmd in cmds:
+        if cmd['traces']:
+            setpoint_tracer.finish(cmd['traces'], outcome, at)
+
+def _on_weg_timeout(inflight, weg_id):
+    """Report a WEG transaction whose reply did not arrive before its deadline"""
+    _weg_rtt['timeouts'] += 1
+    _m_weg_timeouts.inc()
+    if inflight['kind'] == 'heartbeat':
+        _weg_heartbeat_fail[0] += 1
+        _poll_failed(inflight)
+        if _weg_heartbeat_fail[0] <= 5 or _weg_heartbeat_fail[0] % 10 == 0:
+            add_message('WARNING', f"[WEG] Heartbeat #{_weg_heartbeat_count[0]} NO RESPONSE (fail {_weg_heartbeat_fail[0]}/{_weg_heartbeat_count[0]})")
+            add_message('DEBUG', f"[WEG] TX: {rtucodec.hex_bytes(inflight['frame'])}")
+    else:
+        add_message('WARNING', f"[Node {weg_id}] No response (check wiring/ID)")
+        _finish_traces(inflight['cmds'], 'timeout')
+
 # --- RAW SERIAL MONITOR ---
 raw_monitor_running = False
 raw_monitor_thread = None
@@ -1067,7 +2086,7 @@ def _raw_monitor_loop():
             data = ser.read(256)  # Read up to 256 bytes
             if data:
                 bytes_received += len(data)
-                hex_data = ' '.join([f'{b:02X}' for b in data])
+                hex_data = rtucodec.hex_bytes(data)
                 
                 # Try to decode as Modbus RTU
                 modbus_info = decode_raw_modbus(data)
@@ -1222,7 +2241,7 @@ def run_gateway():
     # Creamos un bloque de registros de tipo Holding (4x)
     # El PLC escribirá en las direcciones 1 y 2
     store = ModbusSlaveContext(
-        hr=YaskawaCallback(0x0000, initial_values),
+        hr=YaskawaCallback(0x0000, new_yaskawa_image(initial_values)),
         zero_mode=True
     )
     
@@ -1271,6 +2290,7 @@ def stop_server():
         except:
             pass
     add_message('INFO', 'Server stopped')
+    flush_messages()
 
 if __name__ == "__main__":
     try:
@@ -3,30 +3,120 @@ from flask_socketio import SocketIO, emit
 import threading
 import time
 import vfdserver
+from eventlog import EventFilter, as_dicts
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'wegdrive-secret-key'
 # Use threading mode instead of eventlet for Python 3.14 compatibility
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
-# Thread for broadcasting messages
+# --- LIVE STREAM ---
+# One push pipeline per browser: log messages, decoded entries and status travel as 'stream'
+# batches on Socket.IO. Each client has its own cursors into the message rings and acknowledges
+# every batch; a client with STREAM_MAX_INFLIGHT batches unacknowledged is skipped (its cursor
+# simply stays behind, and entries that fall out of the ring are reported as 'skipped'), and one
+# that acknowledges nothing for STREAM_STALL_S is disconnected. Other clients never wait for it.
 broadcast_thread = None
-last_message_count = 0
+stream_clients = {}            # sid -> client state, see handle_subscribe
+stream_lock = threading.Lock()
+
+def _status_payload():
+    return {
+        'server_running': vfdserver.server_running,
+        'message_count': len(vfdserver.recent_messages),
+        'current_mode': vfdserver.get_mode(),
+        'bus': vfdserver.get_bus_stats(),
+        'log_sampling': vfdserver.log_sampler.stats()
+    }
+
+def _on_stream_ack(sid, sent_at):
+    with stream_lock:
+        client = stream_clients.get(sid)
+        if client is not None:
+            client['inflight'] = max(0, client['inflight'] - 1)
+            client['last_ack'] = time.time()
+            client['rtt'] = time.time() - sent_at
+
+def _stream_batch(client, status, selected):
+    """Next batch for one client (None if there is nothing new), advancing its cursors.
+    selected memoizes EventFilter.select per (subscription, event) for this pass."""
+    limit = vfdserver.config.get('STREAM_BATCH_MAX', 200)
+    # Only entries the ring overwrote before this client read them are skipped (a new client,
+    # seq 0, just starts with whatever the ring still holds)
+    skipped = vfdserver.recent_messages.missed(client['seq']) if client['seq'] else 0
+    events, cursor = vfdserver.recent_messages.since(client['seq'], limit)
+    subscription = client['filter']
+    messages = []
+    for event in events:
+        key = (subscription.key, event.seq)
+        lines = selected.get(key)
+        if lines is None:
+            lines = selected[key] = subscription.select(event)
+        messages.extend(lines)
+    decoded, decoded_cursor = vfdserver.decoded_messages.since(client['decoded_seq'], limit)
+    decoded = [entry for entry in decoded if subscription.match_decoded(entry)]
+    if subscription.include_bits:
+        decoded = [vfdserver.with_decoded_bits(entry) for entry in decoded]
+    send_status = status is not None and status != client['status']
+    # Events the subscription filtered out are consumed too, so they are never counted as skipped
+    client['seq'] = cursor
+    client['decoded_seq'] = decoded_cursor
+    if not messages and not decoded and not send_status and not skipped:
+        return None
+    batch = {'seq': cursor, 'decoded_seq': decoded_cursor}
+    if messages:
+        batch['messages'] = messages
+    if skipped:
+        batch['skipped'] = skipped
+    if decoded:
+        batch['decoded'] = decoded
+    if send_status:
+        batch['status'] = status
+        client['status'] = status
+    return batch
 
 def broadcast_messages():
-    """Broadcast new messages to all connected clients"""
-    global last_message_count
+    """Push new messages, decoded entries and status to every subscribed client"""
+    last_status = 0.0
+    more = False
     while True:
-        time.sleep(0.5)  # Check every 500ms
-        current_count = len(vfdserver.recent_messages)
-        if current_count > last_message_count:
-            # Send new messages
-            new_messages = vfdserver.recent_messages[last_message_count:]
-            socketio.emit('new_messages', {'messages': new_messages})
-            last_message_count = current_count
-        elif current_count < last_message_count:
-            # Messages were cleared
-            last_message_count = current_count
+        if not more:
+            vfdserver.messages_changed.wait(vfdserver.config.get('STREAM_STATUS_S', 1.0))
+            time.sleep(vfdserver.config.get('STREAM_FLUSH_S', 0.05))  # Let a burst collect into one batch
+        vfdserver.messages_changed.clear()
+        now = time.time()
+        status = None
+        if now - last_status >= vfdserver.config.get('STREAM_STATUS_S', 1.0):
+            status = _status_payload()
+            last_status = now
+        more = False
+        selected = {}
+        with stream_lock:
+            clients = list(stream_clients.items())
+        for sid, client in clients:
+            if client['inflight'] >= vfdserver.config.get('STREAM_MAX_INFLIGHT', 2):
+                if now - client['last_ack'] > vfdserver.config.get('STREAM_STALL_S', 30.0):
+                    with stream_lock:
+                        stream_clients.pop(sid, None)
+                    socketio.server.disconnect(sid)
+                continue
+            batch = _stream_batch(client, status, selected)
+            if batch is None:
+                continue
+            with stream_lock:  # _on_stream_ack decrements it from the Socket.IO thread
+                client['inflight'] += 1
+                client['batches'] += 1
+            socketio.emit('stream', batch, to=sid,
+                          callback=lambda *args, sid=sid, sent_at=now: _on_stream_ack(sid, sent_at))
+            if client['seq'] < vfdserver.recent_messages.last_seq:
+                more = True  # Batch limit reached, send the rest without waiting
+
+def start_broadcast_thread():
+    """Start the live stream thread (once)"""
+    global broadcast_thread
+    if broadcast_thread is None or not broadcast_thread.is_alive():
+        broadcast_thread = threading.Thread(target=broadcast_messages, daemon=True)
+        broadcast_thread.start()
 
 @app.route('/')
 def index():
@@ -39,6 +129,7 @@ def get_config():
     return jsonify({
         'success': True,
         'config': vfdserver.config,
+        'timing': vfdserver.compute_bus_timing(),
         'server_running': vfdserver.server_running
     })
 
@@ -47,41 +138,97 @@ def update_config():
     """Update configuration"""
     try:
         data = request.json
+        # Every value is converted and checked first: a bad key fails the request without
+        # applying any of the others
+        updates = {}
         
         # Update config - Serial settings
         if 'PORT_CONTROLADOR' in data:
-            vfdserver.config['PORT_CONTROLADOR'] = data['PORT_CONTROLADOR']
+            updates['PORT_CONTROLADOR'] = data['PORT_CONTROLADOR']
         if 'PORT_WEG' in data:
-            vfdserver.config['PORT_WEG'] = data['PORT_WEG']
+            updates['PORT_WEG'] = data['PORT_WEG']
         if 'BAUD_RATE' in data:
-            vfdserver.config['BAUD_RATE'] = int(data['BAUD_RATE'])
+            updates['BAUD_RATE'] = int(data['BAUD_RATE'])
         if 'PARITY' in data:
-            vfdserver.config['PARITY'] = data['PARITY']
+            updates['PARITY'] = data['PARITY']
         if 'STOPBITS' in data:
-            vfdserver.config['STOPBITS'] = int(data['STOPBITS'])
+            updates['STOPBITS'] = int(data['STOPBITS'])
         if 'BYTESIZE' in data:
-            vfdserver.config['BYTESIZE'] = int(data['BYTESIZE'])
+            updates['BYTESIZE'] = int(data['BYTESIZE'])
         
         # Slave IDs
         if 'SLAVE_ID' in data:
-            vfdserver.config['SLAVE_ID'] = int(data['SLAVE_ID'])
+            updates['SLAVE_ID'] = int(data['SLAVE_ID'])
         if 'YASKAWA_SLAVE_ID' in data:
-            vfdserver.config['YASKAWA_SLAVE_ID'] = int(data['YASKAWA_SLAVE_ID'])
+            updates['YASKAWA_SLAVE_ID'] = int(data['YASKAWA_SLAVE_ID'])
         
         # Frequency settings
         if 'MAX_FREQ' in data:
-            vfdserver.config['MAX_FREQ'] = int(data['MAX_FREQ'])
+            updates['MAX_FREQ'] = int(data['MAX_FREQ'])
         
         # Bus mode settings
         if 'SINGLE_BUS_MODE' in data:
-            vfdserver.config['SINGLE_BUS_MODE'] = bool(data['SINGLE_BUS_MODE'])
+            updates['SINGLE_BUS_MODE'] = bool(data['SINGLE_BUS_MODE'])
         if 'RESPOND_TO_ANY_ID' in data:
-            vfdserver.config['RESPOND_TO_ANY_ID'] = bool(data['RESPOND_TO_ANY_ID'])
+            updates['RESPOND_TO_ANY_ID'] = bool(data['RESPOND_TO_ANY_ID'])
         if 'HEARTBEAT_INTERVAL' in data:
-            vfdserver.config['HEARTBEAT_INTERVAL'] = float(data['HEARTBEAT_INTERVAL'])
+            updates['HEARTBEAT_INTERVAL'] = float(data['HEARTBEAT_INTERVAL'])
         if 'WEG_MAX_FREQ_HZ' in data:
-            vfdserver.config['WEG_MAX_FREQ_HZ'] = float(data['WEG_MAX_FREQ_HZ'])
+            updates['WEG_MAX_FREQ_HZ'] = float(data['WEG_MAX_FREQ_HZ'])
+        if 'WEG_QUEUE_MAX' in data:
+            updates['WEG_QUEUE_MAX'] = int(data['WEG_QUEUE_MAX'])
+        if 'WEG_COMBINE_WRITES' in data:
+            updates['WEG_COMBINE_WRITES'] = bool(data['WEG_COMBINE_WRITES'])
+        if 'ASYNC_LOGGING' in data:
+            updates['ASYNC_LOGGING'] = bool(data['ASYNC_LOGGING'])
+        if 'LOG_RATE_LIMITS' in data:
+            updates['LOG_RATE_LIMITS'] = {str(msg_type): float(rate)
+                                          for msg_type, rate in data['LOG_RATE_LIMITS'].items()}
+        if 'LOG_REPEAT_WINDOW_S' in data:
+            updates['LOG_REPEAT_WINDOW_S'] = float(data['LOG_REPEAT_WINDOW_S'])
+        if 'LOG_ALWAYS_TYPES' in data:
+            updates['LOG_ALWAYS_TYPES'] = [str(msg_type) for msg_type in data['LOG_ALWAYS_TYPES']]
+        for key in ('STREAM_FLUSH_S', 'STREAM_STATUS_S', 'STREAM_STALL_S'):
+            if key in data:
+                updates[key] = float(data[key])
+        for key in ('STREAM_BATCH_MAX', 'STREAM_MAX_INFLIGHT'):
+            if key in data:
+                updates[key] = max(1, int(data[key]))
+        if 'WEG_DEADLINES_S' in data:
+            deadlines = {name: float(value) for name, value in data['WEG_DEADLINES_S'].items()
+                         if name in vfdserver.WEG_PRIORITY_NAMES}
+            updates['WEG_DEADLINES_S'] = dict(vfdserver.config['WEG_DEADLINES_S'], **deadlines)
+        if 'WEG_TURNAROUND_TIMEOUT_S' in data:
+            updates['WEG_TURNAROUND_TIMEOUT_S'] = float(data['WEG_TURNAROUND_TIMEOUT_S'])
+        if 'WEG_TELEMETRY' in data:
+            updates['WEG_TELEMETRY'] = bool(data['WEG_TELEMETRY'])  # applied on next server start
+        if 'WEG_POLL_PERIODS_S' in data:
+            updates['WEG_POLL_PERIODS_S'] = {str(name): float(period)
+                                             for name, period in data['WEG_POLL_PERIODS_S'].items()}
+        if 'WEG_POLL_BUDGET' in data:
+            updates['WEG_POLL_BUDGET'] = min(1.0, max(0.0, float(data['WEG_POLL_BUDGET'])))
+        if 'WEG_WATCHDOG_S' in data:
+            updates['WEG_WATCHDOG_S'] = float(data['WEG_WATCHDOG_S']) if data['WEG_WATCHDOG_S'] else None
+        if 'WEG_WATCHDOG_MARGIN' in data:
+            margin = float(data['WEG_WATCHDOG_MARGIN'])
+            if not 0.0 < margin < 1.0:
+                raise ValueError('WEG_WATCHDOG_MARGIN must be between 0 and 1')
+            updates['WEG_WATCHDOG_MARGIN'] = margin
+        if 'HMI_RESPONSE_WINDOW_S' in data:
+            updates['HMI_RESPONSE_WINDOW_S'] = float(data['HMI_RESPONSE_WINDOW_S'])
+        if 'SERIAL_IO_MODE' in data:
+            if data['SERIAL_IO_MODE'] not in vfdserver.SERIAL_IO_MODES:
+                raise ValueError(f"SERIAL_IO_MODE must be one of {', '.join(vfdserver.SERIAL_IO_MODES)}")
+            updates['SERIAL_IO_MODE'] = data['SERIAL_IO_MODE']
+        
+        # Bus timing overrides (null = derive from baud rate; applied on next server start)
+        for key in ('FRAME_GAP_S', 'RESPONSE_DELAY_S', 'BUS_IDLE_S', 'STALE_FRAME_S', 'SERIAL_LATENCY_S'):
+            if key in data:
+                updates[key] = None if data[key] is None else float(data[key])
         
+        vfdserver.config.update(updates)
+        vfdserver.configure_log_sampling()
+        vfdserver.configure_weg_poller()
         vfdserver.add_message('INFO', 'Configuration updated')
         
         return jsonify({
@@ -94,20 +241,50 @@ def update_config():
             'message': str(e)
         }), 400
 
+# --- INCREMENTAL READS ---
+# /api/messages and /api/decoded take ?since=<seq> (entries after that sequence number, pass
+# back the returned 'seq') and ?limit=<n>; 'more' says the limit cut the read short. The ETag
+# is the ring state plus the query, so a poller that sends If-None-Match gets an empty 304
+# while nothing changed. Decoded entries leave out 'decoded_bits' unless ?include_bits=1.
+def _cursor_args():
+    since = max(0, request.args.get('since', 0, type=int))
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, limit)
+    include_bits = request.args.get('include_bits', '').lower() in ('1', 'true', 'yes')
+    return since, limit, include_bits
+
+def _ring_etag(ring, *query):
+    """ETag for a read of ring with the given query, or a 304 response if the client has it"""
+    etag = '-'.join(str(part) for part in (ring.floor, ring.last_seq) + query)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return etag, response
+    return etag, None
+
 @app.route('/api/messages', methods=['GET'])
 def get_messages():
-    """Get all recent messages"""
-    return jsonify({
+    """Recent messages after ?since= (at most ?limit=)"""
+    since, limit, _ = _cursor_args()
+    ring = vfdserver.recent_messages
+    etag, not_modified = _ring_etag(ring, since, limit)
+    if not_modified:
+        return not_modified
+    messages, cursor = ring.since(since, limit)
+    response = jsonify({
         'success': True,
-        'messages': vfdserver.recent_messages
+        'messages': as_dicts(messages),
+        'seq': cursor,
+        'more': cursor < ring.last_seq
     })
+    response.set_etag(etag)
+    return response
 
 @app.route('/api/messages/clear', methods=['POST'])
 def clear_messages():
     """Clear all messages"""
-    global last_message_count
     vfdserver.recent_messages.clear()
-    last_message_count = 0
     return jsonify({
         'success': True,
         'message': 'Messages cleared'
@@ -159,13 +336,50 @@ def stop_server():
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Get server status"""
+    with stream_lock:
+        clients = [{'seq': c['seq'], 'inflight': c['inflight'], 'batches': c['batches'],
+                    'subscription': c['filter'].to_dict(),
+                    'ack_rtt_ms': c['rtt'] * 1000 if c['rtt'] is not None else None}
+                   for c in stream_clients.values()]
+    return jsonify(dict(_status_payload(), success=True, stream_clients=clients))
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Stage latency histograms and fault counters"""
+    return jsonify(dict(vfdserver.metrics.to_dict(), success=True))
+
+@app.route('/api/metrics/reset', methods=['POST'])
+def reset_metrics():
+    """Zero all histograms and counters"""
+    vfdserver.metrics.reset()
     return jsonify({
         'success': True,
-        'server_running': vfdserver.server_running,
-        'message_count': len(vfdserver.recent_messages),
-        'current_mode': vfdserver.get_mode()
+        'message': 'Metrics reset'
     })
 
+@app.route('/api/setpoints', methods=['GET'])
+def get_setpoints():
+    """HMI write -> drive acknowledgement latency per Yaskawa register, and the latest traces"""
+    return jsonify({
+        'success': True,
+        'registers': vfdserver.setpoint_tracer.stats(),
+        'recent': vfdserver.setpoint_tracer.recent_traces()
+    })
+
+@app.route('/api/setpoints/clear', methods=['POST'])
+def clear_setpoints():
+    """Forget setpoint traces and latencies"""
+    vfdserver.setpoint_tracer.clear()
+    return jsonify({
+        'success': True,
+        'message': 'Setpoint traces cleared'
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics_prometheus():
+    """The same metrics in the Prometheus text format, for scraping"""
+    return app.response_class(vfdserver.metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/mode', methods=['GET'])
 def get_mode():
     """Get current application mode"""
@@ -207,11 +421,23 @@ def set_mode():
 
 @app.route('/api/decoded', methods=['GET'])
 def get_decoded():
-    """Get decoded Yaskawa messages (for listen mode)"""
-    return jsonify({
+    """Decoded Yaskawa messages (for listen mode) after ?since= (at most ?limit=)"""
+    since, limit, include_bits = _cursor_args()
+    ring = vfdserver.decoded_messages
+    etag, not_modified = _ring_etag(ring, since, limit, int(include_bits))
+    if not_modified:
+        return not_modified
+    decoded, cursor = ring.since(since, limit)
+    if include_bits:
+        decoded = [vfdserver.with_decoded_bits(entry) for entry in decoded]
+    response = jsonify({
         'success': True,
-        'decoded': vfdserver.decoded_messages
+        'decoded': decoded,
+        'seq': cursor,
+        'more': cursor < ring.last_seq
     })
+    response.set_etag(etag)
+    return response
 
 @app.route('/api/decoded/clear', methods=['POST'])
 def clear_decoded():
@@ -401,15 +627,41 @@ def handle_connect():
     print('Client connected')
     emit('connection_response', {'status': 'connected'})
 
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    """Start (or resume) the live stream for this client from its last seen sequence numbers.
+    Optional topics (types, nodes, registers, modes) are filtered on the server."""
+    data = data or {}
+    try:
+        subscription = EventFilter.from_request(data)
+    except (TypeError, ValueError) as e:
+        emit('subscribe_error', {'message': str(e)})
+        return
+    with stream_lock:
+        stream_clients[request.sid] = {
+            'filter': subscription,
+            'seq': int(data.get('since', 0)),
+            'decoded_seq': int(data.get('decoded_since', 0)),
+            'inflight': 0,
+            'last_ack': time.time(),
+            'rtt': None,
+            'batches': 0,
+            'status': None,
+        }
+    start_broadcast_thread()
+    emit('subscribed', subscription.to_dict())
+    vfdserver.messages_changed.set()  # Send the backlog right away
+
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
+    with stream_lock:
+        stream_clients.pop(request.sid, None)
     print('Client disconnected')
 
 if __name__ == '__main__':
     # Start broadcast thread
-    broadcast_thread = threading.Thread(target=broadcast_messages, daemon=True)
-    broadcast_thread.start()
+    start_broadcast_thread()
     
     print("Starting Web Interface on http://localhost:5000")
     socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)